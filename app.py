@@ -1,25 +1,162 @@
-from flask import Flask, request, jsonify, send_file, Response
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context, g
 from flask_cors import CORS
 import openai
 import logging
+import logging.handlers
+import atexit
+import copy
 import os
 import sys
 import time
 import requests
+import httpx
 from dotenv import load_dotenv
 from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
 import json
-
-# 配置日志记录
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
-logger = logging.getLogger(__name__)
+import re
+import contextvars
+import cProfile
+import threading
+import hashlib
+import select
+import socket
+import sqlite3
+import unicodedata
+import tempfile
+import uuid
+import queue
+import math
+import random
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，文件存储退化为只依赖原子替换
+    fcntl = None
 
 load_dotenv()
 
+# 当前请求的ID和耗时记录，由请求钩子设置，后台线程通过run_in_context继承
+_current_request_id = contextvars.ContextVar("current_request_id", default="-")
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()  # 日志级别
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # 日志格式：text，或json（每行一个JSON对象）
+LOG_MAX_FIELD_LENGTH = int(os.getenv("LOG_MAX_FIELD_LENGTH", "2000"))  # 日志消息和异常堆栈的最大长度，超出部分截断，0表示不截断
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 后台日志队列长度，队列满时丢弃新日志而不阻塞请求
+LOG_VERBOSE_SAMPLE_RATE = float(os.getenv("LOG_VERBOSE_SAMPLE_RATE", "0"))  # 请求参数、提示词等详细日志的采样率（0-1）
+LOG_REDACT_PII = os.getenv("LOG_REDACT_PII", "true").lower() in ("1", "true", "yes")  # 是否脱敏日志中的邮箱、手机号和身份证号
+VERBOSE = {"verbose": True}  # 作为extra传给logger，标记按采样率输出的详细日志
+
+# 日志中需要脱敏的密钥：sk-开头的API密钥、Authorization头和各类key/token字段
+SECRET_PATTERNS = [
+    (re.compile(r'Bearer\s+[A-Za-z0-9._\-]+'), 'Bearer ***'),
+    (re.compile(r'sk-[A-Za-z0-9_\-]{6,}'), 'sk-***'),
+    (re.compile(r'''((?:api_?key|authorization|password|secret|token)['"]?\s*[:=]\s*['"]?)(?!\*\*\*|Bearer \*\*\*)[^'"\s,}]+''',
+                re.IGNORECASE), r'\1***'),
+]
+# 简历中的个人信息
+PII_PATTERNS = [
+    (re.compile(r'[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}'), '<email>'),
+    (re.compile(r'(?<!\d)\d{17}[\dXx](?!\d)'), '<id>'),
+    (re.compile(r'(?<!\d)1[3-9]\d{9}(?!\d)'), '<phone>'),
+]
+
+def redact(text):
+    """把日志文本中的密钥和个人信息替换为占位符"""
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    if LOG_REDACT_PII:
+        for pattern, replacement in PII_PATTERNS:
+            text = pattern.sub(replacement, text)
+    return text
+
+def truncate_text(text, limit=LOG_MAX_FIELD_LENGTH):
+    """超过limit个字符时截断并注明原长度"""
+    if limit > 0 and len(text) > limit:
+        return f"{text[:limit]}...(已截断，共{len(text)}字符)"
+    return text
+
+class RequestIdFilter(logging.Filter):
+    """给每条日志加上当前请求的ID，便于把同一请求的日志串起来"""
+    def filter(self, record):
+        record.request_id = _current_request_id.get()
+        return True
+
+class VerboseSampler(logging.Filter):
+    """详细日志（extra=VERBOSE）按LOG_VERBOSE_SAMPLE_RATE采样，未采中的日志不会被格式化，其余日志全部保留"""
+    def filter(self, record):
+        if getattr(record, "verbose", False):
+            return random.random() < LOG_VERBOSE_SAMPLE_RATE
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    把日志放入队列，由后台线程格式化、脱敏并写出，写日志不会阻塞请求线程
+    请求线程中只生成消息文本并截断；队列满时丢弃日志并计数
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = truncate_text(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            # 异常对象引用着调用栈，不能留到后台线程再格式化
+            record.exc_text = truncate_text(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class RedactingFormatter(logging.Formatter):
+    """文本格式日志，输出前脱敏"""
+    def format(self, record):
+        return redact(super().format(record))
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON，输出前脱敏"""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "requestId": getattr(record, "request_id", "-"),
+            "thread": record.threadName,
+            "message": redact(record.getMessage())
+        }
+        if record.exc_text:
+            entry["exception"] = redact(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False)
+
+# 配置日志记录：请求线程只把日志放入队列，由后台线程写到标准输出
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_output = logging.StreamHandler(sys.stdout)
+if LOG_FORMAT == "json":
+    log_output.setFormatter(JsonFormatter())
+else:
+    log_output.setFormatter(RedactingFormatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'))
+log_handler = NonBlockingQueueHandler(log_queue)
+log_handler.addFilter(RequestIdFilter())
+log_handler.addFilter(VerboseSampler())
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+log_listener = logging.handlers.QueueListener(log_queue, log_output)
+log_listener.start()
+# 退出时写出队列中剩余的日志
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allow all origins for development
 
@@ -35,406 +172,4481 @@ API_TIMEOUT = 60  # API调用超时时间（秒）
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-3.5-turbo")
 logger.info(f"初始配置: API基础URL={current_config['baseUrl']}, 模型={DEFAULT_MODEL}, 超时={API_TIMEOUT}秒")
 
-@app.route('/')
-def index():
-    logger.info("访问主页")
-    return send_file('index.html')
+# 共享配置存储：/save_config保存的配置写入这里，各worker进程按版本号检查并同步
+CONFIG_STORE = os.getenv("CONFIG_STORE", "memory").strip().lower()  # memory（仅当前进程）、file（JSON文件）或sqlite，多个worker共享配置时使用后两者
+CONFIG_STORE_PATH = os.getenv("CONFIG_STORE_PATH", "")  # 存储路径，默认file为config.json、sqlite为config.db
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1"))  # 每个进程检查配置版本的最小间隔（秒）
+
+# API地址解析缓存：基础URL -> (解析结果, 过期时间)
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", "3600"))  # 找到更优路径时的缓存时间（秒）
+URL_CACHE_NEGATIVE_TTL = int(os.getenv("URL_CACHE_NEGATIVE_TTL", "300"))  # 未找到更优路径时的缓存时间（秒）
+_url_cache = {}
+_url_cache_lock = threading.Lock()
+
+# API地址探测配置
+PROBE_DEADLINE = float(os.getenv("PROBE_DEADLINE", "8"))  # 一次地址探测（规范化或连接测试）的总时限（秒）
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "5"))  # 单个探测请求的超时（秒），不超过剩余的总时限
+PROBE_MAX_CONCURRENCY = int(os.getenv("PROBE_MAX_CONCURRENCY", "8"))  # 一次探测中同时发出的最大请求数
+
+# 上游客户端连接池配置
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "32"))  # 最多保留的(api_key, base_url)组合数
+CLIENT_POOL_CONNECTIONS = int(os.getenv("CLIENT_POOL_CONNECTIONS", "20"))  # 每个上游的最大连接数
+CLIENT_KEEPALIVE_EXPIRY = float(os.getenv("CLIENT_KEEPALIVE_EXPIRY", "60"))  # 空闲连接保活时间（秒）
+OPENAI_VERSION = getattr(openai, "__version__", "未知")
+
+# 上游健康检查与熔断配置
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))  # 后台健康检查间隔（秒）
+HEALTH_CHECK_IDLE_EXPIRY = float(os.getenv("HEALTH_CHECK_IDLE_EXPIRY", "3600"))  # 超过该时间未使用的上游不再检查（秒）
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))  # 连续失败多少次后熔断
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))  # 熔断后多久允许试探请求（秒）
+
+# 重试策略配置
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "150"))  # 单次请求（含所有重试）的总时限（秒）
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))  # 遇到可重试错误时的最多尝试次数
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))  # 指数退避的初始等待时间（秒）
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))  # 单次退避的最长等待时间（秒），Retry-After不受此限制
+PROTOCOL_MEMORY_TTL = float(os.getenv("PROTOCOL_MEMORY_TTL", "3600"))  # 记住上游可用调用方式的时间（秒）
+CHAT_PROTOCOLS = ("sdk", "http_chat", "completions")  # 上游调用方式的默认尝试顺序
+
+# 多上游池配置
+UPSTREAMS = os.getenv("UPSTREAMS", "")  # JSON数组，每项包含name、baseUrl、apiKey、model、models（模型映射）和weight
+UPSTREAM_EWMA_ALPHA = float(os.getenv("UPSTREAM_EWMA_ALPHA", "0.3"))  # 延迟和错误率滑动平均的平滑系数
+UPSTREAM_MAX_FAILOVER = int(os.getenv("UPSTREAM_MAX_FAILOVER", "3"))  # 单次请求最多尝试的上游数
+
+# 上游限流配置（按API地址和密钥分别计算）
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "0"))  # 每分钟最多请求数，0表示只使用从上游响应头学到的限额
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", "0"))  # 每分钟最多token数，0表示只使用从上游响应头学到的限额
+RATE_LIMIT_MAX_INFLIGHT = int(os.getenv("RATE_LIMIT_MAX_INFLIGHT", "0"))  # 所有worker合计同时进行的调用数上限，0表示不限制
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "10"))  # 超限时最多排队等待的时间（秒），预计更久时直接返回429
+RATE_LIMIT_COMPLETION_TOKENS = int(os.getenv("RATE_LIMIT_COMPLETION_TOKENS", "1024"))  # 未指定max_tokens时预估的输出token数
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "resume-ratelimit.db"))  # 限流状态SQLite文件，多个worker进程共享，留空时只在进程内限流
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "1"))  # 有限额时与共享状态同步的间隔（秒）
+RATE_LIMIT_POLL_INTERVAL = 0.1  # 等待并发名额时的轮询间隔（秒）
+
+# 对冲请求配置（默认关闭，也可以在请求中用hedge参数单独开启或关闭）
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # 主请求超过最近首个分片延迟的该分位数仍无内容时发出对冲请求
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))  # 计算分位数使用的最近延迟样本数
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))  # 样本数不足时不对冲
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))  # 发出对冲请求前的最短等待时间（秒）
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))  # 最近一分钟内对冲请求占调用次数的最大比例
+HEDGE_TOKEN_BUDGET = int(os.getenv("HEDGE_TOKEN_BUDGET", "50000"))  # 最近一分钟内对冲请求最多消耗的估算token数，0表示不限制
+
+# 响应缓存配置
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))  # 内存中最多缓存的答案数，设为0关闭缓存
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # 缓存有效期（秒）
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "")  # 可选的SQLite缓存文件，多个worker共享且重启后保留
+SINGLEFLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", "300"))  # 等待相同请求结果的最长时间（秒）
+
+# 近似重复缓存：只有空白、标点、联系方式或条目顺序不同的简历复用或参考此前的结果
+NEAR_DUP_MODE = os.getenv("NEAR_DUP_MODE", "off").strip().lower()  # off（关闭）、answer（直接返回此前的答案）或seed（作为参考交给模型）
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.9"))  # 判定为近似重复的最低相似度（估算的Jaccard相似度，0-1）
+NEAR_DUP_MAX_ENTRIES = int(os.getenv("NEAR_DUP_MAX_ENTRIES", "20000"))  # 相似度索引最多保留的条目数，超出时淘汰最久未使用的
+NEAR_DUP_MAX_CANDIDATES = int(os.getenv("NEAR_DUP_MAX_CANDIDATES", "50"))  # 单次查询最多比较的候选条目数
+
+# 批量优化配置
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))  # 单次批量请求的最大条数
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))  # 单次批量请求的最大并行数
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8"))  # 批量任务对同一上游的最大并发调用数
+_upstream_semaphores = {}
+_upstream_semaphores_lock = threading.Lock()
+
+# 分段优化配置
+SECTION_AUTO_TOKENS = int(os.getenv("SECTION_AUTO_TOKENS", "0"))  # 简历估算token数超过该值时自动分段优化，0表示只在请求指定sectioned时分段
+SECTION_MIN_TOKENS = int(os.getenv("SECTION_MIN_TOKENS", "80"))  # 同一部分中不足该token数的条目与后面的条目合并为一段
+SECTION_MAX_TOKENS = int(os.getenv("SECTION_MAX_TOKENS", "1500"))  # 单段最大token数，超过时按行切开
+SECTION_MAX_CONCURRENCY = int(os.getenv("SECTION_MAX_CONCURRENCY", "6"))  # 单个请求并行改写的最大段数
+
+# 输入压缩配置：调用上游前按顺序执行的简历预处理步骤
+INPUT_COMPACTION = [step.strip().lower() for step in os.getenv("INPUT_COMPACTION", "unicode,whitespace").split(",") if step.strip()]  # 可选unicode、whitespace（默认，不删改内容）以及boilerplate、lists、budget（会删除内容，需显式开启），留空关闭
+INPUT_MAX_LIST_ITEMS = int(os.getenv("INPUT_MAX_LIST_ITEMS", "0"))  # 并列项（如技能列表）最多保留的项数，0表示只去重不截断
+INPUT_TOKEN_BUDGET = int(os.getenv("INPUT_TOKEN_BUDGET", "0"))  # 简历正文的估算token数上限，超出部分按行截断，0表示不限制
+
+# 异步任务队列配置
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")  # 任务库SQLite文件，多个worker进程共享
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # 每个进程的任务处理线程数，设为0关闭任务队列
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))  # 空闲时轮询任务库的间隔（秒）
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "600"))  # 任务租约时间，超时未完成的任务会被重新领取（秒）
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # 任务最多执行次数
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "604800"))  # 已结束任务的保留时间（秒）
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "1000"))  # 任务库中最多排队的任务数，超过时拒绝提交，0表示不限制
+
+# 准入控制配置：每个进程同时处理和排队的耗时请求数，两者之和应小于gunicorn每个进程可处理的连接（或线程）数，
+# 为配置查询等轻量请求留出余量
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "256"))  # 同时处理的耗时请求数上限，0表示不限制
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "512"))  # 达到上限后最多排队的请求数，队列满时返回503
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30"))  # 最长排队时间（秒），超时返回503
+ADMISSION_ENDPOINTS = {"chat", "chat_batch", "test_api"}  # 受准入控制的接口（视图函数名）
+
+# 请求取消配置
+CANCEL_CHECK_INTERVAL = float(os.getenv("CANCEL_CHECK_INTERVAL", "0.5"))  # 检查客户端是否断开、请求是否超过截止时间的间隔（秒），0表示只在流式输出失败时发现断开
+CANCELLABLE_ENDPOINTS = {"chat", "chat_batch"}  # 客户端断开或超过截止时间时取消上游调用的接口（视图函数名）
+
+# 指标配置
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "200"))  # 每个指标最多保留的标签组合数，超出的计入other
+
+# 请求追踪配置
+SERVER_TIMING_MAX_ENTRIES = int(os.getenv("SERVER_TIMING_MAX_ENTRIES", "30"))  # Server-Timing响应头最多包含的阶段数
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 性能分析采样率（0-1），0表示关闭
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # 性能分析结果(.prof)的保存目录
+PROFILE_PATHS = ("/chat", "/chat/batch", "/test_api")  # 参与性能分析采样的接口
+
+# 允许前端传入并参与缓存键计算的采样参数
+SAMPLING_PARAMS = ("temperature", "top_p", "max_tokens", "presence_penalty", "frequency_penalty")
+logger.info(f"OpenAI库版本: {OPENAI_VERSION}")
+
+@app.route('/')
+def index():
+    logger.info("访问主页")
+    return send_file('index.html')
+
+@app.route('/save_config', methods=['POST'])
+def save_config():
+    try:
+        data = request.get_json()
+        logger.info(f"收到配置数据，字段: {sorted(data)}")
+        
+        changes = {"config": {}}
+        if 'upstreams' in data:
+            # 传入空列表时关闭多上游池；校验通过才写入共享存储
+            try:
+                UpstreamPool.parse(data['upstreams'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            changes["upstreams"] = data['upstreams'] or []
+        
+        if 'apiKey' in data and data['apiKey']:
+            changes["config"]["api_key"] = data['apiKey']
+            logger.info("API密钥已更新")
+        
+        if 'baseUrl' in data and data['baseUrl']:
+            changes["config"]["baseUrl"] = data['baseUrl']
+            logger.info(f"API基础URL已更新为: {data['baseUrl']}")
+            
+        if 'model' in data and data['model']:
+            changes["config"]["model"] = data['model']
+            logger.info(f"模型已更新为: {data['model']}")
+        
+        # 写入共享存储后立即在本进程生效，其它worker在下次检查版本时同步
+        with _config_state_lock:
+            version, document = config_store.update(changes)
+            apply_config_document(version, document)
+            
+        logger.info(f"当前配置: {dict(current_config, api_key=mask_api_key(current_config['api_key']))}")
+        return jsonify({"message": "配置更新成功", "config": current_config, "configVersion": version})
+    except Exception as e:
+        logger.error(f"保存配置时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+def get_cached_api_url(base_url):
+    """从缓存中读取已解析的API地址，未命中或已过期时返回None"""
+    key = base_url.rstrip('/')
+    with _url_cache_lock:
+        entry = _url_cache.get(key)
+        if entry is None:
+            return None
+        resolved_url, expires_at = entry
+        if time.time() >= expires_at:
+            del _url_cache[key]
+            return None
+        return resolved_url
+
+def set_cached_api_url(base_url, resolved_url):
+    """缓存API地址解析结果，未找到更优路径时使用较短的负缓存时间"""
+    key = base_url.rstrip('/')
+    ttl = URL_CACHE_TTL if resolved_url.rstrip('/') != key else URL_CACHE_NEGATIVE_TTL
+    with _url_cache_lock:
+        _url_cache[key] = (resolved_url, time.time() + ttl)
+
+def invalidate_api_url_cache(*base_urls):
+    """使指定基础URL的解析缓存失效，不传参数时清空全部缓存"""
+    with _url_cache_lock:
+        if not base_urls:
+            _url_cache.clear()
+            return
+        for base_url in base_urls:
+            if base_url:
+                _url_cache.pop(base_url.rstrip('/'), None)
+
+def normalize_api_url(base_url, use_cache=True):
+    """
+    尝试规范化API基础URL，确保它指向正确的API端点而不是前端页面
+    解析结果会按基础URL缓存，use_cache=False时强制重新探测
+    """
+    if use_cache:
+        cached_url = get_cached_api_url(base_url)
+        if cached_url is not None:
+            logger.info(f"使用缓存的API URL解析结果: {base_url} -> {cached_url}")
+            return cached_url
+
+    resolved_url = _probe_api_url(base_url)
+    set_cached_api_url(base_url, resolved_url)
+    return resolved_url
+
+class ApiProbe:
+    """
+    一个候选API地址的探测：对url发送method请求，check(response)返回(是否接受, 原因)，
+    被接受时result_url为探测出的API地址；priority越小越优先
+    """
+    def __init__(self, priority, method, url, result_url, check, message=None):
+        self.priority = priority
+        self.method = method
+        self.url = url
+        self.result_url = result_url
+        self.check = check
+        self.message = message
+        self.status = None
+        self.duration = None
+        self.accepted = None
+        self.reason = "未在时限内完成"
+        self.html = False
+
+    def report(self, selected=False):
+        if self.accepted is None:
+            outcome = "pending"
+        else:
+            outcome = "accepted" if self.accepted else "rejected"
+        return {
+            "priority": self.priority,
+            "method": self.method,
+            "url": self.url,
+            "status": self.status,
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "outcome": outcome,
+            "reason": self.reason,
+            "selected": selected
+        }
+
+def is_html_response(response):
+    """响应是否为HTML页面（API地址填成了网站首页时常见）"""
+    if 'text/html' in response.headers.get('content-type', '').lower():
+        return True
+    return response.text.lstrip()[:16].lower().startswith(('<!doctype', '<html'))
+
+def check_endpoint_exists(response):
+    """HEAD/OPTIONS探测：除404和HTML页面以外的响应都说明端点可能存在"""
+    if response.status_code == 404:
+        return False, "返回404，端点不存在"
+    if is_html_response(response):
+        return False, "返回HTML页面"
+    return True, f"返回{response.status_code}，端点可能存在"
+
+def check_models_endpoint(response):
+    """models探测（地址规范化）：返回JSON或非HTML内容即可"""
+    if response.headers.get('content-type', '').startswith('application/json'):
+        return True, f"返回{response.status_code}和JSON"
+    if is_html_response(response):
+        return False, "返回HTML页面"
+    return True, f"返回{response.status_code}和非HTML内容"
+
+def check_models_listing(response):
+    """models探测（连接测试）：需要返回200和JSON"""
+    if is_html_response(response):
+        return False, "返回HTML页面"
+    if response.status_code != 200:
+        return False, f"返回{response.status_code}"
+    if 'application/json' not in response.headers.get('content-type', '').lower():
+        return False, "返回的不是JSON"
+    return True, "返回200和JSON"
+
+def run_probes(probes, headers=None, deadline=None):
+    """
+    并发执行一组探测，所有探测共用一个总时限（默认PROBE_DEADLINE秒）
+    某个候选被接受且比它优先的候选都已失败时立即返回，不再等待其余探测；
+    到达总时限时返回已被接受的最优候选。method和url相同的候选只发送一次请求
+    返回(最优候选或None, 各探测的报告列表)
+    """
+    deadline = deadline or time.time() + PROBE_DEADLINE
+    ordered = sorted(probes, key=lambda probe: probe.priority)
+    groups = OrderedDict()
+    for probe in ordered:
+        groups.setdefault((probe.method, probe.url), []).append(probe)
+    
+    def send(method, url):
+        start_time = time.time()
+        try:
+            timeout = max(0.1, min(PROBE_TIMEOUT, deadline - start_time))
+            return probe_request(method, url, headers=headers, timeout=timeout), None, time.time() - start_time
+        except Exception as e:
+            return None, e, time.time() - start_time
+    
+    def pick_best():
+        # 按优先级查找第一个被接受的候选；更优先的候选还没有结果时继续等待
+        for probe in ordered:
+            if probe.accepted is None:
+                return None
+            if probe.accepted:
+                return probe
+        return None
+    
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=min(PROBE_MAX_CONCURRENCY, len(groups)), thread_name_prefix="api-probe")
+    futures = {executor.submit(run_in_context(send), *key): key for key in groups}
+    best = None
+    try:
+        pending = set(futures)
+        while pending and best is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                response, error, duration = future.result()
+                for probe in groups[futures[future]]:
+                    probe.duration = duration
+                    if error is not None:
+                        probe.accepted, probe.reason = False, f"请求失败: {type(error).__name__}"
+                        continue
+                    probe.status = response.status_code
+                    probe.html = is_html_response(response)
+                    probe.accepted, probe.reason = probe.check(response)
+            best = pick_best()
+    finally:
+        # 提前返回时不等待其余探测，它们会在各自的超时内结束
+        executor.shutdown(wait=False, cancel_futures=True)
+    if best is None:
+        best = next((probe for probe in ordered if probe.accepted), None)
+    elif time.time() < deadline:
+        for probe in ordered:
+            if probe.accepted is None:
+                probe.reason = "已选定更优先的候选，未等待结果"
+    logger.info(f"并发探测{len(groups)}个请求，耗时{time.time() - start_time:.2f}秒，"
+                f"结果: {best.result_url if best else '无可用地址'}")
+    return best, [probe.report(probe is best) for probe in ordered]
+
+# 网站首页形式的地址可能对应的API路径，按优先级排列
+CANDIDATE_API_PATHS = [
+    "/v1",              # OpenAI 标准路径
+    "/api/v1",          # 常见API路径格式
+    "/api",             # 简单API路径
+    "/openai/v1"        # 一些代理使用这种格式
+]
+
+def candidate_chat_endpoint(api_url):
+    """候选API地址对应的chat completions端点：路径已包含/v1时直接添加/chat/completions，否则添加/v1/chat/completions"""
+    if api_url.endswith('/v1'):
+        return f"{api_url}/chat/completions"
+    return f"{api_url}/v1/chat/completions"
+
+def build_normalize_probes(base_url):
+    """地址规范化的候选探测：依次为各候选路径的chat completions端点和models端点"""
+    probes = []
+    for index, api_path in enumerate(CANDIDATE_API_PATHS):
+        api_url = f"{base_url}{api_path}"
+        probes.append(ApiProbe(2 * index, "HEAD", candidate_chat_endpoint(api_url), api_url, check_endpoint_exists))
+        probes.append(ApiProbe(2 * index + 1, "GET", f"{api_url}/models", api_url, check_models_endpoint))
+    return probes
+
+def build_test_api_probes(base_url):
+    """
+    连接测试的候选探测：先是chat completions端点和标准models端点，
+    地址看起来像网站首页时再加上各候选路径的models端点
+    """
+    base_url = base_url.rstrip('/')
+    api_url = base_url if base_url.endswith('/v1') else f"{base_url}/v1"
+    probes = [
+        ApiProbe(0, "OPTIONS", f"{api_url}/chat/completions", api_url, check_endpoint_exists,
+                 message="找到可能的API端点: /v1/chat/completions"),
+        ApiProbe(1, "GET", f"{api_url}/models", base_url, check_models_listing)
+    ]
+    if urlparse(base_url).path in ("", "/"):
+        for index, api_path in enumerate(CANDIDATE_API_PATHS):
+            candidate_url = f"{base_url}{api_path}"
+            probes.append(ApiProbe(2 * index + 2, "GET", f"{candidate_url}/models", candidate_url, check_models_listing))
+            probes.append(ApiProbe(2 * index + 3, "GET", f"{candidate_url}/v1/models", candidate_url, check_models_listing))
+    return probes
+
+def _probe_api_url(base_url):
+    """
+    通过并发探测常见API路径来规范化基础URL
+    """
+    original_url = base_url
+    logger.info(f"规范化API URL: {base_url}")
+    
+    # 移除尾部斜杠
+    base_url = base_url.rstrip('/')
+    
+    # 如果URL已经以/v1结尾，则无需处理
+    if base_url.endswith('/v1'):
+        logger.info(f"URL已经以/v1结尾，保持不变: {base_url}")
+        return base_url
+    
+    # 如果URL看起来像网站首页（路径部分为空或仅为/），尝试添加可能的API路径
+    if urlparse(base_url).path in ("", "/"):
+        logger.info(f"API URL看起来像网站首页，并发探测以下可能的API路径: {CANDIDATE_API_PATHS}")
+        best, _ = run_probes(build_normalize_probes(base_url), headers={"Accept": "application/json"})
+        if best is not None:
+            logger.info(f"找到可能的API路径: {best.result_url}（{best.method} {best.url}: {best.reason}）")
+            return best.result_url
+    
+    # 如果没有找到更好的路径，返回原始URL
+    if original_url != base_url:
+        logger.info(f"使用规范化的URL: {base_url}")
+        return base_url
+    
+    logger.info(f"保持原始URL不变: {original_url}")
+    return original_url
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，按Prometheus文本格式输出。
+    每个指标的标签组合数不超过max_series，超出后新的组合统一计入标签值为other的序列
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, max_series):
+        self.max_series = max_series
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(name, "counter", documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = self._register(name, "histogram", documentation, labelnames)
+        metric["buckets"] = tuple(buckets)
+        return metric
+
+    def _register(self, name, kind, documentation, labelnames):
+        metric = {"name": name, "type": kind, "help": documentation, "labelnames": tuple(labelnames), "series": {}}
+        self._metrics[name] = metric
+        return metric
+
+    def collector(self, func):
+        """注册抓取时调用的函数，返回[(指标名, 类型, 说明, [(标签字典, 值)])]，用于导出已有的统计计数"""
+        self._collectors.append(func)
+        return func
+
+    def _series(self, metric, labels):
+        key = tuple(str(labels.get(name, "")) for name in metric["labelnames"])
+        series = metric["series"].get(key)
+        if series is None:
+            if len(metric["series"]) >= self.max_series:
+                key = tuple("other" for _ in metric["labelnames"])
+                series = metric["series"].get(key)
+            if series is None:
+                if metric["type"] == "histogram":
+                    series = {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0}
+                else:
+                    series = {"value": 0.0}
+                metric["series"][key] = series
+        return series
+
+    def inc(self, metric, amount=1, **labels):
+        with self._lock:
+            self._series(metric, labels)["value"] += amount
+
+    def observe(self, metric, value, **labels):
+        with self._lock:
+            series = self._series(metric, labels)
+            for index, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        """记录代码块的耗时（秒），出错时同样记录"""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.observe(metric, time.time() - start_time, **labels)
+
+    @staticmethod
+    def _format_labels(pairs):
+        if not pairs:
+            return ""
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{name}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _format_value(value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return repr(value) if isinstance(value, float) else str(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                # 文本格式0.0.4中计数器的指标族名称带_total后缀
+                family = metric["name"] + ("_total" if metric["type"] == "counter" else "")
+                lines.append(f"# HELP {family} {metric['help']}")
+                lines.append(f"# TYPE {family} {metric['type']}")
+                for key, series in metric["series"].items():
+                    pairs = list(zip(metric["labelnames"], key))
+                    if metric["type"] == "counter":
+                        lines.append(f"{family}{self._format_labels(pairs)} {self._format_value(series['value'])}")
+                        continue
+                    for bound, count in zip(metric["buckets"], series["buckets"]):
+                        lines.append(f"{metric['name']}_bucket{self._format_labels(pairs + [('le', bound)])} {count}")
+                    lines.append(f"{metric['name']}_bucket{self._format_labels(pairs + [('le', '+Inf')])} {series['count']}")
+                    lines.append(f"{metric['name']}_sum{self._format_labels(pairs)} {self._format_value(round(series['sum'], 6))}")
+                    lines.append(f"{metric['name']}_count{self._format_labels(pairs)} {series['count']}")
+        for func in self._collectors:
+            try:
+                collected = func()
+            except Exception as e:
+                logger.warning(f"采集指标失败: {str(e)}")
+                continue
+            for name, kind, documentation, samples in collected:
+                family = name + ("_total" if kind == "counter" else "")
+                lines.append(f"# HELP {family} {documentation}")
+                lines.append(f"# TYPE {family} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{family}{self._format_labels(list(labels.items()))} {self._format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(METRICS_MAX_SERIES)
+CHAT_STAGE_SECONDS = metrics.histogram(
+    "resume_chat_stage_seconds", "各处理阶段的耗时（秒）", ("stage", "upstream"))
+CHAT_TOTAL_SECONDS = metrics.histogram(
+    "resume_chat_request_seconds", "优化请求从收到到响应结束的总耗时（秒），result为hit、miss、bypass或error", ("mode", "result"))
+UPSTREAM_CALL_SECONDS = metrics.histogram(
+    "resume_upstream_call_seconds", "单次上游调用的耗时（秒），按调用方式区分", ("upstream", "model", "protocol", "outcome"))
+UPSTREAM_RESPONSES = metrics.counter(
+    "resume_upstream_responses", "上游调用结果，status为HTTP状态码或错误类型", ("upstream", "protocol", "status"))
+UPSTREAM_RETRIES = metrics.counter(
+    "resume_upstream_retries", "退避后重试上游的次数", ("upstream", "model"))
+PROTOCOL_FALLBACKS = metrics.counter(
+    "resume_protocol_fallbacks", "调用方式不可用而改用下一种方式的次数", ("upstream", "protocol"))
+UPSTREAM_FAILOVERS = metrics.counter(
+    "resume_upstream_failovers", "多上游池中切换到下一个上游的次数", ("upstream",))
+TOKENS_CONSUMED = metrics.counter(
+    "resume_tokens", "消耗的token数，上游未返回用量时为估算值", ("upstream", "model", "kind"))
+INPUT_TOKENS = metrics.counter(
+    "resume_input_tokens", "简历正文的估算token数，stage为original（压缩前）或compacted（压缩后）", ("stage",))
+
+def metric_upstream(settings_or_base):
+    """指标中的上游标签：多上游池中为上游名称，否则为API地址的主机名，避免标签值无限增长"""
+    if isinstance(settings_or_base, dict):
+        if settings_or_base.get("upstream_name"):
+            return settings_or_base["upstream_name"]
+        settings_or_base = settings_or_base.get("api_base") or ""
+    return urlparse(settings_or_base).netloc or "unknown"
+
+def upstream_status_label(error):
+    """上游调用失败时的状态标签：HTTP状态码，或timeout、connection等错误类型"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return str(status_code)
+    if isinstance(error, (requests.exceptions.Timeout, getattr(openai, "APITimeoutError", ()))):
+        return "timeout"
+    if isinstance(error, (requests.exceptions.ConnectionError, openai.APIConnectionError)):
+        return "connection"
+    if isinstance(error, UpstreamCallCancelled):
+        return "cancelled"
+    return "error"
+
+_profile_lock = threading.Lock()
+
+class RequestTrace:
+    """
+    单个请求各阶段的耗时记录，请求结束时生成Server-Timing响应头
+    """
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start_time = time.time()
+        self.spans = []
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def add(self, name, duration, desc=None):
+        with self._lock:
+            self.spans.append((name, duration, desc))
+
+    def server_timing(self):
+        with self._lock:
+            spans = self.spans[:SERVER_TIMING_MAX_ENTRIES]
+        entries = []
+        for name, duration, desc in spans:
+            entry = f"{name};dur={duration * 1000:.1f}"
+            if desc:
+                entry += ';desc="' + str(desc).replace('\\', '').replace('"', "'") + '"'
+            entries.append(entry)
+        entries.append(f"total;dur={(time.time() - self.start_time) * 1000:.1f}")
+        return ", ".join(entries)
+
+def record_span(name, duration, desc=None):
+    """把一个阶段的耗时记入当前请求（不在请求中时忽略）"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, duration, desc)
+
+@contextmanager
+def stage_timer(stage, upstream):
+    """记录一个处理阶段的耗时：写入阶段延迟直方图，同时记入当前请求的Server-Timing"""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start_time
+        metrics.observe(CHAT_STAGE_SECONDS, duration, stage=stage, upstream=upstream)
+        record_span(stage, duration, upstream)
+
+def run_in_context(func):
+    """让后台线程继承当前请求的上下文（请求ID和耗时记录）"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+def probe_request(method, url, **kwargs):
+    """发送一次API地址探测请求，并把耗时和状态码记入当前请求的Server-Timing"""
+    kwargs.setdefault("allow_redirects", method != "HEAD")
+    start_time = time.time()
+    status = "error"
+    try:
+        response = requests.request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        record_span("probe", time.time() - start_time, f"{method} {url} {status}")
+
+@app.before_request
+def start_request_trace():
+    """为每个请求分配请求ID（沿用客户端传入的X-Request-ID），按采样率开启性能分析"""
+    request_id = request.headers.get("X-Request-ID", "")
+    if not re.fullmatch(r"[A-Za-z0-9._-]{1,64}", request_id):
+        request_id = uuid.uuid4().hex[:16]
+    trace = RequestTrace(request_id)
+    _current_request_id.set(request_id)
+    _current_trace.set(trace)
+    if PROFILE_SAMPLE_RATE > 0 and request.path in PROFILE_PATHS and random.random() < PROFILE_SAMPLE_RATE:
+        # cProfile同一时间只能分析一个请求，正在分析时跳过本次采样
+        if _profile_lock.acquire(blocking=False):
+            trace.profile = cProfile.Profile()
+            trace.profile.enable()
+
+@app.after_request
+def add_trace_headers(response):
+    trace = _current_trace.get()
+    if trace is not None:
+        response.headers["X-Request-ID"] = trace.request_id
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    """请求结束（流式响应在输出完毕后）时保存性能分析结果"""
+    trace = _current_trace.get()
+    if trace is not None and trace.profile is not None:
+        profile, trace.profile = trace.profile, None
+        try:
+            profile.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            endpoint = request.path.strip('/').replace('/', '_') or "index"
+            path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{trace.request_id}.prof")
+            profile.dump_stats(path)
+            logger.info(f"已保存性能分析结果: {path}，耗时{time.time() - trace.start_time:.2f}秒")
+        except OSError as e:
+            logger.warning(f"保存性能分析结果失败: {str(e)}")
+        finally:
+            _profile_lock.release()
+    _current_trace.set(None)
+    _current_request_id.set("-")
+
+class AdmissionRejected(Exception):
+    """准入队列已满、排队超过时限或已过客户端截止时间时抛出"""
+    status_code = 503
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class AdmissionController:
+    """
+    耗时请求的准入控制：同时处理的请求数达到上限后按到达顺序排队，名额释放时直接交给队首；
+    队列已满、排队超过时限或已过客户端截止时间的请求直接拒绝，避免为已经放弃等待的客户端调用上游
+    """
+    def __init__(self, max_active, max_queue, max_wait, alpha=0.2):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self.active = 0
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "timeout": 0, "deadline": 0}
+        self.service_time = None  # 请求占用名额时长的滑动平均（秒），用于估算Retry-After
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def estimate_wait(self, queued, slots):
+        """按平均处理时长估算排在queued个请求之后、由slots个名额处理时需要等待的秒数"""
+        return max(1, math.ceil((self.service_time or 1.0) * (queued + 1) / max(slots, 1)))
+
+    def acquire(self, deadline=None):
+        """
+        获取一个处理名额，返回只生效一次的释放函数；无法在时限内获得时抛出AdmissionRejected
+        deadline为客户端的截止时间（时间戳），排队等待不会超过它
+        """
+        if self.max_active <= 0:
+            return lambda: None
+        start_time = time.time()
+        wait_until = start_time + self.max_wait
+        if deadline is not None:
+            wait_until = min(wait_until, deadline)
+        with self._lock:
+            if self.active < self.max_active and not self._waiters:
+                self.active += 1
+                self.admitted += 1
+                return self._release_once(start_time)
+            reason = None
+            if deadline is not None and deadline <= start_time:
+                reason = "deadline"
+            elif len(self._waiters) >= self.max_queue:
+                reason = "queue_full"
+            if reason is not None:
+                self.rejected[reason] += 1
+                raise AdmissionRejected("服务繁忙，请稍后重试", self.estimate_wait(len(self._waiters), self.max_active), reason)
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        waiter.wait(max(0.0, wait_until - time.time()))
+        with self._lock:
+            # 超时与名额转交可能同时发生，以是否已被转交为准
+            if not waiter.is_set():
+                self._waiters.remove(waiter)
+                reason = "deadline" if deadline is not None and deadline <= start_time + self.max_wait else "timeout"
+                self.rejected[reason] += 1
+                raise AdmissionRejected("服务繁忙，排队超时，请稍后重试",
+                                        self.estimate_wait(len(self._waiters), self.max_active), reason)
+            self.admitted += 1
+        return self._release_once(time.time())
+
+    def _release_once(self, acquired_at):
+        released = threading.Event()
+
+        def release():
+            if released.is_set():
+                return
+            released.set()
+            self._release(time.time() - acquired_at)
+        return release
+
+    def _release(self, duration):
+        with self._lock:
+            if self.service_time is None:
+                self.service_time = duration
+            else:
+                self.service_time = self.alpha * duration + (1 - self.alpha) * self.service_time
+            if self._waiters:
+                # 名额直接转交给队首，active不变，后到的请求无法插队
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "queued": len(self._waiters),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "serviceTime": self.service_time
+            }
+
+admission = AdmissionController(ADMISSION_MAX_ACTIVE, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "resume_admission_wait_seconds", "耗时请求获得处理名额前的排队时间（秒）", ("endpoint",))
+ADMISSION_REJECTIONS = metrics.counter(
+    "resume_admission_rejections", "准入控制拒绝的请求数，reason为queue_full、timeout或deadline", ("endpoint", "reason"))
+
+def request_deadline():
+    """客户端通过X-Request-Timeout（秒）声明的截止时间，从收到请求时算起；未声明时返回None"""
+    try:
+        timeout = float(request.headers.get("X-Request-Timeout", ""))
+    except ValueError:
+        return None
+    if not 0 < timeout < float("inf"):
+        return None
+    trace = _current_trace.get()
+    return (trace.start_time if trace is not None else time.time()) + timeout
+
+def busy_response(message, retry_after):
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 503
+
+@app.before_request
+def admit_request():
+    """
+    耗时接口先获取处理名额并受准入队列限制；配置查询、任务状态、静态页面等其它请求不排队，始终优先处理
+    """
+    if request.endpoint not in ADMISSION_ENDPOINTS:
+        return None
+    deadline = request_deadline()
+    g.request_deadline = deadline
+    start_time = time.time()
+    try:
+        add_request_cleanup(admission.acquire(deadline))
+    except AdmissionRejected as e:
+        logger.warning(f"准入控制拒绝请求{request.path}（{e.reason}），Retry-After={e.retry_after}秒")
+        metrics.inc(ADMISSION_REJECTIONS, endpoint=request.endpoint, reason=e.reason)
+        return busy_response(str(e), e.retry_after)
+    wait = time.time() - start_time
+    metrics.observe(ADMISSION_WAIT_SECONDS, wait, endpoint=request.endpoint)
+    record_span("admission", wait)
+
+def add_request_cleanup(callback):
+    """登记请求结束时执行的清理（归还处理名额、停止断开检查等）"""
+    g.setdefault("request_cleanup", []).append(callback)
+
+def run_request_cleanup(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.warning(f"请求结束时清理出错: {str(e)}")
+
+@app.after_request
+def defer_request_cleanup(response):
+    """普通响应在视图返回后立即清理；流式响应要等输出结束、连接关闭后才清理"""
+    callbacks = g.pop("request_cleanup", [])
+    if response.is_streamed:
+        for callback in callbacks:
+            response.call_on_close(callback)
+    else:
+        run_request_cleanup(callbacks)
+    return response
+
+@app.teardown_request
+def finish_request_cleanup(error=None):
+    """处理出错、没有生成响应时在这里清理"""
+    run_request_cleanup(g.pop("request_cleanup", []))
+
+class CancelScope(threading.Event):
+    """
+    可取消的范围：取消时依次执行登记的回调（例如关闭进行中的上游连接），子范围随父范围一起取消
+    reason为取消原因：disconnect（客户端断开）、deadline（超过截止时间）或hedge（对冲的另一方胜出）
+    """
+    def __init__(self, parent=None):
+        super().__init__()
+        self.reason = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        if parent is not None:
+            parent.on_cancel(lambda: self.cancel(parent.reason))
+
+    def cancel(self, reason):
+        with self._callbacks_lock:
+            if self.is_set():
+                return
+            self.reason = reason
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"执行取消回调时出错: {str(e)}")
+
+    def set(self):
+        self.cancel("cancelled")
+
+    def on_cancel(self, callback):
+        """登记取消时执行的回调（已取消时立即执行），返回注销函数"""
+        with self._callbacks_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._callbacks_lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+def client_disconnected(sock):
+    """客户端是否已关闭连接：套接字可读却读不到数据（收到FIN）或连接已被重置"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ConnectionError:
+        return True
+    except (OSError, ValueError):
+        # 套接字已关闭、不支持MSG_PEEK（例如TLS）或文件描述符超出select范围时无法判断
+        return False
+
+class RequestWatcher:
+    """
+    后台线程每隔interval秒检查进行中的优化请求，客户端已断开或超过截止时间时取消该请求的范围
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, scope, sock, deadline, endpoint):
+        """登记一个请求，返回注销函数"""
+        if self.interval <= 0 or (sock is None and deadline is None):
+            return lambda: None
+        # 在请求的上下文中执行取消，回调产生的日志带有该请求的请求ID
+        cancel = run_in_context(scope.cancel)
+        with self._lock:
+            self._entries[id(scope)] = (scope, cancel, sock, deadline, endpoint)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-watcher", daemon=True)
+                self._thread.start()
+        return lambda: self._unregister(scope)
+
+    def _unregister(self, scope):
+        with self._lock:
+            self._entries.pop(id(scope), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                entries = list(self._entries.values())
+            for scope, cancel, sock, deadline, endpoint in entries:
+                if scope.is_set():
+                    continue
+                if deadline is not None and time.time() >= deadline:
+                    reason = "deadline"
+                elif sock is not None and client_disconnected(sock):
+                    reason = "disconnect"
+                else:
+                    continue
+                self._unregister(scope)
+                metrics.inc(REQUEST_CANCELLATIONS, endpoint=endpoint, reason=reason)
+                cancel(reason)
+
+request_watcher = RequestWatcher(CANCEL_CHECK_INTERVAL)
+REQUEST_CANCELLATIONS = metrics.counter(
+    "resume_request_cancellations", "因客户端断开（disconnect）或超过截止时间（deadline）而取消的请求数", ("endpoint", "reason"))
+UPSTREAM_CANCELLATIONS = metrics.counter(
+    "resume_upstream_cancellations", "被取消的上游调用：stage为inflight（中止进行中的调用）或retry（跳过剩余的重试）",
+    ("upstream", "reason", "stage"))
+
+@app.before_request
+def start_request_cancellation():
+    """为优化请求建立取消范围：客户端断开或超过截止时间时中止进行中的上游调用，并跳过剩余的重试和上游切换"""
+    if request.endpoint not in CANCELLABLE_ENDPOINTS:
+        return None
+    scope = CancelScope()
+    g.cancel_scope = scope
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    add_request_cleanup(request_watcher.register(scope, sock, g.get("request_deadline"), request.endpoint))
+
+def cancel_request(reason):
+    """取消当前请求（流式输出时发现客户端已断开）"""
+    scope = g.get("cancel_scope")
+    if scope is not None and not scope.is_set():
+        metrics.inc(REQUEST_CANCELLATIONS, endpoint=request.endpoint, reason=reason)
+        scope.cancel(reason)
+
+def cancelled_response(reason):
+    """请求取消后的响应：超过截止时间返回504；客户端已断开时直接关闭连接，不再发送响应"""
+    if reason == "deadline":
+        return jsonify({"error": "请求超过截止时间，已取消"}), 504
+    sock = request.environ.get("gunicorn.socket") or request.environ.get("werkzeug.socket")
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    # 连接已关闭，服务器写出这个响应时会失败并被忽略
+    return Response(status=204)
+
+def apply_request_scope(settings):
+    """把当前请求的截止时间和取消范围带入上游调用参数"""
+    if g.get("request_deadline"):
+        settings["deadline"] = g.request_deadline
+    if g.get("cancel_scope") is not None:
+        settings["cancel_event"] = g.cancel_scope
+    return settings
+
+class UpstreamClient:
+    """
+    同一(api_key, base_url)共享的上游客户端，SDK调用与HTTP备选调用都复用其中的连接
+    """
+    def __init__(self, api_key, base_url):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.in_use = 0
+        self.evicted = False
+        self.new_connections = {"sdk": 0, "http": 0}
+        self.requests_sent = {"sdk": 0, "http": 0}
+        self._stats_lock = threading.Lock()
+        self._http_retired = {"connections": 0, "requests": 0}
+
+        # requests会话，用于原始HTTP和completions备选路径
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=CLIENT_POOL_CONNECTIONS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        self.session.hooks["response"].append(self._observe_http_response)
+
+        # OpenAI SDK客户端 (openai >= 1.0.0)，使用带保活的httpx连接池
+        try:
+            http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=CLIENT_POOL_CONNECTIONS,
+                    max_keepalive_connections=CLIENT_POOL_CONNECTIONS,
+                    keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY
+                ),
+                event_hooks={"request": [self._attach_trace], "response": [self._observe_sdk_response]}
+            )
+            self.openai_client = openai.OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=API_TIMEOUT,  # 设置超时时间
+                max_retries=0,  # 重试统一由call_upstream_with_retries负责
+                http_client=http_client
+            )
+            self.http_client = http_client
+        except (AttributeError, TypeError) as e:
+            # 对于旧版本, 可能需要不同的设置方式
+            logger.warning(f"新版客户端创建失败: {str(e)}，尝试兼容模式")
+            self.openai_client = None
+            self.http_client = None
+
+    def _observe_sdk_response(self, response):
+        """SDK响应的限流头交给限流器校准限额"""
+        rate_limiter.observe(self.base_url, self.api_key, response.status_code, response.headers)
+
+    def _observe_http_response(self, response, *args, **kwargs):
+        """HTTP备选路径响应的限流头交给限流器校准限额"""
+        rate_limiter.observe(self.base_url, self.api_key, response.status_code, response.headers)
+
+    def _attach_trace(self, request):
+        """为每个SDK请求挂载连接追踪回调，用于统计新建连接数"""
+        request.extensions["trace"] = self._trace
+        with self._stats_lock:
+            self.requests_sent["sdk"] += 1
+
+    def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self._stats_lock:
+                self.new_connections["sdk"] += 1
+
+    def _http_pool_stats(self):
+        """汇总requests会话底层urllib3连接池的新建连接数和请求数"""
+        connections = self._http_retired["connections"]
+        sent = self._http_retired["requests"]
+        for adapter in set(self.session.adapters.values()):
+            try:
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    connections += pool.num_connections
+                    sent += pool.num_requests
+            except Exception:
+                continue
+        return connections, sent
+
+    def stats(self):
+        http_connections, http_requests = self._http_pool_stats()
+        with self._stats_lock:
+            return {
+                "sdk": {
+                    "requests": self.requests_sent["sdk"],
+                    "newConnections": self.new_connections["sdk"],
+                    "reusedConnections": max(self.requests_sent["sdk"] - self.new_connections["sdk"], 0)
+                },
+                "http": {
+                    "requests": http_requests,
+                    "newConnections": http_connections,
+                    "reusedConnections": max(http_requests - http_connections, 0)
+                }
+            }
+
+    def close(self):
+        try:
+            self.session.close()
+            if self.http_client is not None:
+                self.http_client.close()
+        except Exception as e:
+            logger.warning(f"关闭上游客户端失败: {str(e)}")
+
+
+class UpstreamClientPool:
+    """
+    按(api_key, base_url)缓存上游客户端的LRU池，超出容量时淘汰最久未使用且空闲的客户端
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._retired_stats = {"sdk": {"requests": 0, "newConnections": 0}, "http": {"requests": 0, "newConnections": 0}}
+
+    def _retire(self, client):
+        """记录被淘汰客户端的统计数据，并在其空闲时关闭"""
+        client.evicted = True
+        for kind, values in client.stats().items():
+            self._retired_stats[kind]["requests"] += values["requests"]
+            self._retired_stats[kind]["newConnections"] += values["newConnections"]
+        self.evictions += 1
+        if client.in_use == 0:
+            client.close()
+
+    @contextmanager
+    def acquire(self, api_key, base_url):
+        key = (api_key, base_url.rstrip('/'))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                client = UpstreamClient(api_key, base_url)
+                self._clients[key] = client
+                logger.info(f"创建新的上游客户端: {base_url}")
+                # 淘汰最久未使用且当前空闲的客户端
+                for old_key in list(self._clients.keys()):
+                    if len(self._clients) <= self.max_size:
+                        break
+                    old_client = self._clients[old_key]
+                    if old_key != key and old_client.in_use == 0:
+                        del self._clients[old_key]
+                        self._retire(old_client)
+            client.in_use += 1
+        try:
+            yield client
+        finally:
+            with self._lock:
+                client.in_use -= 1
+                if client.evicted and client.in_use == 0:
+                    client.close()
+
+    def invalidate(self, base_url=None, api_key=None):
+        """移除指定基础URL和/或API密钥（或全部）的客户端"""
+        with self._lock:
+            for key in list(self._clients.keys()):
+                if (base_url is None or key[1] == base_url.rstrip('/')) and (api_key is None or key[0] == api_key):
+                    self._retire(self._clients.pop(key))
+
+    def stats(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            totals = {kind: dict(values) for kind, values in self._retired_stats.items()}
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        for client in clients:
+            for kind, values in client.stats().items():
+                totals[kind]["requests"] += values["requests"]
+                totals[kind]["newConnections"] += values["newConnections"]
+        for values in totals.values():
+            values["reusedConnections"] = max(values["requests"] - values["newConnections"], 0)
+        return {
+            "clients": len(clients),
+            "maxClients": self.max_size,
+            "clientHits": hits,
+            "clientMisses": misses,
+            "clientEvictions": evictions,
+            "connections": totals
+        }
+
+client_pool = UpstreamClientPool(CLIENT_POOL_SIZE)
+
+class UpstreamHTTPError(Exception):
+    """上游以非200状态码响应HTTP请求时抛出"""
+    def __init__(self, message, status_code=None, headers=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class UpstreamEmptyAnswer(ValueError):
+    """上游返回200但没有产出任何内容（例如SSE流中没有分片）时抛出，按该调用方式不可用处理，换下一种方式"""
+
+def is_upstream_failure(error):
+    """判断错误是否说明上游不可用（连接失败、超时或5xx），用于熔断计数"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(error, UpstreamHTTPError) and error.status_code is not None:
+        return error.status_code >= 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    单个上游的熔断器：连续失败达到阈值后打开，等待一段时间后进入半开状态放行试探请求
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            return self.state != self.OPEN
+
+    def retry_after(self):
+        """熔断打开时距离下次允许试探的秒数"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(int(self.reset_timeout - (time.time() - self.opened_at)) + 1, 1)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"上游连续失败{self.consecutive_failures}次，熔断器打开")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def mark_recovering(self):
+        """后台检查发现上游恢复时，提前进入半开状态"""
+        with self._lock:
+            if self.state == self.OPEN:
+                self.state = self.HALF_OPEN
+
+
+class UpstreamHealthMonitor:
+    """
+    在请求路径之外跟踪上游健康状态：后台线程定期探测，真实调用结果驱动熔断器
+    """
+    def __init__(self, interval, idle_expiry):
+        self.interval = interval
+        self.idle_expiry = idle_expiry
+        self._upstreams = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._session = requests.Session()
+
+    def _entry(self, base_url):
+        key = base_url.rstrip('/')
+        entry = self._upstreams.get(key)
+        if entry is None:
+            entry = {
+                "baseUrl": key,
+                "apiKey": None,
+                "breaker": CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+                "healthy": None,
+                "authFailed": False,
+                "lastStatus": None,
+                "lastError": None,
+                "lastCheck": None,
+                "lastUsed": time.time()
+            }
+            self._upstreams[key] = entry
+        return entry
+
+    def register(self, base_url, api_key):
+        """登记正在使用的上游，供后台线程定期检查"""
+        with self._lock:
+            entry = self._entry(base_url)
+            if entry["apiKey"] != api_key:
+                entry["authFailed"] = False
+            entry["apiKey"] = api_key
+            entry["lastUsed"] = time.time()
+            self._ensure_started()
+
+    def _ensure_started(self):
+        # 延迟到首次使用时启动线程，保证gunicorn fork出的每个worker都有自己的检查线程
+        if self.interval > 0 and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name="upstream-health-checker", daemon=True)
+            self._thread.start()
+
+    def allow_request(self, base_url):
+        with self._lock:
+            breaker = self._entry(base_url)["breaker"]
+        return breaker.allow_request()
+
+    def retry_after(self, base_url):
+        with self._lock:
+            breaker = self._entry(base_url)["breaker"]
+        return breaker.retry_after()
+
+    def auth_failed(self, base_url, api_key):
+        """后台检查是否已确认该密钥认证失败"""
+        with self._lock:
+            entry = self._upstreams.get(base_url.rstrip('/'))
+            return bool(entry and entry["authFailed"] and entry["apiKey"] == api_key)
+
+    def record_success(self, base_url):
+        with self._lock:
+            entry = self._entry(base_url)
+            entry["healthy"] = True
+            entry["authFailed"] = False
+            entry["lastError"] = None
+            breaker = entry["breaker"]
+        breaker.record_success()
+
+    def record_failure(self, base_url, error):
+        if not is_upstream_failure(error):
+            return
+        with self._lock:
+            entry = self._entry(base_url)
+            entry["lastError"] = str(error)[:200]
+            breaker = entry["breaker"]
+        breaker.record_failure()
+        if breaker.state == CircuitBreaker.OPEN:
+            with self._lock:
+                entry["healthy"] = False
+
+    def check(self, base_url):
+        """探测一次上游的models接口并更新健康状态"""
+        with self._lock:
+            entry = self._entry(base_url)
+            api_key = entry["apiKey"]
+        base = entry["baseUrl"]
+        test_urls = [f"{base}/models"] if base.endswith('/v1') else [f"{base}/v1/models", f"{base}/models"]
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        status, error = None, None
+        try:
+            with stage_timer(stage="health_probe", upstream=metric_upstream(base)):
+                for test_url in test_urls:
+                    response = self._session.get(test_url, headers=headers, timeout=10)
+                    status = response.status_code
+                    if status != 404:
+                        break
+        except requests.exceptions.RequestException as e:
+            error = e
+
+        healthy = error is None and status is not None and status < 500
+        with self._lock:
+            entry["lastCheck"] = time.time()
+            entry["lastStatus"] = status
+            entry["healthy"] = healthy
+            entry["authFailed"] = status == 401
+            if error is not None:
+                entry["lastError"] = str(error)[:200]
+            breaker = entry["breaker"]
+        if healthy:
+            breaker.mark_recovering()
+        else:
+            logger.warning(f"后台健康检查发现上游异常: {base}, 状态码: {status}, 错误: {error}")
+            breaker.record_failure()
+        return healthy
+
+    def _run(self):
+        logger.info(f"上游健康检查线程已启动，间隔{self.interval}秒")
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self._lock:
+                for key in [k for k, e in self._upstreams.items() if now - e["lastUsed"] > self.idle_expiry]:
+                    del self._upstreams[key]
+                base_urls = list(self._upstreams.keys())
+            for base_url in base_urls:
+                try:
+                    self.check(base_url)
+                except Exception as e:
+                    logger.warning(f"健康检查出错: {base_url}, 错误: {str(e)}")
+
+    def snapshot(self):
+        with self._lock:
+            return [{
+                "baseUrl": e["baseUrl"],
+                "healthy": e["healthy"],
+                "authFailed": e["authFailed"],
+                "circuit": e["breaker"].state,
+                "consecutiveFailures": e["breaker"].consecutive_failures,
+                "lastStatus": e["lastStatus"],
+                "lastError": e["lastError"],
+                "lastCheck": e["lastCheck"]
+            } for e in self._upstreams.values()]
+
+upstream_health = UpstreamHealthMonitor(HEALTH_CHECK_INTERVAL, HEALTH_CHECK_IDLE_EXPIRY)
+
+class UpstreamDeadlineError(Exception):
+    """请求超过总时限仍未得到答案时抛出"""
+
+
+class UpstreamCallCancelled(Exception):
+    """上游调用被取消（客户端断开、超过截止时间或对冲请求的另一方已经胜出）时抛出"""
+    def __init__(self, message, reason=None):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ProtocolMemory:
+    """
+    记住每个上游最近调用成功的方式（sdk、http_chat或completions），后续请求直接从该方式开始
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # 基础URL -> (调用方式, 过期时间)
+        self._lock = threading.Lock()
+
+    def order(self, api_base):
+        """返回本次请求依次尝试的调用方式，记住的方式排在最前"""
+        with self._lock:
+            entry = self._entries.get(api_base)
+        if entry is None or entry[1] <= time.time():
+            return list(CHAT_PROTOCOLS)
+        return [entry[0]] + [protocol for protocol in CHAT_PROTOCOLS if protocol != entry[0]]
+
+    def remember(self, api_base, protocol):
+        with self._lock:
+            previous = self._entries.get(api_base)
+            self._entries[api_base] = (protocol, time.time() + self.ttl)
+        if previous is None or previous[0] != protocol:
+            logger.info(f"上游{api_base}记住调用方式: {protocol}")
+
+    def forget(self, api_base, protocol):
+        """记住的方式失效（例如接口被移除）时清除"""
+        with self._lock:
+            entry = self._entries.get(api_base)
+            if entry is not None and entry[0] == protocol:
+                del self._entries[api_base]
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {base: protocol for base, (protocol, expires_at) in self._entries.items() if expires_at > now}
+
+protocol_memory = ProtocolMemory(PROTOCOL_MEMORY_TTL)
+
+class UpstreamPool:
+    """
+    多上游池：每个上游有自己的地址、密钥、模型映射和权重，
+    按实时延迟、错误率和进行中的请求数选择上游，出错时由run_with_failover切换到下一个
+    """
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self._upstreams = []
+        self._stats = {}  # 上游名称 -> 延迟/错误率等实时统计
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def parse(upstreams):
+        """校验上游列表并补全默认值，配置错误时抛出ValueError"""
+        parsed = []
+        names = set()
+        for index, item in enumerate(upstreams or []):
+            if not isinstance(item, dict):
+                raise ValueError(f"第{index + 1}个上游配置必须是对象")
+            base_url = (item.get("baseUrl") or "").strip()
+            if not base_url.startswith(('http://', 'https://')):
+                raise ValueError(f"第{index + 1}个上游的API地址格式错误，必须以http://或https://开头")
+            if not item.get("apiKey"):
+                raise ValueError(f"第{index + 1}个上游没有设置API密钥")
+            name = str(item.get("name") or urlparse(base_url).netloc)
+            if name in names:
+                name = f"{name}#{index + 1}"
+            names.add(name)
+            try:
+                weight = float(item.get("weight", 1))
+            except (TypeError, ValueError):
+                raise ValueError(f"上游{name}的权重必须是数字")
+            if weight <= 0:
+                raise ValueError(f"上游{name}的权重必须大于0")
+            models = item.get("models") or {}
+            if not isinstance(models, dict):
+                raise ValueError(f"上游{name}的models必须是对象")
+            parsed.append({
+                "name": name,
+                "baseUrl": base_url,
+                "apiKey": item["apiKey"],
+                "model": item.get("model"),
+                "models": models,
+                "weight": weight
+            })
+        return parsed
+
+    def configure(self, upstreams):
+        """校验并替换上游列表，配置错误时抛出ValueError"""
+        parsed = self.parse(upstreams)
+        with self._lock:
+            self._upstreams = parsed
+            self._stats = {
+                upstream["name"]: self._stats.get(upstream["name"]) or
+                {"requests": 0, "failures": 0, "latency": None, "errorRate": 0.0, "inflight": 0}
+                for upstream in parsed
+            }
+        logger.info(f"多上游池已配置{len(parsed)}个上游: {[upstream['name'] for upstream in parsed]}")
+
+    def size(self):
+        with self._lock:
+            return len(self._upstreams)
+
+    def has_key(self, api_key):
+        """请求携带的密钥（或其脱敏形式）属于池中某个上游时，视为使用服务端配置"""
+        with self._lock:
+            return any(api_key in (upstream["apiKey"], mask_api_key(upstream["apiKey"])) for upstream in self._upstreams)
+
+    def _score(self, upstream, default_latency):
+        stats = self._stats[upstream["name"]]
+        latency = stats["latency"] if stats["latency"] is not None else default_latency
+        error_rate = min(stats["errorRate"], 0.9)
+        return upstream["weight"] * (1 - error_rate) ** 2 / (max(latency, 0.05) * (1 + stats["inflight"]))
+
+    @staticmethod
+    def _map_model(upstream, model, explicit):
+        """模型映射优先；请求未指定模型时使用该上游的默认模型"""
+        if model in upstream["models"]:
+            return upstream["models"][model]
+        if explicit or not upstream["model"]:
+            return model
+        return upstream["model"]
+
+    def candidates(self, model, explicit=True):
+        """
+        返回本次请求依次尝试的上游（已解析地址和映射后的模型），跳过熔断或密钥失效的上游；
+        首选上游按得分加权随机选出，其余按得分从高到低排列
+        """
+        with self._lock:
+            upstreams = list(self._upstreams)
+        available = []
+        for upstream in upstreams:
+            api_base = normalize_api_url(upstream["baseUrl"])
+            upstream_health.register(api_base, upstream["apiKey"])
+            if upstream_health.auth_failed(api_base, upstream["apiKey"]) or not upstream_health.allow_request(api_base):
+                continue
+            available.append(dict(upstream, baseUrl=api_base, model=self._map_model(upstream, model, explicit)))
+        if not available:
+            return []
+        with self._lock:
+            measured = [s["latency"] for s in self._stats.values() if s["latency"] is not None]
+            default_latency = sum(measured) / len(measured) if measured else 1.0
+            scores = [self._score(upstream, default_latency) for upstream in available]
+        first = random.choices(range(len(available)), weights=scores)[0]
+        rest = sorted((i for i in range(len(available)) if i != first), key=lambda i: scores[i], reverse=True)
+        return [available[first]] + [available[i] for i in rest]
+
+    def retry_after(self):
+        """所有上游都不可用时，距离最早恢复试探的秒数"""
+        with self._lock:
+            upstreams = list(self._upstreams)
+        waits = [upstream_health.retry_after(normalize_api_url(upstream["baseUrl"])) for upstream in upstreams]
+        return min(waits) if waits else 1
+
+    @contextmanager
+    def track(self, name):
+        """记录一次对该上游的调用，结束时更新延迟和错误率"""
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is not None:
+                stats["inflight"] += 1
+        start_time = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            elapsed = time.time() - start_time
+            with self._lock:
+                stats = self._stats.get(name)
+                if stats is not None:
+                    stats["inflight"] -= 1
+                    stats["requests"] += 1
+                    if not ok:
+                        stats["failures"] += 1
+                    elif stats["latency"] is None:
+                        stats["latency"] = elapsed
+                    else:
+                        stats["latency"] += self.alpha * (elapsed - stats["latency"])
+                    stats["errorRate"] += self.alpha * ((0.0 if ok else 1.0) - stats["errorRate"])
+
+    def snapshot(self):
+        with self._lock:
+            result = []
+            for upstream in self._upstreams:
+                stats = self._stats[upstream["name"]]
+                result.append({
+                    "name": upstream["name"],
+                    "baseUrl": upstream["baseUrl"],
+                    "model": upstream["model"],
+                    "models": upstream["models"],
+                    "weight": upstream["weight"],
+                    "requests": stats["requests"],
+                    "failures": stats["failures"],
+                    "inflight": stats["inflight"],
+                    "latency": round(stats["latency"], 3) if stats["latency"] is not None else None,
+                    "errorRate": round(stats["errorRate"], 3)
+                })
+            return result
+
+def load_upstreams_from_env():
+    """从UPSTREAMS环境变量（JSON数组）读取多上游配置"""
+    if not UPSTREAMS:
+        return []
+    try:
+        upstreams = json.loads(UPSTREAMS)
+    except json.JSONDecodeError as e:
+        logger.error(f"UPSTREAMS不是合法的JSON，忽略多上游配置: {str(e)}")
+        return []
+    if not isinstance(upstreams, list):
+        logger.error("UPSTREAMS必须是JSON数组，忽略多上游配置")
+        return []
+    return upstreams
+
+upstream_pool = UpstreamPool(UPSTREAM_EWMA_ALPHA)
+try:
+    upstream_pool.configure(load_upstreams_from_env())
+except ValueError as e:
+    logger.error(f"多上游配置错误，忽略: {str(e)}")
+
+def merge_config_document(document, changes):
+    """把changes合并进配置文档：config中的字段逐个覆盖，upstreams整体替换"""
+    merged = {"config": dict(document.get("config") or {})}
+    merged["config"].update(changes.get("config") or {})
+    upstreams = changes.get("upstreams", document.get("upstreams"))
+    if upstreams is not None:
+        merged["upstreams"] = upstreams
+    return merged
+
+class ConfigStore:
+    """
+    进程内配置存储（默认）：只在当前进程中生效，多个worker时各自独立
+    配置文档为{"config": {...}, "upstreams": [...]}，每次保存版本号加1
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._document = {}
+
+    def version(self):
+        """返回当前版本号，调用方据此判断是否需要重新读取配置"""
+        return self._version
+
+    def load(self):
+        """返回(版本号, 配置文档)"""
+        version = self.version()
+        with self._lock:
+            return max(version, self._version), copy.deepcopy(self._document)
+
+    def update(self, changes):
+        """把changes合并进配置文档并原子地写入，返回(新版本号, 新配置文档)"""
+        with self._lock:
+            self._version += 1
+            self._document = merge_config_document(self._document, changes)
+            return self._version, copy.deepcopy(self._document)
+
+class FileConfigStore(ConfigStore):
+    """
+    JSON文件配置存储：保存时加文件锁串行化读-改-写，写临时文件后原子替换；
+    读者只比较文件的修改时间、大小和inode，文件变化时才重新读取
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._signature = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0, {}
+        return int(data.get("version", 0)), data.get("document") or {}
+
+    def version(self):
+        signature = self._stat()
+        with self._lock:
+            if signature != self._signature:
+                self._version, self._document = self._read()
+                self._signature = signature
+            return self._version
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update(self, changes):
+        with self._lock, self._file_lock():
+            version, document = self._read()
+            version += 1
+            document = merge_config_document(document, changes)
+            # 临时文件与目标文件在同一目录，os.replace保证读者看到的要么是旧文件要么是完整的新文件
+            fd, temp_path = tempfile.mkstemp(prefix=".config-", dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"version": version, "updatedAt": time.time(), "document": document}, f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
+            self._version, self._document, self._signature = version, document, self._stat()
+            return version, copy.deepcopy(document)
+
+class SqliteConfigStore(ConfigStore):
+    """
+    SQLite配置存储：保存在事务中完成；读者通过PRAGMA data_version判断库是否被其它连接修改过，
+    未修改时不查询配置表。每个进程只持有一个连接，由锁串行化访问
+    （gevent下每个greenlet的threading.local各不相同，按线程建连接会让data_version的比较永远不命中）
+    """
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = db_path
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self._data_version = None
+
+    def _db(self):
+        # 首次使用时才创建文件，且只允许所有者读写（库中包含API密钥）；调用方须持有_db_lock
+        if self._conn is None:
+            os.close(os.open(self.db_path, os.O_RDWR | os.O_CREAT, 0o600))
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS config_store ("
+                "id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL, "
+                "document TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn = db
+        return self._conn
+
+    def version(self):
+        with self._db_lock:
+            db = self._db()
+            data_version = db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return self._version
+            row = db.execute("SELECT version, document FROM config_store WHERE id = 1").fetchone()
+            self._data_version = data_version
+        with self._lock:
+            if row and row[0] > self._version:
+                self._version, self._document = row[0], json.loads(row[1])
+            return self._version
+
+    def update(self, changes):
+        with self._db_lock, self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT version, document FROM config_store WHERE id = 1").fetchone()
+                version, document = (row[0], json.loads(row[1])) if row else (0, {})
+                version += 1
+                document = merge_config_document(document, changes)
+                db.execute(
+                    "INSERT OR REPLACE INTO config_store (id, version, document, updated_at) VALUES (1, ?, ?, ?)",
+                    (version, json.dumps(document, ensure_ascii=False), time.time())
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self._version, self._document = version, document
+            return version, copy.deepcopy(document)
+
+def make_config_store():
+    """按CONFIG_STORE创建配置存储"""
+    if CONFIG_STORE == "file":
+        return FileConfigStore(CONFIG_STORE_PATH or "config.json")
+    if CONFIG_STORE == "sqlite":
+        return SqliteConfigStore(CONFIG_STORE_PATH or "config.db")
+    if CONFIG_STORE != "memory":
+        logger.error(f"未知的CONFIG_STORE: {CONFIG_STORE}，使用进程内配置")
+    return ConfigStore()
+
+# 环境变量中的初始配置，共享存储中没有保存的字段使用这里的值
+ENV_CONFIG = dict(current_config)
+_config_state = {"version": 0, "checked_at": 0.0, "upstreams": None}
+_config_state_lock = threading.RLock()
+
+def apply_config_document(version, document):
+    """把共享存储中的配置应用到本进程，并使依赖旧配置的API地址解析缓存、上游客户端和多上游池失效"""
+    with _config_state_lock:
+        previous = dict(current_config)
+        current_config.update(dict(ENV_CONFIG, **(document.get("config") or {})))
+        if current_config['baseUrl'] != previous['baseUrl']:
+            invalidate_api_url_cache(previous['baseUrl'], current_config['baseUrl'])
+        # 客户端按(API密钥, 基础URL)缓存，地址、密钥或上游列表任一变化都清空整个客户端池，
+        # 正在使用的客户端在请求结束后关闭
+        stale_clients = (current_config['baseUrl'], current_config['api_key']) != (previous['baseUrl'], previous['api_key'])
+        upstreams = document.get("upstreams")
+        if upstreams is not None and upstreams != _config_state["upstreams"]:
+            try:
+                upstream_pool.configure(upstreams)
+            except ValueError as e:
+                logger.error(f"共享配置中的多上游配置错误，忽略: {str(e)}")
+            _config_state["upstreams"] = upstreams
+            stale_clients = True
+        if stale_clients:
+            client_pool.invalidate()
+        _config_state["version"] = version
+    logger.info(f"已应用配置版本{version}: API基础URL={current_config['baseUrl']}, 模型={current_config['model']}")
+
+def refresh_config(force=False):
+    """
+    检查共享配置是否有新版本，有则重新读取并应用；
+    每个进程最多每CONFIG_CHECK_INTERVAL秒检查一次，检查本身只比较版本号
+    """
+    now = time.time()
+    if not force and now - _config_state["checked_at"] < CONFIG_CHECK_INTERVAL:
+        return
+    with _config_state_lock:
+        if not force and now - _config_state["checked_at"] < CONFIG_CHECK_INTERVAL:
+            return
+        _config_state["checked_at"] = now
+        try:
+            if config_store.version() == _config_state["version"]:
+                return
+            version, document = config_store.load()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.warning(f"读取共享配置失败，继续使用当前配置: {str(e)}")
+            return
+        apply_config_document(version, document)
+
+config_store = make_config_store()
+refresh_config(force=True)
+
+@app.before_request
+def sync_shared_config():
+    refresh_config()
+
+def estimate_tokens(text):
+    """粗略估算文本的token数：中日韩字符约1个token，其它字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uf900' <= ch <= '\ufaff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+def estimate_request_tokens(settings):
+    """估算一次调用消耗的token数（提示词 + 预计输出），用于每分钟token数限流"""
+    sampling = settings.get("sampling") or {}
+    try:
+        completion_tokens = int(sampling.get("max_tokens") or RATE_LIMIT_COMPLETION_TOKENS)
+    except (TypeError, ValueError):
+        completion_tokens = RATE_LIMIT_COMPLETION_TOKENS
+    return estimate_tokens(settings.get("system_prompt")) + estimate_tokens(settings.get("question")) + completion_tokens
+
+def parse_reset_duration(value):
+    """解析x-ratelimit-reset-*响应头（如"1s"、"6m0s"、"20ms"），无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class RateLimitExceeded(Exception):
+    """超过上游限流且无法在允许的等待时间内放行时抛出"""
+    status_code = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamRateLimiter:
+    """
+    按(API地址, 密钥)限制上游调用：每分钟请求数和token数两个令牌桶，加上同时进行的调用数上限。
+    令牌桶保存在进程内存中，调用路径上不访问数据库；有限额时每隔sync_interval秒与SQLite中的共享状态合并一次，
+    把本进程的消耗、并发数和429暂停同步给其它worker。上游返回的x-ratelimit-*响应头用于学习和校准限额，
+    429响应会让该密钥暂停到Retry-After指定的时间。没有配置限额、也没有学到限额时不做任何记录
+    """
+    def __init__(self, db_path, rpm, tpm, max_inflight, max_wait, sync_interval=1.0):
+        self.db_path = db_path
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_inflight = max_inflight
+        self.max_wait = max_wait
+        self.sync_interval = sync_interval
+        self._states = {}  # 限流键 -> 本进程的令牌桶状态
+        self._lock = threading.Lock()
+        self._db_conn = None
+        self._db_lock = threading.Lock()
+        self.stats_counter = {"acquired": 0, "queued": 0, "rejected": 0, "throttled": 0, "syncs": 0}
+
+    def _db(self):
+        # 所有线程（gevent下为协程）共用一个连接，由_db_lock串行化；首次同步时才创建文件
+        if self._db_conn is None:
+            db = sqlite3.connect(self.db_path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                "key TEXT PRIMARY KEY, rpm REAL, tpm REAL, requests REAL, tokens REAL, "
+                "updated_at REAL NOT NULL, blocked_until REAL NOT NULL DEFAULT 0)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_inflight ("
+                "key TEXT NOT NULL, worker TEXT NOT NULL, inflight INTEGER NOT NULL, updated_at REAL NOT NULL, "
+                "PRIMARY KEY (key, worker))"
+            )
+            self._db_conn = db
+        return self._db_conn
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counter[name] += 1
+
+    @staticmethod
+    def limiter_key(api_base, api_key):
+        """库中不保存密钥原文，只保存地址和密钥的摘要"""
+        return hashlib.sha256(f"{api_base.rstrip('/')}\0{api_key}".encode("utf-8")).hexdigest()[:32]
+
+    def _effective(self, configured, learned):
+        """配置的限额和从响应头学到的限额取较小者，都没有时不限制"""
+        limits = [value for value in (configured, learned) if value]
+        return min(limits) if limits else None
+
+    @staticmethod
+    def _refill(rpm, tpm, requests_left, tokens_left, elapsed):
+        """按经过的时间补充令牌，返回(剩余请求数, 剩余token数)"""
+        if rpm:
+            requests_left = min(rpm, (rpm if requests_left is None else requests_left) + elapsed * rpm / 60)
+        if tpm:
+            tokens_left = min(tpm, (tpm if tokens_left is None else tokens_left) + elapsed * tpm / 60)
+        return requests_left, tokens_left
+
+    def _state(self, key, now):
+        """取得并补充本进程的令牌桶状态（调用方持有_lock）"""
+        state = self._states.get(key)
+        if state is None:
+            state = {
+                "rpm": None, "tpm": None, "requests": None, "tokens": None, "updated_at": now, "blocked_until": 0.0,
+                "inflight": 0, "shared_inflight": 0, "used_requests": 0.0, "used_tokens": 0.0, "synced_at": 0.0
+            }
+            self._states[key] = state
+        rpm = self._effective(self.rpm, state["rpm"])
+        tpm = self._effective(self.tpm, state["tpm"])
+        state["requests"], state["tokens"] = self._refill(
+            rpm, tpm, state["requests"], state["tokens"], max(0.0, now - state["updated_at"]))
+        state["updated_at"] = now
+        return state, rpm, tpm
+
+    def _needs_sync(self, state, rpm, tpm, now):
+        return bool(rpm or tpm or self.max_inflight or state["blocked_until"] > now) \
+            and self.db_path and now - state["synced_at"] >= self.sync_interval
+
+    def _sync(self, key):
+        """
+        把本进程自上次同步以来的消耗、当前并发数和暂停时间合并进共享状态，再用合并结果更新本进程的令牌桶
+        数据库不可用时只使用本进程的状态
+        """
+        now = time.time()
+        with self._lock:
+            state = self._states[key]
+            state["synced_at"] = now
+            snapshot = dict(state)
+            state["used_requests"] = state["used_tokens"] = 0.0
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        try:
+            with self._db_lock:
+                db = self._db()
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = db.execute(
+                        "SELECT rpm, tpm, requests, tokens, updated_at, blocked_until FROM rate_limits WHERE key = ?", (key,)
+                    ).fetchone()
+                    shared_rpm, shared_tpm, requests_left, tokens_left, updated_at, blocked_until = \
+                        row or (None, None, None, None, now, 0.0)
+                    learned_rpm = snapshot["rpm"] or shared_rpm
+                    learned_tpm = snapshot["tpm"] or shared_tpm
+                    rpm = self._effective(self.rpm, learned_rpm)
+                    tpm = self._effective(self.tpm, learned_tpm)
+                    requests_left, tokens_left = self._refill(
+                        rpm, tpm, requests_left, tokens_left, max(0.0, now - updated_at))
+                    if rpm:
+                        requests_left -= snapshot["used_requests"]
+                        if snapshot["requests"] is not None:
+                            # 本进程根据响应头校准过的剩余额度可能更低
+                            requests_left = min(requests_left, snapshot["requests"])
+                    if tpm:
+                        tokens_left -= snapshot["used_tokens"]
+                        if snapshot["tokens"] is not None:
+                            tokens_left = min(tokens_left, snapshot["tokens"])
+                    blocked_until = max(blocked_until, snapshot["blocked_until"])
+                    db.execute(
+                        "INSERT OR REPLACE INTO rate_limits (key, rpm, tpm, requests, tokens, updated_at, blocked_until) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (key, learned_rpm, learned_tpm, requests_left, tokens_left, now, blocked_until)
+                    )
+                    shared_inflight = 0
+                    if self.max_inflight:
+                        db.execute(
+                            "INSERT OR REPLACE INTO rate_limit_inflight (key, worker, inflight, updated_at) VALUES (?, ?, ?, ?)",
+                            (key, worker, snapshot["inflight"], now)
+                        )
+                        # 崩溃的worker停止上报后，它的并发数在过期后不再计入
+                        shared_inflight = db.execute(
+                            "SELECT COALESCE(SUM(inflight), 0) FROM rate_limit_inflight "
+                            "WHERE key = ? AND worker != ? AND updated_at > ?",
+                            (key, worker, now - max(10 * self.sync_interval, 10))
+                        ).fetchone()[0]
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.warning(f"同步限流状态失败，暂时只使用本进程的状态: {str(e)}")
+            with self._lock:
+                state["used_requests"] += snapshot["used_requests"]
+                state["used_tokens"] += snapshot["used_tokens"]
+            return
+        with self._lock:
+            self.stats_counter["syncs"] += 1
+            # 同步期间本进程新消耗的额度从共享结果中扣除
+            elapsed = max(0.0, state["updated_at"] - now)
+            state["rpm"], state["tpm"] = learned_rpm, learned_tpm
+            requests_left, tokens_left = self._refill(rpm, tpm, requests_left, tokens_left, elapsed)
+            state["requests"] = requests_left - state["used_requests"] if rpm else None
+            state["tokens"] = tokens_left - state["used_tokens"] if tpm else None
+            state["blocked_until"] = max(state["blocked_until"], blocked_until)
+            state["shared_inflight"] = shared_inflight
+
+    def _try_acquire(self, key, tokens):
+        """尝试占用一次调用额度，成功返回(是否占用了并发名额, 0)，否则返回(None, 需要等待的秒数)"""
+        if not self.rpm and not self.tpm and not self.max_inflight and key not in self._states:
+            # 没有配置限额、也没有从上游学到限额（默认情况），不记录任何状态
+            return False, 0
+        now = time.time()
+        with self._lock:
+            state, rpm, tpm = self._state(key, now)
+            needs_sync = self._needs_sync(state, rpm, tpm, now)
+        if needs_sync:
+            self._sync(key)
+        with self._lock:
+            state, rpm, tpm = self._state(key, now)
+            wait = max(0.0, state["blocked_until"] - now)
+            if rpm and state["requests"] < 1:
+                wait = max(wait, (1 - state["requests"]) * 60 / rpm)
+            needed = min(tokens, tpm) if tpm else 0
+            if tpm and state["tokens"] < needed:
+                wait = max(wait, (needed - state["tokens"]) * 60 / tpm)
+            if self.max_inflight and state["inflight"] + state["shared_inflight"] >= self.max_inflight:
+                wait = max(wait, RATE_LIMIT_POLL_INTERVAL)
+            if wait > 0:
+                return None, wait
+            if rpm:
+                state["requests"] -= 1
+                state["used_requests"] += 1
+            if tpm:
+                state["tokens"] -= needed
+                state["used_tokens"] += needed
+            if self.max_inflight:
+                state["inflight"] += 1
+                return True, 0
+            return False, 0
+
+    def _release(self, key):
+        with self._lock:
+            self._states[key]["inflight"] -= 1
+
+    @contextmanager
+    def acquire(self, api_base, api_key, tokens=0, deadline=None):
+        """
+        在调用上游前占用额度：额度不足时最多排队max_wait秒（不超过请求总时限），
+        预计等待更久时立即抛出RateLimitExceeded
+        """
+        key = self.limiter_key(api_base, api_key)
+        start_time = time.time()
+        max_wait = self.max_wait
+        if deadline is not None:
+            max_wait = min(max_wait, deadline - start_time)
+        queued = False
+        while True:
+            holding, wait = self._try_acquire(key, tokens)
+            if holding is not None:
+                break
+            waited = time.time() - start_time
+            if waited + wait > max_wait:
+                self._count("rejected")
+                retry_after = max(1, int(wait + 0.999))
+                logger.warning(f"上游{api_base}超过限流，预计还需等待{wait:.2f}秒，拒绝请求")
+                raise RateLimitExceeded(f"上游请求过于频繁，请{retry_after}秒后重试", retry_after)
+            if not queued:
+                queued = True
+                self._count("queued")
+                logger.info(f"上游{api_base}超过限流，排队等待{wait:.2f}秒")
+            time.sleep(min(wait, 1.0))
+        self._count("acquired")
+        try:
+            yield
+        finally:
+            if holding:
+                self._release(key)
+
+    def observe(self, api_base, api_key, status_code, headers):
+        """根据上游响应校准限额：学习x-ratelimit-*响应头，429时暂停该密钥；只更新内存，429时立即同步给其它worker"""
+        def header_number(name):
+            try:
+                return float(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+        limit_requests = header_number("x-ratelimit-limit-requests")
+        limit_tokens = header_number("x-ratelimit-limit-tokens")
+        remaining_requests = header_number("x-ratelimit-remaining-requests")
+        remaining_tokens = header_number("x-ratelimit-remaining-tokens")
+        if status_code != 429 and limit_requests is None and limit_tokens is None \
+                and remaining_requests is None and remaining_tokens is None:
+            return
+        
+        key = self.limiter_key(api_base, api_key)
+        now = time.time()
+        with self._lock:
+            state, _, _ = self._state(key, now)
+            state["rpm"] = limit_requests or state["rpm"]
+            state["tpm"] = limit_tokens or state["tpm"]
+            rpm = self._effective(self.rpm, state["rpm"])
+            tpm = self._effective(self.tpm, state["tpm"])
+            if rpm and remaining_requests is not None:
+                state["requests"] = min(rpm if state["requests"] is None else state["requests"], remaining_requests)
+            if tpm and remaining_tokens is not None:
+                state["tokens"] = min(tpm if state["tokens"] is None else state["tokens"], remaining_tokens)
+            if status_code == 429:
+                pause = parse_retry_after(headers)
+                if pause is None:
+                    pause = parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 1.0
+                state["blocked_until"] = max(state["blocked_until"], now + pause)
+                state["synced_at"] = 0.0
+                self.stats_counter["throttled"] += 1
+                logger.warning(f"上游{api_base}返回429，暂停调用{pause:.2f}秒")
+        if status_code == 429 and self.db_path:
+            self._sync(key)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.stats_counter)
+            counters["keys"] = len(self._states)
+        return {
+            "rpm": self.rpm or None,
+            "tpm": self.tpm or None,
+            "maxInflight": self.max_inflight or None,
+            "maxWait": self.max_wait,
+            "syncInterval": self.sync_interval,
+            **counters
+        }
+
+rate_limiter = UpstreamRateLimiter(
+    RATE_LIMIT_DB, RATE_LIMIT_RPM, RATE_LIMIT_TPM, RATE_LIMIT_MAX_INFLIGHT, RATE_LIMIT_MAX_WAIT, RATE_LIMIT_SYNC_INTERVAL
+)
+
+class HedgeController:
+    """
+    对冲请求的触发时机和预算：按最近首个分片延迟的分位数决定何时发出对冲请求，
+    最近一分钟内对冲次数占调用次数的比例和对冲消耗的token数都有上限
+    """
+    def __init__(self, percentile, window, min_samples, min_delay, max_ratio, token_budget):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.token_budget = token_budget
+        self._samples = deque(maxlen=window)
+        self._calls = deque()  # 最近一分钟的调用时间
+        self._hedges = deque()  # 最近一分钟的(对冲时间, 估算token数)
+        self._lock = threading.Lock()
+        self.stats_counter = {
+            "calls": 0, "hedged": 0, "hedgeWins": 0, "cancelled": 0, "budgetExhausted": 0, "hedgeTokens": 0
+        }
+
+    def observe(self, latency):
+        """记录一次首个分片延迟（秒）"""
+        with self._lock:
+            self._samples.append(latency)
+
+    def delay(self):
+        """返回发出对冲请求前的等待时间，样本不足时返回None（不对冲）"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, max(0, math.ceil(self.percentile / 100 * len(samples)) - 1))
+        return max(self.min_delay, samples[index])
+
+    def _trim(self, now):
+        while self._calls and self._calls[0] <= now - 60:
+            self._calls.popleft()
+        while self._hedges and self._hedges[0][0] <= now - 60:
+            self._hedges.popleft()
+
+    def record_call(self):
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            self._calls.append(now)
+            self.stats_counter["calls"] += 1
+
+    def try_spend(self, tokens):
+        """预算允许时占用一次对冲额度并返回True"""
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            # 不设下限：比例为0时不对冲，调用量少时也不会因为"至少1次"而超出比例
+            allowed_hedges = self.max_ratio * len(self._calls)
+            spent_tokens = sum(hedge_tokens for _, hedge_tokens in self._hedges)
+            if len(self._hedges) + 1 > allowed_hedges or (self.token_budget and spent_tokens + tokens > self.token_budget):
+                self.stats_counter["budgetExhausted"] += 1
+                return False
+            self._hedges.append((now, tokens))
+            self.stats_counter["hedged"] += 1
+            self.stats_counter["hedgeTokens"] += tokens
+            return True
+
+    def record(self, name):
+        with self._lock:
+            self.stats_counter[name] += 1
+
+    def stats(self):
+        delay = self.delay()
+        with self._lock:
+            counters = dict(self.stats_counter)
+            samples = len(self._samples)
+        calls = counters["calls"]
+        return {
+            "enabled": HEDGE_ENABLED,
+            "percentile": self.percentile,
+            "samples": samples,
+            "delay": round(delay, 3) if delay is not None else None,
+            "hedgeRate": round(counters["hedged"] / calls, 4) if calls else 0.0,
+            **counters
+        }
+
+hedge_controller = HedgeController(
+    HEDGE_PERCENTILE, HEDGE_WINDOW, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY, HEDGE_MAX_RATIO, HEDGE_TOKEN_BUDGET
+)
+
+class ResponseCache:
+    """
+    优化结果缓存：内存LRU（容量和有效期限制）+ 可选的SQLite持久化存储
+    每个进程只持有一个SQLite连接，由锁串行化访问（gevent下threading.local按greenlet区分，按线程建连接会每个请求新开一个）
+    """
+    def __init__(self, max_size, ttl, db_path=""):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self.stats_counter = {"hits": 0, "diskHits": 0, "misses": 0, "bypass": 0, "stores": 0}
+        if self.db_path:
+            self._init_db()
+
+    def _init_db(self):
+        with self._db_lock:
+            db = self._db()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
+            db.commit()
+
+    def _db(self):
+        # 调用方须持有_db_lock
+        if self._conn is None:
+            db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._conn = db
+        return self._conn
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counter[name] += 1
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                answer, expires_at = entry
+                if now < expires_at:
+                    self._memory.move_to_end(key)
+                    self.stats_counter["hits"] += 1
+                    return answer
+                del self._memory[key]
+
+        if self.db_path:
+            try:
+                with self._db_lock:
+                    row = self._db().execute(
+                        "SELECT answer, expires_at FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"读取持久化缓存失败: {str(e)}")
+                row = None
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self._count("diskHits")
+                return row[0]
+
+        self._count("misses")
+        return None
+
+    def _remember(self, key, answer, expires_at):
+        with self._lock:
+            self._memory[key] = (answer, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def set(self, key, answer):
+        if not self.enabled or not answer:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, answer, expires_at)
+        self._count("stores")
+        if self.db_path:
+            try:
+                # 连接由所有请求共用，出错时回滚，不把未完成的事务留给下一个请求
+                with self._db_lock, self._db() as db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO response_cache (key, answer, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                        (key, answer, now, expires_at)
+                    )
+                    # 顺带清理过期记录，避免数据库无限增长
+                    db.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            except sqlite3.Error as e:
+                logger.warning(f"写入持久化缓存失败: {str(e)}")
+
+    def record_bypass(self):
+        self._count("bypass")
+
+    def stats(self):
+        with self._lock:
+            result = dict(self.stats_counter)
+            result["entries"] = len(self._memory)
+        lookups = result["hits"] + result["diskHits"] + result["misses"]
+        result["hitRate"] = round((result["hits"] + result["diskHits"]) / lookups, 4) if lookups else 0.0
+        result["maxEntries"] = self.max_size
+        result["ttl"] = self.ttl
+        result["persistent"] = bool(self.db_path)
+        return result
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB)
+
+def make_response_cache_key(settings):
+    """按模型、系统提示词、简历内容和采样参数计算缓存键"""
+    material = json.dumps({
+        "model": settings["model"],
+        "system_prompt": settings["system_prompt"],
+        "question": settings["question"],
+        "sampling": settings.get("sampling") or {}
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def should_bypass_cache(data):
+    """请求体中noCache为true或请求头Cache-Control包含no-cache时跳过缓存读取"""
+    if data.get('noCache'):
+        return True
+    return 'no-cache' in request.headers.get('Cache-Control', '').lower()
+
+FINGERPRINT_TOKEN_PATTERN = re.compile(r'[\u3400-\u9fff]|[a-z0-9]+')
+FINGERPRINT_LIST_PATTERN = re.compile(r'[^\s、，,。；;：:]+(?:、[^\s、，,。；;：:]+)+')  # 顿号分隔的并列项，如技能列表
+MINHASH_EMPTY = 1 << 64
+MINHASH_MASK = (1 << 64) - 1
+
+def fingerprint_shingles(text, size=3, mask_pii=True):
+    """
+    把简历正文规范化为片段集合：统一全半角和大小写，邮箱、手机号等个人信息替换为占位符（mask_pii为false时保留原值），
+    顿号分隔的并列项排序后再比较，只保留中文单字和英文单词/数字（忽略空白和标点），相邻size个词组成一个片段；
+    调整经历段落的顺序只影响边界处的少数片段
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    if mask_pii:
+        for pattern, replacement in PII_PATTERNS:
+            text = pattern.sub(replacement, text)
+    text = FINGERPRINT_LIST_PATTERN.sub(lambda m: "、".join(sorted(m.group(0).split("、"))), text)
+    tokens = FINGERPRINT_TOKEN_PATTERN.findall(text)
+    if len(tokens) <= size:
+        return {tuple(tokens)} if tokens else set()
+    return {tuple(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+def pii_values(text):
+    """简历中出现的邮箱、手机号和身份证号（规范化后）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return frozenset(match for pattern, _ in PII_PATTERNS for match in pattern.findall(text))
+
+def mask_pii(text):
+    """把邮箱、手机号和身份证号替换为占位符"""
+    for pattern, replacement in PII_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+def identity_guard(text):
+    """
+    answer模式下判断能否把一份简历的答案返回给另一份简历所需的信息：
+    (个人信息集合, 未屏蔽个人信息时的片段哈希集合)
+    """
+    return pii_values(text), frozenset(hash(shingle) for shingle in fingerprint_shingles(text, mask_pii=False))
+
+def answer_is_transferable(guard, question_guard, answer):
+    """
+    近似重复简历的答案只有在不会泄露前一份简历独有的内容时才能直接返回：
+    两份简历的邮箱、手机号、身份证号必须完全相同，且只出现在前一份简历中的片段（如不同的姓名）不能出现在答案里
+    """
+    pii, shingles = guard
+    question_pii, question_shingles = question_guard
+    if pii != question_pii:
+        return False
+    only_previous = shingles - question_shingles
+    if not only_previous:
+        return True
+    return not only_previous & identity_guard(answer)[1]
+
+def minhash_signature(shingles, num_perm):
+    """
+    单次哈希的MinHash签名（one permutation hashing）：每个片段只哈希一次，按哈希值分到num_perm个桶中各取最小值，
+    空桶借用右侧最近的非空桶（旋转致密化）；两个签名相同位置相等的比例近似于片段集合的Jaccard相似度
+    片段为空时返回None
+    """
+    if not shingles:
+        return None
+    mins = [MINHASH_EMPTY] * num_perm
+    for shingle in shingles:
+        # 乘以奇数常数打散内置哈希的位分布，高位决定分桶
+        value = (hash(shingle) * 0x9E3779B97F4A7C15) & MINHASH_MASK
+        bucket = (value * num_perm) >> 64
+        if value < mins[bucket]:
+            mins[bucket] = value
+    if MINHASH_EMPTY in mins:
+        filled = list(mins)
+        for index in range(num_perm):
+            if mins[index] == MINHASH_EMPTY:
+                distance = 1
+                while mins[(index + distance) % num_perm] == MINHASH_EMPTY:
+                    distance += 1
+                filled[index] = (mins[(index + distance) % num_perm] + distance * 0x632BE59BD9B4E019) & MINHASH_MASK
+        mins = filled
+    return array('Q', mins)
+
+class NearDuplicateIndex:
+    """
+    近似重复简历的相似度索引：MinHash签名按LSH分段分桶，查询只比较与本次签名至少有一段完全相同的候选，
+    开销与索引大小基本无关。条目数超过上限时淘汰最久未使用的，过期条目在访问时清除
+    只有scope（模型、系统提示词和采样参数）相同的条目才互相匹配
+    """
+    def __init__(self, max_entries, ttl, threshold, num_perm=64, bands=8, max_candidates=50):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_candidates = max_candidates
+        self._entries = OrderedDict()  # 条目ID -> (scope, 桶键列表, 签名, 答案, 过期时间, 身份校验信息)
+        self._buckets = {}  # 桶键 -> {条目ID: None}，按加入顺序排列
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.stats_counter = {"lookups": 0, "hits": 0, "stores": 0, "evictions": 0, "compared": 0, "rejected": 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def signature(self, text):
+        return minhash_signature(fingerprint_shingles(text), self.num_perm)
+
+    def _band_keys(self, scope, signature):
+        raw = signature.tobytes()
+        width = self.rows * signature.itemsize
+        return [hash((scope, band, raw[band * width:(band + 1) * width])) for band in range(self.bands)]
+
+    def similarity(self, left, right):
+        return sum(1 for a, b in zip(left, right) if a == b) / self.num_perm
+
+    def _remove(self, entry_id):
+        keys = self._entries.pop(entry_id)[1]
+        for key in keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.pop(entry_id, None)
+                if not bucket:
+                    del self._buckets[key]
+
+    def add(self, scope, signature, answer, guard=None):
+        """加入一条结果；签名完全相同的旧条目直接更新。guard为identity_guard的结果，answer模式下用于防止泄露个人信息"""
+        if not self.enabled or signature is None or not answer:
+            return
+        keys = self._band_keys(scope, signature)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self.stats_counter["stores"] += 1
+            for entry_id in self._buckets.get(keys[0], ()):
+                entry = self._entries[entry_id]
+                if entry[0] == scope and entry[2] == signature:
+                    self._entries[entry_id] = (scope, keys, signature, answer, expires_at, guard)
+                    self._entries.move_to_end(entry_id)
+                    return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, keys, signature, answer, expires_at, guard)
+            for key in keys:
+                self._buckets.setdefault(key, {})[entry_id] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats_counter["evictions"] += 1
+
+    def query(self, scope, signature):
+        """返回相似度不低于阈值的最相似条目(答案, 相似度, 身份校验信息)，没有时返回None"""
+        if not self.enabled or signature is None:
+            return None
+        keys = self._band_keys(scope, signature)
+        now = time.time()
+        best_id, best_similarity = None, 0.0
+        with self._lock:
+            self.stats_counter["lookups"] += 1
+            seen, expired = set(), []
+            for key in keys:
+                # 同一桶中从最新的条目开始比较，候选数有上限，避免大量相似模板拖慢查询
+                for entry_id in reversed(self._buckets.get(key, {})):
+                    if len(seen) >= self.max_candidates:
+                        break
+                    if entry_id in seen:
+                        continue
+                    seen.add(entry_id)
+                    entry_scope, _, entry_signature, _, expires_at, _ = self._entries[entry_id]
+                    if expires_at <= now:
+                        expired.append(entry_id)
+                        continue
+                    if entry_scope != scope:
+                        continue
+                    similarity = self.similarity(signature, entry_signature)
+                    if similarity > best_similarity:
+                        best_id, best_similarity = entry_id, similarity
+            self.stats_counter["compared"] += len(seen)
+            for entry_id in expired:
+                self._remove(entry_id)
+            if best_id is None or best_similarity < self.threshold:
+                return None
+            self._entries.move_to_end(best_id)
+            self.stats_counter["hits"] += 1
+            entry = self._entries[best_id]
+            return entry[3], best_similarity, entry[5]
+
+    def record_rejected(self):
+        """命中的条目因可能泄露个人信息而没有使用"""
+        with self._lock:
+            self.stats_counter["hits"] -= 1
+            self.stats_counter["rejected"] += 1
+
+    def stats(self):
+        with self._lock:
+            result = dict(self.stats_counter)
+            result["entries"] = len(self._entries)
+            result["buckets"] = len(self._buckets)
+        result["hitRate"] = round(result["hits"] / result["lookups"], 4) if result["lookups"] else 0.0
+        result["mode"] = NEAR_DUP_MODE
+        result["threshold"] = self.threshold
+        result["maxEntries"] = self.max_entries
+        return result
+
+near_duplicate_index = NearDuplicateIndex(
+    NEAR_DUP_MAX_ENTRIES if NEAR_DUP_MODE in ("answer", "seed") else 0, RESPONSE_CACHE_TTL, NEAR_DUP_THRESHOLD,
+    max_candidates=NEAR_DUP_MAX_CANDIDATES
+)
+
+def fingerprint_scope(settings):
+    """相似度索引的分区：模型、系统提示词和采样参数都相同的请求才互相匹配"""
+    material = json.dumps({
+        "model": settings["model"],
+        "system_prompt": settings["system_prompt"],
+        "sampling": settings.get("sampling") or {}
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def resolve_near_duplicate(settings, bypass_cache):
+    """
+    精确缓存未命中后查询相似度索引，返回(可直接使用的答案或None, 相似度或None)：
+    answer模式只在不会泄露前一份简历的个人信息时直接返回其答案（见answer_is_transferable）；
+    seed模式把屏蔽个人信息后的答案附加到系统提示词中作为参考，仍然调用上游。
+    本请求的指纹记在settings["fingerprint"]中，调用成功后由run_inflight_call加入索引
+    """
+    if not near_duplicate_index.enabled:
+        return None, None
+    scope = fingerprint_scope(settings)
+    signature = near_duplicate_index.signature(settings["question"])
+    guard = identity_guard(settings["question"]) if NEAR_DUP_MODE == "answer" else None
+    settings["fingerprint"] = (scope, signature, guard)
+    if bypass_cache:
+        return None, None
+    match = near_duplicate_index.query(scope, signature)
+    if match is None:
+        return None, None
+    answer, similarity, entry_guard = match
+    if NEAR_DUP_MODE == "answer":
+        if entry_guard is None or not answer_is_transferable(entry_guard, guard, answer):
+            near_duplicate_index.record_rejected()
+            logger.info(f"相似度{similarity:.2f}的历史结果包含另一份简历的个人信息，不直接复用")
+            return None, None
+        logger.info(f"命中近似重复缓存，相似度{similarity:.2f}")
+        return answer, similarity
+    logger.info(f"找到相似度{similarity:.2f}的历史结果，作为参考交给模型")
+    settings["system_prompt"] = f"{settings['system_prompt']}\n\n{NEAR_DUP_SEED_PROMPT}\n{mask_pii(answer)}"
+    return None, similarity
+
+DEFAULT_SYSTEM_PROMPT = "假如你是一名资深简历提升官，请使用STAR+改写简历，并且最后提供完整输出，帮助更多应届大学生顺利找到他们的工作 输出限制： 1.请不要使用任何表情符号 2.请在一个自然段内完整输出 3.请不要过度夸大，请符合岗位实际 4.语言请说人话，平白直叙，拒绝任何行业黑话"
+NEAR_DUP_SEED_PROMPT = "以下是一份相似简历此前的优化结果，只可参考其结构和表达方式，内容必须以本次提供的简历为准："
+
+def build_chat_messages(system_prompt, question):
+    """构造chat completions接口的消息列表"""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": question}
+    ]
+
+def build_chat_completions_url(api_base):
+    """根据基础URL拼出chat completions端点"""
+    if api_base.rstrip('/').endswith('/v1'):
+        # 如果基础URL已经以/v1结尾，直接添加/chat/completions
+        return f"{api_base.rstrip('/')}/chat/completions"
+    # 否则添加完整路径/v1/chat/completions
+    return f"{api_base.rstrip('/')}/v1/chat/completions"
+
+def build_completions_payload(model, system_prompt, question, sampling=None):
+    """构造旧版/v1/completions接口的请求参数"""
+    payload = {
+        "model": model,
+        "prompt": f"系统: {system_prompt}\n\n用户: {question}",
+        "max_tokens": 2000,
+        "temperature": 0.7
+    }
+    payload.update(sampling or {})
+    return payload
+
+def build_http_request(protocol, settings, stream=False):
+    """
+    返回HTTP调用方式对应的(接口地址, 请求体)，protocol为http_chat或completions
+    """
+    api_base = settings["api_base"]
+    model = settings["model"]
+    sampling = settings.get("sampling") or {}
+    if protocol == "http_chat":
+        url = build_chat_completions_url(api_base)
+        payload = {
+            "model": model,
+            "messages": build_chat_messages(settings["system_prompt"], settings["question"]),
+            **sampling
+        }
+    else:
+        url = f"{api_base.rstrip('/')}/v1/completions"
+        payload = build_completions_payload(model, settings["system_prompt"], settings["question"], sampling)
+    if stream:
+        payload["stream"] = True
+    return url, payload
+
+def iter_sse_data(response):
+    """
+    解析上游返回的SSE流，逐个产出data字段解析后的JSON对象，遇到[DONE]结束
+    """
+    # SSE规定使用UTF-8；上游的Content-Type不带charset时requests会按ISO-8859-1解码，中文变成乱码
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        try:
+            yield json.loads(data)
+        except json.JSONDecodeError:
+            logger.warning(f"无法解析的SSE数据: {data[:200]}")
+
+def extract_delta_from_chunk(chunk):
+    """
+    从流式响应的单个分片中提取增量文本，兼容SDK对象和字典两种格式
+    """
+    if hasattr(chunk, 'choices'):
+        if not chunk.choices:
+            return ""
+        choice = chunk.choices[0]
+        delta = getattr(choice, 'delta', None)
+        if delta is not None:
+            return getattr(delta, 'content', None) or ""
+        return getattr(choice, 'text', None) or ""
+    if isinstance(chunk, dict) and chunk.get("choices"):
+        choice = chunk["choices"][0]
+        if isinstance(choice.get("delta"), dict):
+            return choice["delta"].get("content") or ""
+        return choice.get("text") or ""
+    return ""
+
+def check_cancelled(settings):
+    """调用已被取消（settings["cancel_event"]已设置）时抛出UpstreamCallCancelled"""
+    cancel_event = settings.get("cancel_event")
+    if cancel_event is not None and cancel_event.is_set():
+        reason = getattr(cancel_event, "reason", None)
+        raise UpstreamCallCancelled(f"上游调用已取消（{reason}）" if reason else "上游调用已取消", reason)
+
+def shutdown_connection(response):
+    """
+    从另一个线程中止正在读取的上游响应（requests或httpx的响应对象）：
+    直接close会与读取线程争用缓冲区，这里关闭底层套接字的读写，读取线程随即收到连接结束并自行清理
+    """
+    network_stream = (getattr(response, "extensions", None) or {}).get("network_stream")
+    if network_stream is not None:
+        sock = network_stream.get_extra_info("socket")
+    else:
+        raw = getattr(response, "raw", None)
+        connection = getattr(raw, "connection", None) or getattr(raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def on_cancel(settings, callback):
+    """调用被取消时执行callback（用于关闭进行中的上游连接），返回注销函数"""
+    cancel_event = settings.get("cancel_event")
+    if isinstance(cancel_event, CancelScope):
+        return cancel_event.on_cancel(callback)
+    return lambda: None
+
+def extract_json_answer(settings, response_data):
+    """从非流式（JSON）响应中提取答案和用量，耗时记入answer_extract阶段"""
+    with stage_timer(stage="answer_extract", upstream=metric_upstream(settings)):
+        settings["usage"] = extract_usage(response_data)
+        return extract_answer_from_response(response_data, logger)
+
+def extract_stream_deltas(settings, chunks):
+    """
+    逐个分片提取增量文本，各分片的解析耗时合计记入answer_extract阶段；
+    连接被取消回调关闭后读取会提前结束，不能把不完整的内容当作答案；
+    流中没有任何内容时抛出UpstreamEmptyAnswer，不返回空答案
+    """
+    extract_seconds = 0.0
+    produced = False
+    try:
+        for chunk in chunks:
+            check_cancelled(settings)
+            start_time = time.time()
+            # 部分上游在最后一个分片中附带用量
+            settings["usage"] = extract_usage(chunk) or settings.get("usage")
+            delta = extract_delta_from_chunk(chunk)
+            extract_seconds += time.time() - start_time
+            if delta:
+                produced = True
+                yield delta
+        check_cancelled(settings)
+    finally:
+        metrics.observe(CHAT_STAGE_SECONDS, extract_seconds, stage="answer_extract", upstream=metric_upstream(settings))
+        record_span("answer_extract", extract_seconds, metric_upstream(settings))
+    if not produced:
+        raise UpstreamEmptyAnswer("上游返回的流式响应中没有内容")
+
+def stream_chat_answer(upstream, client, settings, protocol, timeout=API_TIMEOUT):
+    """
+    用指定的调用方式流式请求一次上游，逐段产出增量文本
+    上游忽略stream参数返回普通JSON时按非流式响应一次性产出答案；没有任何内容时抛出UpstreamEmptyAnswer
+    """
+    if protocol == "sdk":
+        logger.info("使用OpenAI 1.x版本的流式API调用")
+        stream = client.chat.completions.create(
+            model=settings["model"],
+            messages=build_chat_messages(settings["system_prompt"], settings["question"]),
+            stream=True,
+            timeout=timeout,
+            **(settings.get("sampling") or {})
+        )
+        # 取消时立即中止上游连接，不必等到下一个分片
+        unregister = on_cancel(settings, lambda: shutdown_connection(getattr(stream, "response", None)))
+        try:
+            response = getattr(stream, "response", None)
+            if response is not None and not response.headers.get('content-type', '').startswith('text/event-stream'):
+                # SDK按SSE解析非流式响应时不会产出任何分片，这里直接读取JSON
+                answer = extract_json_answer(settings, json.loads(response.read()))
+                check_cancelled(settings)
+                if not answer:
+                    raise UpstreamEmptyAnswer("上游返回的响应中没有答案")
+                yield answer
+                return
+            yield from extract_stream_deltas(settings, stream)
+        finally:
+            unregister()
+            # 提前结束（例如客户端断开）时关闭上游连接
+            if hasattr(stream, 'close'):
+                stream.close()
+        return
+    
+    url, payload = build_http_request(protocol, settings, stream=True)
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {settings['api_key']}",
+        "Accept": "text/event-stream"
+    }
+    logger.info(f"使用HTTP流式请求调用API: {url}")
+    response = upstream.session.post(url, headers=headers, json=payload, timeout=timeout, stream=True)
+    unregister = on_cancel(settings, lambda: shutdown_connection(response))
+    try:
+        if response.status_code != 200:
+            error_msg = f"API返回错误状态码: {response.status_code}, 响应: {response.text}"
+            logger.error(error_msg)
+            raise UpstreamHTTPError(error_msg, response.status_code, response.headers)
+        if not response.headers.get('content-type', '').startswith('text/event-stream'):
+            # 上游不支持流式输出时，按普通JSON响应一次性返回
+            answer = extract_json_answer(settings, response.json())
+            check_cancelled(settings)
+            if not answer:
+                raise UpstreamEmptyAnswer("上游返回的响应中没有答案")
+            yield answer
+            return
+        yield from extract_stream_deltas(settings, iter_sse_data(response))
+    finally:
+        unregister()
+        response.close()
+
+def format_sse(payload):
+    """将字典编码为一条SSE消息"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+# 全角字母数字、各种宽度的空格和PDF中常见的连字统一为普通字符，中文标点保持不变
+COMPACTION_CHAR_MAP = {
+    **{code: code - 0xFEE0 for code in list(range(0xFF10, 0xFF1A)) + list(range(0xFF21, 0xFF3B)) + list(range(0xFF41, 0xFF5B))},
+    **{code: " " for code in [0x00A0, 0x1680, 0x202F, 0x205F, 0x3000] + list(range(0x2000, 0x200B))},
+    0xFB00: "ff", 0xFB01: "fi", 0xFB02: "fl", 0xFB03: "ffi", 0xFB04: "ffl",
+}
+# 从PDF复制时逐字加空格的中文（如"负 责 项 目"）
+SPACED_CJK_PATTERN = re.compile(r'(?:[\u3400-\u9fff] ){3,}[\u3400-\u9fff]')
+LIST_MARKER_PATTERN = re.compile(r'(?:[-*+•●▪■◆◦]|\d+[.、)）])\s')
+# 明确的页码行：第1页、第1页/共3页、Page 1、Page 1 of 3、- 1 -
+PAGE_MARKER_PATTERN = re.compile(
+    r'(?:第\s*\d{1,3}\s*页(?:\s*[/，,]?\s*共\s*\d{1,3}\s*页)?|page\s*\d{1,3}(?:\s*(?:/|of)\s*\d{1,3})?|[-—]\s*\d{1,3}\s*[-—])',
+    re.IGNORECASE
+)
+# 单独一行的"1/3"、"1 of 3"可能是日期，只有同一份简历中出现同一总页数的多个页码时才当作页码
+BARE_PAGE_PATTERN = re.compile(r'(\d{1,2})\s*(?:/|of)\s*(\d{1,2})', re.IGNORECASE)
+BARE_PAGE_MAX = 20
+# 并列项分隔符；两侧都是数字的逗号是千位分隔符（如2,000,000），不作为分隔符
+LIST_SEPARATOR_PATTERN = re.compile(r'(\s*(?:、|[;；|]|(?<!\d)[,，]|[,，](?!\d))\s*)')
+NUMERIC_ITEM_PATTERN = re.compile(r'[\d.,%+\-\s]+')
+COMPACTION_OMITTED = "……（简历过长，以下内容已省略）"
+DUPLICATE_PARAGRAPH_MIN_CHARS = 30
+
+def line_key(line):
+    """比较两行是否重复时忽略空白差异和大小写"""
+    return " ".join(line.split()).lower()
+
+def compact_unicode(text):
+    """统一换行符、NFC规范化，全角字母数字和特殊空格换成半角，删除零宽字符、软连字符等不可见字符"""
+    text = unicodedata.normalize("NFC", text.replace("\r\n", "\n").replace("\r", "\n")).translate(COMPACTION_CHAR_MAP)
+    return "".join(ch for ch in text if ch in "\n\t" or unicodedata.category(ch) not in ("Cc", "Cf"))
+
+def compact_whitespace(text):
+    """
+    合并行内连续空白、删除行首缩进（列表项保留最多4个空格的层级）和逐字空格，连续空行合并为一个
+    """
+    lines = []
+    for line in text.split("\n"):
+        stripped = " ".join(line.split())
+        if stripped and LIST_MARKER_PATTERN.match(stripped + " "):
+            indent = len(line.expandtabs(2)) - len(line.expandtabs(2).lstrip())
+            stripped = " " * min(indent, 4) + stripped
+        stripped = SPACED_CJK_PATTERN.sub(lambda m: m.group(0).replace(" ", ""), stripped)
+        if stripped or (lines and lines[-1]):
+            lines.append(stripped)
+    return "\n".join(lines).strip("\n")
+
+def find_page_markers(lines, content):
+    """返回页码行的行号：明确的页码格式，或构成页码序列（同一总页数下至少两个不同页码）的"N/M"行"""
+    markers = {i for i in content if PAGE_MARKER_PATTERN.fullmatch(lines[i].strip())}
+    bare = {}
+    for i in content:
+        match = BARE_PAGE_PATTERN.fullmatch(lines[i].strip())
+        if match:
+            page, total = int(match.group(1)), int(match.group(2))
+            if 1 <= page <= total <= BARE_PAGE_MAX:
+                bare.setdefault(total, {})[i] = page
+    for pages in bare.values():
+        if len(set(pages.values())) >= 2:
+            markers.update(pages)
+    return markers
+
+def strip_boilerplate(text):
+    """
+    删除页码行、在分页处重复出现的页眉页脚（紧挨页码且在全文出现多次的行，只保留第一次出现）、
+    紧挨着重复的行，以及与前文完全相同的段落（重复粘贴）
+    """
+    lines = text.split("\n")
+    content = [i for i, line in enumerate(lines) if line.strip()]
+    markers = find_page_markers(lines, content)
+    counts, first_seen = {}, {}
+    for i in content:
+        key = line_key(lines[i])
+        counts[key] = counts.get(key, 0) + 1
+        first_seen.setdefault(key, i)
+    dropped = set(markers)
+    for pos, i in enumerate(content):
+        if i not in markers:
+            continue
+        for neighbour in content[max(pos - 1, 0):pos] + content[pos + 1:pos + 2]:
+            key = line_key(lines[neighbour])
+            if neighbour not in markers and counts[key] >= 2 and first_seen[key] != neighbour:
+                dropped.add(neighbour)
+    kept, previous = [], None
+    for i, line in enumerate(lines):
+        if i in dropped:
+            continue
+        key = line_key(line)
+        if key and key == previous:
+            continue
+        previous = key
+        kept.append(line)
+    paragraphs, seen_paragraphs = [], set()
+    for paragraph in re.split(r'\n\s*\n', "\n".join(kept)):
+        key = line_key(paragraph)
+        if len(key) >= DUPLICATE_PARAGRAPH_MIN_CHARS and key in seen_paragraphs:
+            continue
+        seen_paragraphs.add(key)
+        paragraphs.append(paragraph)
+    return "\n\n".join(paragraphs).strip("\n")
+
+def compact_lists(text, max_items=INPUT_MAX_LIST_ITEMS):
+    """顿号、逗号等分隔的短并列项（如技能列表）去掉重复项，max_items大于0时只保留前max_items项"""
+    lines = []
+    for line in text.split("\n"):
+        label, colon, body = line.rpartition("：") if "：" in line else line.rpartition(":")
+        parts = LIST_SEPARATOR_PATTERN.split(body)
+        items = parts[::2]
+        # 只处理由多个短词组成的列表，不改动普通句子、表格和数字序列（如得分3、3、3）
+        if len(items) < 3 or not all(0 < len(item) <= 15 and not NUMERIC_ITEM_PATTERN.fullmatch(item) for item in items):
+            lines.append(line)
+            continue
+        separators = parts[1::2]
+        kept, seen = [], set()
+        for index, item in enumerate(items):
+            if item.lower() in seen:
+                continue
+            seen.add(item.lower())
+            kept.append((separators[index - 1] if index else "", item))
+        if max_items > 0 and len(kept) > max_items:
+            kept = kept[:max_items]
+            kept.append(("", "等"))
+        joined = "".join((separator if position else "") + item for position, (separator, item) in enumerate(kept))
+        lines.append(f"{label}{colon}{joined}")
+    return "\n".join(lines)
+
+def truncate_to_tokens(text, budget):
+    """截取估算token数不超过budget的最长前缀"""
+    cjk = other = 0
+    for index, ch in enumerate(text):
+        if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uf900' <= ch <= '\ufaff':
+            cjk += 1
+        else:
+            other += 1
+        if cjk + (other + 3) // 4 > budget:
+            return text[:index]
+    return text
+
+def enforce_token_budget(text, budget=INPUT_TOKEN_BUDGET):
+    """估算token数超过budget时按行保留开头部分（放不下的一行截取前半部分），并注明后面的内容已省略"""
+    if budget <= 0 or estimate_tokens(text) <= budget:
+        return text
+    limit = budget - estimate_tokens(COMPACTION_OMITTED) - 1
+    kept, used = [], 0
+    for line in text.split("\n"):
+        cost = estimate_tokens(line) + 1
+        if used + cost > limit:
+            kept.append(truncate_to_tokens(line, limit - used))
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept).rstrip() + "\n" + COMPACTION_OMITTED
+
+COMPACTION_STEPS = {
+    "unicode": compact_unicode,
+    "whitespace": compact_whitespace,
+    "boilerplate": strip_boilerplate,
+    "lists": compact_lists,
+    "budget": enforce_token_budget,
+}
+for _step in INPUT_COMPACTION:
+    if _step not in COMPACTION_STEPS:
+        logger.warning(f"忽略未知的输入压缩步骤: {_step}")
+
+def compact_question(settings):
+    """
+    调用上游前按INPUT_COMPACTION的顺序压缩简历正文，请求参数compact为false时跳过
+    压缩前后的估算token数记在settings["input_tokens"]中，并计入resume_input_tokens指标
+    """
+    question = settings["question"]
+    original_tokens = estimate_tokens(question)
+    if settings.get("compact", True):
+        for step in INPUT_COMPACTION:
+            compact = COMPACTION_STEPS.get(step)
+            if compact is not None:
+                question = compact(question)
+        # 压缩后为空（如只有不可见字符）时保留原文，交给上游处理
+        if question.strip():
+            settings["question"] = question
+    compacted_tokens = estimate_tokens(settings["question"])
+    settings["input_tokens"] = {"original": original_tokens, "compacted": compacted_tokens}
+    metrics.inc(INPUT_TOKENS, original_tokens, stage="original")
+    metrics.inc(INPUT_TOKENS, compacted_tokens, stage="compacted")
+    if compacted_tokens < original_tokens:
+        logger.info(f"输入压缩: 估算token数 {original_tokens} -> {compacted_tokens}")
+    return settings
+
+def input_token_fields(settings):
+    """响应中报告压缩前后的估算token数"""
+    tokens = settings.get("input_tokens") or {}
+    return {"originalTokens": tokens.get("original"), "compactedTokens": tokens.get("compacted")}
+
+def input_token_headers(settings):
+    """流式响应无法在正文开头附带字段，压缩前后的token数同时通过响应头返回"""
+    tokens = settings.get("input_tokens")
+    if not tokens:
+        return {}
+    return {"X-Input-Tokens-Original": str(tokens["original"]), "X-Input-Tokens-Compacted": str(tokens["compacted"])}
+
+def resolve_chat_request(data):
+    """
+    从请求数据中解析问题、系统提示词和上游配置，参数错误时返回(None, 错误响应)
+    """
+    question = data.get('question')
+    if not question:
+        logger.warning("请求中没有提供问题内容")
+        return None, (jsonify({"error": "question参数不能为空"}), 400)
+    
+    # 获取前端传入的系统提示词，如果没有则使用默认值
+    system_prompt = data.get('systemPrompt', DEFAULT_SYSTEM_PROMPT)
+    logger.info("系统提示词: %s", system_prompt, extra=VERBOSE)
+    
+    settings, error_response = resolve_upstream_settings(data)
+    if error_response is not None:
+        return None, error_response
+    settings["question"] = question
+    settings["system_prompt"] = system_prompt
+    settings["compact"] = data.get('compact') is not False
+    compact_question(settings)
+    return apply_request_scope(settings), None
+
+def resolve_upstream_settings(data):
+    """
+    解析并校验上游配置（密钥、地址、模型和采样参数），参数错误或上游熔断时返回(None, 错误响应)
+    """
+    sampling = {name: data[name] for name in SAMPLING_PARAMS if data.get(name) is not None}
+    
+    # 配置了多上游池且请求没有携带自己的密钥时，由池在调用时选择上游
+    if upstream_pool.size() and uses_server_credentials(data.get('apiKey')):
+        model = data.get('model') or current_config['model']
+        logger.info(f"使用多上游池，模型={model}")
+        if not upstream_pool.candidates(model):
+            logger.warning("多上游池中所有上游都不可用，快速失败")
+            response = jsonify({"error": "API服务暂时不可用，请稍后重试"})
+            response.headers["Retry-After"] = str(upstream_pool.retry_after())
+            return None, (response, 503)
+        return {
+            "pool": True,
+            "api_key": None,
+            "api_base": None,
+            "model": model,
+            "model_explicit": bool(data.get('model')),
+            "sampling": sampling,
+            "hedge": bool(data.get('hedge', HEDGE_ENABLED))
+        }, None
+    
+    # 使用最新保存的配置或前端传入的临时配置
+    api_key = data.get('apiKey', current_config['api_key'])
+    api_base = data.get('baseUrl', current_config['baseUrl'])
+    model = data.get('model', current_config['model'])
+    
+    logger.info(f"使用配置: API基础URL={api_base}, 模型={model}")
+    
+    if not api_key:
+        logger.error("没有提供API密钥")
+        return None, (jsonify({"error": "未设置API密钥，请在配置中设置API密钥"}), 400)
+
+    # 验证API基础URL格式
+    if not api_base.startswith(('http://', 'https://')):
+        return None, (jsonify({"error": "API地址格式错误，必须以http://或https://开头"}), 400)
+        
+    # 尝试规范化API地址，确保它指向实际的API端点而不是网站首页
+    with stage_timer(stage="url_normalize", upstream=metric_upstream(api_base)):
+        api_base = normalize_api_url(api_base)
+    logger.info(f"规范化后的API基础URL={api_base}")
+    
+    # 上游健康状态由后台线程和真实调用结果维护，这里只做快速判断
+    health_start = time.time()
+    upstream_health.register(api_base, api_key)
+    if upstream_health.auth_failed(api_base, api_key):
+        error_msg = "API密钥认证失败: 401"
+        logger.error(error_msg)
+        return None, (jsonify({"error": error_msg}), 500)
+    if not upstream_health.allow_request(api_base):
+        logger.warning(f"上游熔断中，快速失败: {api_base}")
+        response = jsonify({"error": "API服务暂时不可用，请稍后重试"})
+        response.headers["Retry-After"] = str(upstream_health.retry_after(api_base))
+        return None, (response, 503)
+    health_duration = time.time() - health_start
+    metrics.observe(CHAT_STAGE_SECONDS, health_duration, stage="health_gate", upstream=metric_upstream(api_base))
+    record_span("health_gate", health_duration, metric_upstream(api_base))
+    
+    return {
+        "api_key": api_key,
+        "api_base": api_base,
+        "model": model,
+        "sampling": sampling,
+        "hedge": bool(data.get('hedge', HEDGE_ENABLED))
+    }, None
+
+def uses_server_credentials(api_key):
+    """请求未携带密钥，或携带的是服务端配置的密钥（含前端回显的脱敏形式）"""
+    if not api_key:
+        return True
+    if current_config['api_key'] and api_key in (current_config['api_key'], mask_api_key(current_config['api_key'])):
+        return True
+    return upstream_pool.has_key(api_key)
+
+@contextmanager
+def acquire_chat_client(api_key, api_base):
+    """从连接池获取复用的上游客户端，避免每次请求重新建立TCP+TLS连接"""
+    with client_pool.acquire(api_key, api_base) as upstream:
+        if upstream.openai_client is not None:
+            client = upstream.openai_client
+        else:
+            # 设置全局配置 (openai < 1.0.0)
+            openai.api_key = api_key
+            openai.api_base = api_base
+            client = openai  # 在旧版中，直接使用openai模块
+            logger.info("已使用兼容模式设置OpenAI客户端")
+        yield upstream, client
+
+class InflightCall:
+    """
+    一次进行中的上游调用，同时到达的相同请求订阅它的增量输出和最终结果
+    """
+    def __init__(self, key, streaming):
+        self.key = key
+        self.streaming = streaming
+        self.chunks = []
+        self.done = False
+        self.answer = None
+        self.error = None
+        self.followers = 0
+        self.subscribers = 0
+        self.upstream = None  # 实际服务该请求的上游
+        self.cancel_scope = CancelScope()  # 所有订阅者都离开后取消上游调用
+        self._cond = threading.Condition()
+
+    def subscribe(self, scope=None):
+        """
+        登记一个订阅者；scope（请求的取消范围）被取消时该订阅者离开，
+        所有订阅者都离开而调用仍未结束时取消上游调用，只要还有订阅者就继续为它们调用
+        """
+        with self._cond:
+            self.subscribers += 1
+        if scope is None:
+            return
+        
+        def leave():
+            with self._cond:
+                self.subscribers -= 1
+                abandoned = self.subscribers <= 0 and not self.done
+                self._cond.notify_all()
+            if abandoned:
+                logger.info(f"所有请求都已取消（{scope.reason}），中止进行中的上游调用")
+                self.cancel_scope.cancel(scope.reason)
+        scope.on_cancel(leave)
+
+    def publish(self, delta):
+        with self._cond:
+            self.chunks.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, answer=None, error=None):
+        with self._cond:
+            self.answer = answer
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    @staticmethod
+    def _cancelled(scope):
+        return scope is not None and scope.is_set()
+
+    def wait(self, timeout=None, scope=None):
+        """阻塞等待调用结束，返回完整答案或抛出调用失败的错误；scope被取消时不再等待"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.done or self._cancelled(scope), timeout):
+                raise TimeoutError("等待相同请求的结果超时")
+            if not self.done:
+                raise UpstreamCallCancelled(f"请求已取消（{scope.reason}）", scope.reason)
+            if self.error is not None:
+                raise self.error
+            return self.answer
+
+    def iter_deltas(self, timeout=None, scope=None):
+        """依次产出已发布和后续发布的增量文本，调用失败时抛出错误；scope被取消时不再等待"""
+        index = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: index < len(self.chunks) or self.done or self._cancelled(scope), timeout):
+                    raise TimeoutError("等待相同请求的结果超时")
+                if self._cancelled(scope) and not self.done:
+                    raise UpstreamCallCancelled(f"请求已取消（{scope.reason}）", scope.reason)
+                pending = self.chunks[index:]
+                index = len(self.chunks)
+                finished = self.done
+            for delta in pending:
+                yield delta
+            if finished and index >= len(self.chunks):
+                break
+        if self.error is not None:
+            raise self.error
+        if index == 0 and self.answer:
+            # 非流式调用没有增量输出，结束后一次性产出完整答案
+            yield self.answer
+
+
+class SingleFlight:
+    """
+    合并进行中的相同请求：同一个键同一时间只有一个请求真正调用上游
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.shared = 0
+
+    def join(self, key, streaming=False):
+        """返回(调用, 是否为发起者)；已有相同请求在进行时加入它"""
+        with self._lock:
+            call = self._calls.get(key)
+            # 已被取消的调用即将失败，不再让新请求加入
+            if call is not None and not call.cancel_scope.is_set():
+                call.followers += 1
+                self.shared += 1
+                return call, False
+            call = InflightCall(key, streaming)
+            self._calls[key] = call
+            self.leaders += 1
+            return call, True
+
+    def forget(self, call):
+        with self._lock:
+            if self._calls.get(call.key) is call:
+                del self._calls[call.key]
+
+    def stats(self):
+        with self._lock:
+            return {"inflight": len(self._calls), "leaders": self.leaders, "shared": self.shared}
+
+chat_singleflight = SingleFlight()
+
+def parse_retry_after(headers):
+    """解析Retry-After响应头（秒数或HTTP日期），缺失或无法解析时返回None"""
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_upstream_error(error):
+    """
+    判断上游错误的处理方式，返回(类别, Retry-After秒数)
+    类别: retryable（稍后重试）、protocol（该调用方式不可用，换下一种）、fatal（直接失败）
+    """
+    status_code, headers = None, None
+    if isinstance(error, UpstreamHTTPError):
+        status_code, headers = error.status_code, error.headers
+    elif isinstance(error, openai.APIStatusError):
+        status_code, headers = error.status_code, error.response.headers
+    if status_code is not None:
+        if status_code in (404, 405, 415, 501):
+            return "protocol", None
+        if status_code in (408, 409, 429) or status_code >= 500:
+            return "retryable", parse_retry_after(headers)
+        return "fatal", None
+    if isinstance(error, (openai.APIConnectionError, requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return "retryable", None
+    if isinstance(error, (AttributeError, ImportError, TypeError, ValueError, openai.APIResponseValidationError)):
+        # SDK不兼容或上游返回了无法解析的内容（例如HTML页面）
+        return "protocol", None
+    return "fatal", None
+
+def compute_retry_delay(attempt, retry_after=None):
+    """第attempt次失败后的等待时间：带完全抖动的指数退避，上游给出Retry-After时至少等待该时间"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1))))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def timed_invoke(invoke, settings, upstream, client, protocol, timeout):
+    """执行一次上游调用，记录耗时、响应状态和token用量指标"""
+    upstream_label = metric_upstream(settings)
+    start_time = time.time()
+    try:
+        answer = invoke(upstream, client, protocol, timeout)
+    except Exception as e:
+        duration = time.time() - start_time
+        cancel_event = settings.get("cancel_event")
+        if cancel_event is not None and cancel_event.is_set():
+            # 取消时关闭连接引起的读取错误也记为cancelled
+            status = "cancelled"
+            metrics.inc(UPSTREAM_CANCELLATIONS, upstream=upstream_label,
+                        reason=getattr(cancel_event, "reason", None) or "cancelled", stage="inflight")
+        else:
+            status = upstream_status_label(e)
+        metrics.observe(UPSTREAM_CALL_SECONDS, duration,
+                        upstream=upstream_label, model=settings["model"], protocol=protocol, outcome="error")
+        metrics.inc(UPSTREAM_RESPONSES, upstream=upstream_label, protocol=protocol, status=status)
+        record_span("upstream", duration, f"{upstream_label} {protocol} {status}")
+        raise
+    duration = time.time() - start_time
+    metrics.observe(UPSTREAM_CALL_SECONDS, duration,
+                    upstream=upstream_label, model=settings["model"], protocol=protocol, outcome="ok")
+    metrics.inc(UPSTREAM_RESPONSES, upstream=upstream_label, protocol=protocol, status="200")
+    record_span("upstream", duration, f"{upstream_label} {protocol} 200")
+    usage = settings.pop("usage", None)
+    if usage is None:
+        usage = (estimate_tokens(settings.get("system_prompt")) + estimate_tokens(settings.get("question")),
+                 estimate_tokens(answer))
+    metrics.inc(TOKENS_CONSUMED, usage[0], upstream=upstream_label, model=settings["model"], kind="prompt")
+    metrics.inc(TOKENS_CONSUMED, usage[1], upstream=upstream_label, model=settings["model"], kind="completion")
+    return answer
+
+def extract_usage(response_obj):
+    """读取上游返回的token用量，返回(提示词token数, 输出token数)，没有时返回None"""
+    usage = response_obj.get("usage") if isinstance(response_obj, dict) else getattr(response_obj, "usage", None)
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = {"prompt_tokens": getattr(usage, "prompt_tokens", None), "completion_tokens": getattr(usage, "completion_tokens", None)}
+    try:
+        return int(usage["prompt_tokens"]), int(usage["completion_tokens"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def call_upstream_with_retries(settings, invoke, can_retry=None):
+    """
+    统一的上游重试引擎：按协议记忆的顺序尝试各调用方式，可重试错误按带抖动的指数退避重试，
+    遵守Retry-After、请求总时限（settings["deadline"]，默认CHAT_DEADLINE秒）和最多尝试次数（settings["max_attempts"]）
+    invoke(upstream, client, protocol, timeout)执行一次调用并返回答案；
+    can_retry返回False时（例如流式已输出内容）不再换方式或重试
+    """
+    api_base = settings["api_base"]
+    deadline = settings.get("deadline") or time.time() + CHAT_DEADLINE
+    max_attempts = settings.get("max_attempts") or RETRY_MAX_ATTEMPTS
+    tokens = estimate_request_tokens(settings)
+    acquire_start = time.time()
+    with acquire_chat_client(settings["api_key"], api_base) as (upstream, client):
+        acquire_duration = time.time() - acquire_start
+        metrics.observe(CHAT_STAGE_SECONDS, acquire_duration, stage="client_acquire", upstream=metric_upstream(settings))
+        record_span("client_acquire", acquire_duration, metric_upstream(settings))
+        protocols = protocol_memory.order(api_base)
+        attempt = 0
+        while True:
+            attempt += 1
+            last_error, kind, retry_after = None, None, None
+            for protocol in protocols:
+                check_cancelled(settings)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise UpstreamDeadlineError(f"请求超过总时限{CHAT_DEADLINE:g}秒仍未完成: {str(last_error)}")
+                try:
+                    # 调用前先占用限流额度，超限时排队或直接拒绝
+                    with rate_limiter.acquire(api_base, settings["api_key"], tokens, deadline):
+                        answer = timed_invoke(invoke, settings, upstream, client, protocol, min(API_TIMEOUT, remaining))
+                except Exception as e:
+                    cancel_event = settings.get("cancel_event")
+                    if isinstance(cancel_event, CancelScope) and settings.get("deadline") and time.time() >= settings["deadline"]:
+                        # 单次调用的超时与截止时间同时到达，按超过截止时间取消
+                        cancel_event.cancel("deadline")
+                    # 取消引起的错误与上游无关，不计入失败，也不换调用方式
+                    check_cancelled(settings)
+                    last_error = e
+                    kind, retry_after = classify_upstream_error(e)
+                    upstream_health.record_failure(api_base, e)
+                    logger.warning(f"调用方式{protocol}失败（{kind}）: {str(e)}")
+                    if kind == "protocol" and (can_retry is None or can_retry()):
+                        protocol_memory.forget(api_base, protocol)
+                        metrics.inc(PROTOCOL_FALLBACKS, upstream=metric_upstream(settings), protocol=protocol)
+                        continue
+                    # 下一轮重试直接从出错的方式开始，不再重复已确认不可用的方式
+                    protocols = [protocol] + [p for p in protocols if p != protocol]
+                    break
+                protocol_memory.remember(api_base, protocol)
+                upstream_health.record_success(api_base)
+                return answer
+            
+            # 所有调用方式都不适用或遇到不可重试的错误时直接失败
+            if kind != "retryable" or (can_retry is not None and not can_retry()):
+                raise last_error
+            if attempt >= max_attempts:
+                logger.error(f"已达到最大尝试次数{max_attempts}")
+                raise last_error
+            if not upstream_health.allow_request(api_base):
+                logger.warning("上游已熔断，停止重试")
+                raise last_error
+            delay = compute_retry_delay(attempt, retry_after)
+            if time.time() + delay >= deadline:
+                logger.warning(f"剩余时间不足以等待{delay:.2f}秒后重试，放弃重试")
+                raise last_error
+            logger.warning(f"API调用失败，{delay:.2f}秒后重试 {attempt}/{max_attempts - 1}: {str(last_error)}")
+            metrics.inc(UPSTREAM_RETRIES, upstream=metric_upstream(settings), model=settings["model"])
+            cancel_event = settings.get("cancel_event")
+            if cancel_event is not None:
+                # 等待期间被取消时立即停止重试
+                if cancel_event.wait(delay):
+                    metrics.inc(UPSTREAM_CANCELLATIONS, upstream=metric_upstream(settings),
+                                reason=getattr(cancel_event, "reason", None) or "cancelled", stage="retry")
+                    check_cancelled(settings)
+            else:
+                time.sleep(delay)
+
+def run_with_failover(settings, run, can_fail_over=None):
+    """
+    多上游池模式下依次尝试选出的上游：run(upstream_settings)失败且错误与请求本身无关时切换到下一个上游，
+    同一请求的所有上游共享总时限；非池模式直接在配置的上游上执行。实际服务的上游记录在settings["served_by"]
+    """
+    if not settings.get("pool"):
+        answer = run(settings)
+        settings["served_by"] = settings["api_base"]
+        return answer
+    
+    deadline = settings.get("deadline") or time.time() + CHAT_DEADLINE
+    candidates = upstream_pool.candidates(settings["model"], settings.get("model_explicit", True))
+    avoid = settings.get("avoid_upstream")
+    if avoid and len(candidates) > 1:
+        # 对冲请求优先发往主请求之外的上游
+        candidates = [c for c in candidates if c["name"] != avoid] + [c for c in candidates if c["name"] == avoid]
+    candidates = candidates[:UPSTREAM_MAX_FAILOVER]
+    if not candidates:
+        raise UpstreamHTTPError("多上游池中没有可用的上游", 503, {"Retry-After": str(upstream_pool.retry_after())})
+    last_error = None
+    for index, candidate in enumerate(candidates):
+        is_last = index == len(candidates) - 1
+        upstream_settings = dict(
+            settings,
+            api_key=candidate["apiKey"],
+            api_base=candidate["baseUrl"],
+            model=candidate["model"],
+            upstream_name=candidate["name"],
+            deadline=deadline,
+            # 还有其它上游可切换时不在当前上游上反复重试
+            max_attempts=None if is_last else 1
+        )
+        logger.info(f"使用上游: {candidate['name']}")
+        settings["current_upstream"] = candidate["name"]
+        try:
+            with upstream_pool.track(candidate["name"]):
+                answer = run(upstream_settings)
+        except Exception as e:
+            last_error = e
+            if is_last or isinstance(e, (UpstreamDeadlineError, UpstreamCallCancelled)) or time.time() >= deadline:
+                break
+            if can_fail_over is not None and not can_fail_over():
+                break
+            status_code = getattr(e, "status_code", None)
+            if status_code in (400, 413, 422):
+                # 请求本身有问题，换上游也不会成功
+                break
+            logger.warning(f"上游{candidate['name']}调用失败，切换到下一个上游: {str(e)}")
+            metrics.inc(UPSTREAM_FAILOVERS, upstream=candidate["name"])
+            continue
+        settings["served_by"] = candidate["name"]
+        return answer
+    raise last_error
+
+def stream_with_failover(settings, on_delta, restartable=False):
+    """
+    流式调用上游（含重试和切换上游），每段增量文本交给on_delta，返回完整答案；只在尚未输出任何内容时重试
+    restartable为true时（增量文本不会发给客户端）输出部分内容后仍可重试，重试时丢弃已收到的内容
+    """
+    parts = []
+    
+    def run(upstream_settings):
+        def invoke(upstream, client, protocol, timeout):
+            if restartable:
+                parts.clear()
+            attempt_start = time.time()
+            for delta in stream_chat_answer(upstream, client, upstream_settings, protocol, timeout):
+                if not parts:
+                    hedge_controller.observe(time.time() - attempt_start)
+                on_delta(delta)
+                parts.append(delta)
+            return "".join(parts)
+        return call_upstream_with_retries(upstream_settings, invoke, can_retry=lambda: restartable or not parts)
+    
+    # 已经输出部分内容后重试或切换上游会导致重复文本
+    return run_with_failover(settings, run, can_fail_over=lambda: restartable or not parts)
+
+def run_hedged(settings, on_delta):
+    """
+    对冲模式：主请求在最近首个分片延迟的分位数内还没有产出内容时，再发出一个相同的请求
+    （多上游池中优先发往另一个上游），先产出首个分片的一方胜出并继续输出，另一方被取消
+    """
+    hedge_controller.record_call()
+    delay = hedge_controller.delay()
+    results = queue.Queue()
+    lock = threading.Lock()
+    racers = []
+    state = {"winner": None}
+    
+    def forward(index, delta):
+        with lock:
+            if state["winner"] is None:
+                state["winner"] = index
+                for other, racer_settings in enumerate(racers):
+                    if other != index:
+                        racer_settings["cancel_event"].cancel("hedge")
+            elif state["winner"] != index:
+                raise UpstreamCallCancelled("对冲请求已由另一方胜出")
+        on_delta(delta)
+    
+    def launch(racer_settings):
+        index = len(racers)
+        racers.append(racer_settings)
+        
+        def race():
+            try:
+                answer = stream_with_failover(racer_settings, lambda delta: forward(index, delta))
+                results.put((index, answer, None))
+            except Exception as e:
+                results.put((index, None, e))
+        threading.Thread(target=run_in_context(race), name=f"chat-hedge-{index}", daemon=True).start()
+    
+    launch(dict(settings, cancel_event=CancelScope(settings.get("cancel_event"))))
+    hedge_at = time.time() + delay if delay is not None else None
+    pending = 1
+    errors = []
+    while pending:
+        timeout = max(0.0, hedge_at - time.time()) if hedge_at is not None else None
+        try:
+            index, answer, error = results.get(timeout=timeout)
+        except queue.Empty:
+            hedge_at = None
+            with lock:
+                has_winner = state["winner"] is not None
+            if not has_winner and hedge_controller.try_spend(estimate_request_tokens(settings)):
+                logger.info(f"主请求{delay:.2f}秒内没有产出内容，发出对冲请求")
+                launch(dict(settings, cancel_event=CancelScope(settings.get("cancel_event")),
+                            avoid_upstream=racers[0].get("current_upstream")))
+                pending += 1
+            continue
+        pending -= 1
+        with lock:
+            winner = state["winner"]
+            if error is None and winner is None:
+                # 上游返回了空答案，同样视为胜出
+                state["winner"] = winner = index
+        if winner == index:
+            for other, racer_settings in enumerate(racers):
+                if other != index:
+                    racer_settings["cancel_event"].cancel("hedge")
+            if error is not None:
+                raise error
+            if index > 0:
+                hedge_controller.record("hedgeWins")
+            if len(racers) > 1:
+                hedge_controller.record("cancelled")
+            settings["served_by"] = racers[index].get("served_by")
+            return answer
+        if not isinstance(error, UpstreamCallCancelled):
+            errors.append(error)
+    if errors:
+        raise errors[0]
+    check_cancelled(settings)
+    raise UpstreamCallCancelled("对冲请求均已取消")
 
-@app.route('/save_config', methods=['POST'])
-def save_config():
+def complete_chat(settings):
+    """
+    非流式请求获取完整答案（含重试），重试失败时抛出最后一次的错误
+    内部使用流式调用：非流式上游调用在生成结束前拿不到响应对象，无法在客户端断开或超过截止时间时中止；
+    上游忽略stream参数返回JSON时由stream_chat_answer按JSON解析，没有内容时按调用方式不可用换下一种
+    """
+    # 开始调用API
+    logger.info("开始调用OpenAI API")
+    
     try:
-        data = request.get_json()
-        logger.info(f"收到配置数据: {data}")
-        
-        # 更新全局配置
-        if 'apiKey' in data and data['apiKey']:
-            current_config['api_key'] = data['apiKey']
-            logger.info("API密钥已更新")
-        
-        if 'baseUrl' in data and data['baseUrl']:
-            current_config['baseUrl'] = data['baseUrl']
-            logger.info(f"API基础URL已更新为: {data['baseUrl']}")
-            
-        if 'model' in data and data['model']:
-            current_config['model'] = data['model']
-            logger.info(f"模型已更新为: {data['model']}")
-            
-        logger.info(f"当前配置: {current_config}")
-        return jsonify({"message": "配置更新成功", "config": current_config})
+        if settings.get("hedge"):
+            # 对冲需要在首个分片到达时判定胜负并取消另一方
+            return run_hedged(settings, lambda delta: None)
+        return stream_with_failover(settings, lambda delta: None, restartable=True)
+    except UpstreamCallCancelled as e:
+        logger.info(f"API调用已取消: {str(e)}")
+        raise
     except Exception as e:
-        logger.error(f"保存配置时出错: {str(e)}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        logger.error(f"API调用失败: {str(e)}")
+        raise
 
-def normalize_api_url(base_url):
+def produce_streaming_chat(settings, call, start_time):
     """
-    尝试规范化API基础URL，确保它指向正确的API端点而不是前端页面
+    流式调用上游并把增量文本发布给所有订阅者，只在尚未输出任何内容时重试
     """
-    original_url = base_url
-    logger.info(f"规范化API URL: {base_url}")
+    first_token = []
     
-    # 移除尾部斜杠
-    base_url = base_url.rstrip('/')
+    def publish(delta):
+        if not first_token:
+            first_token.append(time.time())
+            logger.info(f"首个分片耗时: {first_token[0] - start_time:.2f}秒")
+        call.publish(delta)
     
-    # 如果URL已经以/v1结尾，则无需处理
-    if base_url.endswith('/v1'):
-        logger.info(f"URL已经以/v1结尾，保持不变: {base_url}")
-        return base_url
+    try:
+        if settings.get("hedge"):
+            return run_hedged(settings, publish)
+        return stream_with_failover(settings, publish)
+    except UpstreamCallCancelled as e:
+        logger.info(f"流式API调用已取消: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"流式API调用失败: {str(e)}")
+        raise
+    finally:
+        logger.info(f"流式上游调用总耗时: {time.time() - start_time:.2f}秒")
+
+def run_inflight_call(settings, call, start_time):
+    """作为发起者执行上游调用，结果写入缓存后通知所有等待者"""
+    answer, error = None, None
+    try:
+        if call.streaming:
+            answer = produce_streaming_chat(settings, call, start_time)
+        else:
+            answer = complete_chat(settings)
+        call.upstream = settings.get("served_by")
+        response_cache.set(settings["cache_key"], answer)
+        if settings.get("fingerprint"):
+            scope, signature, guard = settings["fingerprint"]
+            near_duplicate_index.add(scope, signature, answer, guard)
+    except Exception as e:
+        error = e
+    finally:
+        chat_singleflight.forget(call)
+        call.finish(answer, error)
+
+def get_chat_answer(settings, bypass_cache=False):
+    """
+    非流式获取答案：依次查询响应缓存、合并进行中的相同请求、调用上游
+    返回(答案, 元信息)，元信息包含cached、shared标记和实际服务的上游upstream
+    """
+    cache_key = make_response_cache_key(settings)
+    settings["cache_key"] = cache_key
+    if bypass_cache:
+        response_cache.record_bypass()
+    else:
+        cached_answer = response_cache.get(cache_key)
+        if cached_answer is not None:
+            return cached_answer, {"cached": True, "shared": False, "upstream": None}
+    near_answer, similarity = resolve_near_duplicate(settings, bypass_cache)
+    if near_answer is not None:
+        return near_answer, {"cached": True, "shared": False, "upstream": None, "similarity": similarity}
+    # 排队中的分段或批量条目在请求取消后不再调用上游
+    check_cancelled(settings)
     
-    # 如果URL看起来像网站首页，尝试添加可能的API路径
-    # 检查URL路径部分是否为空或仅为 /
-    parsed_url = urlparse(base_url)
-    path = parsed_url.path
-    
-    if path == "" or path == "/":
-        # 可能是网站首页，尝试添加常见的API路径
-        possible_api_paths = [
-            "/v1",              # OpenAI 标准路径
-            "/api/v1",          # 常见API路径格式
-            "/api",             # 简单API路径
-            "/openai/v1"        # 一些代理使用这种格式
-        ]
-        
-        # 记录规范化前的URL
-        logger.info(f"API URL看起来像网站首页: {base_url}")
-        logger.info(f"尝试以下可能的API路径: {possible_api_paths}")
+    scope = settings.get("cancel_event")
+    call, leader = chat_singleflight.join(cache_key)
+    call.subscribe(scope)
+    if leader:
+        run_inflight_call(dict(settings, cancel_event=call.cancel_scope), call, time.time())
+    answer = call.wait(SINGLEFLIGHT_WAIT_TIMEOUT, scope)
+    meta = {"cached": False, "shared": not leader, "upstream": call.upstream}
+    if similarity is not None:
+        meta["similarity"] = similarity
+    return answer, meta
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    start_time = time.time()
+    try:
+        data = request.get_json()
+        logger.info("收到聊天请求")
         
-        # 尝试直接检测/v1/chat/completions接口是否可用
-        direct_chat_endpoint = f"{base_url}/v1/chat/completions"
-        logger.info(f"直接测试chat completions端点: {direct_chat_endpoint}")
+        settings, error_response = resolve_chat_request(data)
+        if error_response is not None:
+            return error_response
         
-        try:
-            # 仅发送简单HEAD请求测试端点是否存在
-            response = requests.head(
-                direct_chat_endpoint,
-                timeout=5,
-                headers={"Accept": "application/json"}
-            )
-            
-            # 如果状态码不是404，该端点可能存在
-            if response.status_code != 404:
-                logger.info(f"找到可能的chat completions端点: {base_url}/v1")
-                return f"{base_url}/v1"
-        except Exception as e:
-            logger.warning(f"测试chat completions端点失败: {str(e)}")
+        streaming = bool(data.get('stream'))
+        bypass_cache = should_bypass_cache(data)
+        chunks = resolve_sections(data, settings)
         
-        # 继续测试其他可能的API路径
-        for api_path in possible_api_paths:
-            test_url = f"{base_url}{api_path}"
-            logger.info(f"测试API路径: {test_url}")
-            
-            # 首先尝试测试chat completions端点
+        if not streaming:
             try:
-                if api_path.endswith('/v1'):
-                    # 如果路径已包含/v1，则直接添加/chat/completions
-                    chat_endpoint = f"{test_url}/chat/completions"
+                if chunks:
+                    answer, meta = get_sectioned_answer(settings, chunks, bypass_cache)
                 else:
-                    # 否则添加完整路径/v1/chat/completions
-                    chat_endpoint = f"{test_url}/v1/chat/completions"
-                
-                logger.info(f"测试聊天端点: {chat_endpoint}")
-                response = requests.head(
-                    chat_endpoint, 
-                    timeout=5,
-                    headers={"Accept": "application/json"}
-                )
-                
-                # 如果chat/completions端点可能存在
-                if response.status_code != 404:
-                    logger.info(f"找到可能的API路径(chat/completions): {test_url}")
-                    return test_url
+                    answer, meta = get_chat_answer(settings, bypass_cache)
+            except RateLimitExceeded as e:
+                metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="json", result="error")
+                response = jsonify({"error": str(e)})
+                response.headers["Retry-After"] = str(e.retry_after)
+                return response, 429
+            except UpstreamCallCancelled as e:
+                metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="json", result="cancelled")
+                logger.info(f"请求已取消: {str(e)}")
+                return cancelled_response(e.reason)
             except Exception as e:
-                logger.warning(f"测试chat completions端点失败: {test_url}/chat/completions, 错误: {str(e)}")
+                metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="json", result="error")
+                return jsonify({"error": f"OpenAI API调用失败: {str(e)}"}), 500
+            metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="json",
+                            result="bypass" if bypass_cache else ("hit" if meta["cached"] else "miss"))
             
-            # 然后尝试通用models端点
-            try:
-                response = requests.get(
-                    f"{test_url}/models", 
-                    timeout=5,
-                    headers={"Accept": "application/json"}
-                )
-                
-                # 如果返回JSON并且不是HTML，可能是有效的API端点
-                if response.headers.get('content-type', '').startswith('application/json'):
-                    logger.info(f"找到有效的API路径: {test_url}")
-                    return test_url
-                elif not response.text.strip().startswith(('<!DOCTYPE', '<html')):
-                    logger.info(f"可能的API路径: {test_url}")
-                    return test_url
-            except Exception as e:
-                logger.warning(f"测试API路径失败: {test_url}, 错误: {str(e)}")
+            if meta["cached"]:
+                logger.info("命中响应缓存，直接返回")
+            else:
+                logger.info(f"成功获取API响应，总耗时: {time.time() - start_time:.2f}秒")
+            response = jsonify({"answer": answer, **meta, **input_token_fields(settings)})
+            response.headers["X-Cache"] = cache_header(bypass_cache, meta)
+            response.headers.update(input_token_headers(settings))
+            if meta["upstream"]:
+                response.headers["X-Upstream"] = meta["upstream"]
+            return response
+        
+        logger.info("使用流式输出模式")
+        
+        if chunks:
+            cache_status = "BYPASS" if bypass_cache else "MISS"
+            return sse_response(stream_sectioned_events(settings, chunks, bypass_cache, start_time), cache_status, settings)
+        
+        # 相同请求直接返回缓存的优化结果
+        cache_key = make_response_cache_key(settings)
+        settings["cache_key"] = cache_key
+        if bypass_cache:
+            response_cache.record_bypass()
+        else:
+            cached_answer = response_cache.get(cache_key)
+            if cached_answer is not None:
+                logger.info("命中响应缓存，直接返回")
+                metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="stream", result="hit")
+                return sse_response(iter_cached_events(cached_answer), "HIT", settings)
+        near_answer, similarity = resolve_near_duplicate(settings, bypass_cache)
+        if near_answer is not None:
+            metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="stream", result="hit")
+            return sse_response(iter_cached_events(near_answer, similarity), "NEAR", settings)
+        cache_status = "BYPASS" if bypass_cache else "MISS"
+        
+        # 相同请求正在进行时不再重复调用上游，而是等待并共享它的结果
+        scope = settings.get("cancel_event")
+        call, leader = chat_singleflight.join(cache_key, streaming=True)
+        call.subscribe(scope)
+        if leader:
+            threading.Thread(
+                target=run_in_context(run_inflight_call), args=(dict(settings, cancel_event=call.cancel_scope), call, start_time),
+                name="chat-stream", daemon=True
+            ).start()
+        else:
+            logger.info("相同请求正在处理中，等待共享结果")
+        events = stream_chat_events(call, start_time, shared=not leader, cache_status=cache_status, scope=scope)
+        return sse_response(events, cache_status, settings)
+
+    except Exception as e:
+        logger.error(f"处理聊天请求时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        logger.info(f"请求处理总耗时: {time.time() - start_time:.2f}秒")
+
+def sse_response(events, cache_status, settings=None):
+    """把SSE事件生成器包装为流式响应"""
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": cache_status}
+    headers.update(input_token_headers(settings or {}))
+    return Response(stream_with_context(events), mimetype='text/event-stream', headers=headers)
+
+def iter_cached_events(cached_answer, similarity=None):
+    """命中缓存时一次性输出完整答案；命中近似重复缓存时附带相似度"""
+    yield format_sse({"content": cached_answer})
+    done = {"done": True, "cached": True}
+    if similarity is not None:
+        done["similarity"] = similarity
+    yield format_sse(done)
+
+def cache_header(bypass_cache, meta):
+    """X-Cache响应头：BYPASS、HIT、NEAR（命中近似重复缓存）或MISS"""
+    if bypass_cache:
+        return "BYPASS"
+    if meta["cached"]:
+        return "NEAR" if meta.get("similarity") is not None else "HIT"
+    return "MISS"
+
+def stream_chat_events(call, start_time, shared=False, cache_status="MISS", scope=None):
+    """
+    流式模式下的SSE事件生成器：转发进行中调用的增量文本
+    """
+    result = cache_status.lower()
+    try:
+        for delta in call.iter_deltas(SINGLEFLIGHT_WAIT_TIMEOUT, scope):
+            yield format_sse({"content": delta})
+        yield format_sse({"done": True, "cached": False, "shared": shared, "upstream": call.upstream})
+    except GeneratorExit:
+        logger.info("客户端断开连接，停止流式输出")
+        result = "cancelled"
+        cancel_request("disconnect")
+        raise
+    except UpstreamCallCancelled as e:
+        result = "cancelled"
+        logger.info(f"请求已取消: {str(e)}")
+        yield format_sse({"error": "请求超过截止时间，已取消" if e.reason == "deadline" else "请求已取消"})
+    except Exception as e:
+        result = "error"
+        logger.error(f"流式API调用失败: {str(e)}")
+        yield format_sse({"error": f"OpenAI API调用失败: {str(e)}"})
+    finally:
+        metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="stream", result=result)
+        logger.info(f"流式请求处理总耗时: {time.time() - start_time:.2f}秒")
+
+def get_upstream_semaphore(api_base, limit=UPSTREAM_MAX_CONCURRENCY):
+    """每个上游一个信号量，限制批量任务对同一上游的并发调用数"""
+    key = api_base.rstrip('/')
+    with _upstream_semaphores_lock:
+        semaphore = _upstream_semaphores.get(key)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(limit)
+            _upstream_semaphores[key] = semaphore
+        return semaphore
+
+def run_batch_item(index, item, base_settings, default_system_prompt, bypass_cache):
+    """处理批量请求中的一项，返回该项的结果字典（失败时包含error）"""
+    if isinstance(item, str):
+        item = {"question": item}
+    question = item.get('question') if isinstance(item, dict) else None
+    if not question:
+        return {"index": index, "error": "question参数不能为空"}
     
-    # 如果没有找到更好的路径，返回原始URL
-    if original_url != base_url:
-        logger.info(f"使用规范化的URL: {base_url}")
-        return base_url
+    settings = dict(base_settings)
+    settings["question"] = question
+    settings["system_prompt"] = item.get('systemPrompt') or default_system_prompt
+    if item.get('compact') is not None:
+        settings["compact"] = item['compact'] is not False
+    compact_question(settings)
+    try:
+        with get_batch_semaphore(settings):
+            answer, meta = get_chat_answer(settings, bypass_cache)
+        return {"index": index, "answer": answer, **meta, **input_token_fields(settings)}
+    except Exception as e:
+        logger.warning(f"批量请求第{index}项失败: {str(e)}")
+        return {"index": index, "error": f"OpenAI API调用失败: {str(e)}"}
+
+# 简历中常见的分节标题，可带Markdown标记、【】、序号和冒号
+SECTION_HEADING_PATTERN = re.compile(
+    r'\s*(?:#{1,6}\s*)?(?:\*\*)?[【\[]?\s*(?:[一二三四五六七八九十]+[、.．]|\d+[、.．])?\s*'
+    r'(教育背景|教育经历|教育|工作经历|工作经验|实习经历|实习经验|项目经历|项目经验|校园经历|社团经历|学生工作|'
+    r'科研经历|研究经历|专业技能|技能特长|技能|证书|荣誉奖项|获奖情况|获奖经历|自我评价|个人总结|个人简介|'
+    r'个人信息|基本信息|求职意向|education|work experience|experience|employment|internships?|projects?|'
+    r'skills|summary|profile|awards|certifications?|publications|activities)'
+    r'\s*[】\]]?(?:\*\*)?\s*[:：]?\s*',
+    re.IGNORECASE
+)
+# 以年份开头的行（如2021.07-2022.06、2020年9月）通常是一段新经历的开始
+ENTRY_START_PATTERN = re.compile(r'\s*(?:\d{4}\s*[年./\-]|\d{4}\s*[-–—~至]\s*(?:\d{4}|至今|present))', re.IGNORECASE)
+
+def split_resume_sections(text):
+    """
+    把简历按分节标题切成若干部分，每部分再按空行或以日期开头的行切成条目（每段经历、每个项目）
+    返回[[条目文本, ...], ...]，标题行归入该部分的第一个条目
+    """
+    sections, entries, current = [], [], []
     
-    logger.info(f"保持原始URL不变: {original_url}")
-    return original_url
+    def close_entry():
+        if current:
+            entries.append("\n".join(current))
+        current.clear()
+    
+    def has_body():
+        # 只有标题行时不切分，让标题和第一个条目在一起
+        return bool(current) and not (len(current) == 1 and SECTION_HEADING_PATTERN.fullmatch(current[0]))
+    
+    for line in text.splitlines():
+        if SECTION_HEADING_PATTERN.fullmatch(line):
+            close_entry()
+            if entries:
+                sections.append(entries)
+            entries = []
+            current.append(line)
+        elif not line.strip():
+            if has_body():
+                close_entry()
+        elif ENTRY_START_PATTERN.match(line) and has_body():
+            close_entry()
+            current.append(line)
+        else:
+            current.append(line)
+    close_entry()
+    if entries:
+        sections.append(entries)
+    return sections
 
-@app.route('/chat', methods=['POST'])
-def chat():
+def split_oversized_entry(entry, max_tokens):
+    """超过max_tokens的条目按行切开，每块不超过max_tokens（单行超长时保持整行）"""
+    pieces, current, current_tokens = [], [], 0
+    for line in entry.split("\n"):
+        line_tokens = estimate_tokens(line) + 1
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+def plan_resume_sections(text, min_tokens=SECTION_MIN_TOKENS, max_tokens=SECTION_MAX_TOKENS):
+    """
+    把简历切成可以并行改写的片段，按原文顺序返回
+    同一部分中不足min_tokens的条目与后面的条目合并，超过max_tokens的条目按行切开
+    """
+    chunks = []
+    for entries in split_resume_sections(text):
+        current, current_tokens = [], 0
+        for entry in entries:
+            for piece in split_oversized_entry(entry, max_tokens):
+                piece_tokens = estimate_tokens(piece)
+                if current and (current_tokens >= min_tokens or current_tokens + piece_tokens > max_tokens):
+                    chunks.append("\n\n".join(current))
+                    current, current_tokens = [], 0
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            chunks.append("\n\n".join(current))
+    return chunks
+
+def normalize_paragraph(text):
+    """规范化段落的空白（行内连续空格、行首尾空格、空行），只改动空白的段落指纹不变"""
+    lines = (re.sub(r'[ \t\u3000]+', ' ', line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def resolve_sections(data, settings):
+    """
+    判断本次请求是否分段优化：请求参数sectioned为true，或简历估算token数超过SECTION_AUTO_TOKENS
+    incremental为true时按段落（每段经历、每个项目）切分且不合并，段落边界不受其它段落修改的影响，
+    配合按段缓存，再次提交时只有改动过或新增的段落会调用上游
+    需要分段时返回片段列表，否则（包括只切出一段时）返回None
+    """
+    question = settings["question"]
+    if data.get('incremental'):
+        chunks = [normalize_paragraph(chunk) for chunk in plan_resume_sections(question, min_tokens=0)]
+    else:
+        sectioned = data.get('sectioned')
+        if sectioned is None:
+            sectioned = SECTION_AUTO_TOKENS > 0 and estimate_tokens(question) > SECTION_AUTO_TOKENS
+        if not sectioned:
+            return None
+        chunks = plan_resume_sections(question)
+    if len(chunks) < 2:
+        return None
+    logger.info(f"分段优化: 共{len(chunks)}段，各段估算token数: {[estimate_tokens(chunk) for chunk in chunks]}")
+    return chunks
+
+def get_batch_semaphore(settings):
+    """批量请求限制对上游并发调用数的信号量，同一进程内的所有批量请求共用"""
+    if settings.get("pool"):
+        # 多上游池按上游数量放大并发上限
+        size = upstream_pool.size()
+        return get_upstream_semaphore(f"upstream-pool:{size}", UPSTREAM_MAX_CONCURRENCY * size)
+    return get_upstream_semaphore(settings["api_base"])
+
+def submit_sections(settings, chunks, bypass_cache):
+    """
+    用相同的系统提示词并行改写各片段，返回(executor, 按原文顺序排列的future列表)
+    每个片段单独缓存，future的结果为get_chat_answer的(答案, 元信息)
+    并发上限只作用于本次请求（线程池大小SECTION_MAX_CONCURRENCY），不与其它请求共用批量请求的信号量，
+    否则同时到达的几个分段请求会互相排队；所有请求合计的上限由RATE_LIMIT_MAX_INFLIGHT控制
+    """
+    def optimize(chunk):
+        section_settings = dict(settings, question=chunk)
+        section_settings.pop("cache_key", None)
+        return get_chat_answer(section_settings, bypass_cache)
+    
+    executor = ThreadPoolExecutor(max_workers=min(SECTION_MAX_CONCURRENCY, len(chunks)), thread_name_prefix="chat-section")
+    return executor, [executor.submit(run_in_context(optimize), chunk) for chunk in chunks]
+
+def merge_section_meta(metas):
+    """
+    合并各片段的元信息：全部命中缓存才算cached，upstream取第一个实际调用的上游，
+    reused为直接复用缓存的段数，regenerated为调用上游（或共享进行中调用）的段数
+    """
+    reused = sum(1 for meta in metas if meta["cached"])
+    return {
+        "cached": reused == len(metas),
+        "shared": any(meta["shared"] for meta in metas),
+        "upstream": next((meta["upstream"] for meta in metas if meta["upstream"]), None),
+        "sections": len(metas),
+        "reused": reused,
+        "regenerated": len(metas) - reused
+    }
+
+def get_sectioned_answer(settings, chunks, bypass_cache=False):
+    """
+    分段优化：并行改写各片段后按原文顺序拼接，总耗时取决于最长的片段而不是整份简历
+    任一片段失败时抛出该片段的错误
+    """
+    start_time = time.time()
+    executor, futures = submit_sections(settings, chunks, bypass_cache)
+    try:
+        results = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    meta = merge_section_meta([meta for _, meta in results])
+    logger.info(f"分段优化完成: 共{len(chunks)}段，复用{meta['reused']}段，耗时: {time.time() - start_time:.2f}秒")
+    return "\n\n".join(answer for answer, _ in results), meta
+
+def stream_sectioned_events(settings, chunks, bypass_cache, start_time):
+    """分段优化的SSE事件生成器：各片段并行改写，按原文顺序在前面的片段完成后依次输出"""
+    executor, futures = submit_sections(settings, chunks, bypass_cache)
+    result = "bypass" if bypass_cache else "miss"
+    metas = []
+    try:
+        for index, future in enumerate(futures):
+            answer, meta = future.result()
+            metas.append(meta)
+            yield format_sse({"content": answer if index == 0 else "\n\n" + answer})
+        yield format_sse({"done": True, **merge_section_meta(metas)})
+    except GeneratorExit:
+        logger.info("客户端断开连接，停止分段输出")
+        result = "cancelled"
+        cancel_request("disconnect")
+        raise
+    except Exception as e:
+        result = "error"
+        logger.error(f"分段优化失败: {str(e)}")
+        yield format_sse({"error": f"OpenAI API调用失败: {str(e)}"})
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        metrics.observe(CHAT_TOTAL_SECONDS, time.time() - start_time, mode="stream", result=result)
+        logger.info(f"分段流式请求处理总耗时: {time.time() - start_time:.2f}秒")
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """批量优化多份简历，按上游并发上限并行处理，按顺序返回或以NDJSON流式返回每项结果"""
     start_time = time.time()
     try:
         data = request.get_json()
-        logger.info("收到聊天请求")
+        items = data.get('items')
+        if items is None:
+            items = data.get('questions')
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "items参数必须是非空列表"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"error": f"单次批量请求最多{BATCH_MAX_ITEMS}项"}), 400
+        logger.info(f"收到批量请求，共{len(items)}项")
         
-        question = data.get('question')
-        if not question:
-            logger.warning("请求中没有提供问题内容")
-            return jsonify({"error": "question参数不能为空"}), 400
-            
-        # 使用最新保存的配置或前端传入的临时配置
-        api_key = data.get('apiKey', current_config['api_key'])
-        api_base = data.get('baseUrl', current_config['baseUrl'])
-        model = data.get('model', current_config['model'])
+        base_settings, error_response = resolve_upstream_settings(data)
+        if error_response is not None:
+            return error_response
+        apply_request_scope(base_settings)
+        base_settings["compact"] = data.get('compact') is not False
+        default_system_prompt = data.get('systemPrompt', DEFAULT_SYSTEM_PROMPT)
+        bypass_cache = should_bypass_cache(data)
         
-        # 获取前端传入的系统提示词，如果没有则使用默认值
-        system_prompt = data.get('systemPrompt', "假如你是一名资深简历提升官，请使用STAR+改写简历，并且最后提供完整输出，帮助更多应届大学生顺利找到他们的工作 输出限制： 1.请不要使用任何表情符号 2.请在一个自然段内完整输出 3.请不要过度夸大，请符合岗位实际 4.语言请说人话，平白直叙，拒绝任何行业黑话")
+        try:
+            concurrency = int(data.get('concurrency') or BATCH_MAX_CONCURRENCY)
+        except (TypeError, ValueError):
+            concurrency = BATCH_MAX_CONCURRENCY
+        concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY, len(items)))
         
-        logger.info(f"使用配置: API基础URL={api_base}, 模型={model}")
-        logger.info(f"系统提示词: {system_prompt}")
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="chat-batch")
+        futures = [
+            executor.submit(run_in_context(run_batch_item), index, item, base_settings, default_system_prompt, bypass_cache)
+            for index, item in enumerate(items)
+        ]
         
-        if not api_key:
-            logger.error("没有提供API密钥")
-            return jsonify({"error": "未设置API密钥，请在配置中设置API密钥"}), 400
-
-        # 验证API基础URL格式
-        if not api_base.startswith(('http://', 'https://')):
-            return jsonify({"error": "API地址格式错误，必须以http://或https://开头"}), 400
-            
-        # 尝试规范化API地址，确保它指向实际的API端点而不是网站首页
-        api_base = normalize_api_url(api_base)
-        logger.info(f"规范化后的API基础URL={api_base}")
+        if data.get('stream'):
+            def generate():
+                succeeded = 0
+                try:
+                    # 按完成顺序逐行输出，客户端通过index对应原始顺序
+                    for future in as_completed(futures):
+                        result = future.result()
+                        if "error" not in result:
+                            succeeded += 1
+                        yield json.dumps(result, ensure_ascii=False) + "\n"
+                    yield json.dumps({"done": True, "succeeded": succeeded, "failed": len(items) - succeeded}) + "\n"
+                except GeneratorExit:
+                    logger.info("客户端断开连接，停止批量输出")
+                    cancel_request("disconnect")
+                    raise
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    logger.info(f"批量请求处理总耗时: {time.time() - start_time:.2f}秒")
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
         
-        # 创建OpenAI客户端实例
-        logger.info("创建OpenAI客户端实例")
         try:
-            # 记录OpenAI库版本
+            results = [future.result() for future in futures]
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        scope = base_settings.get("cancel_event")
+        if scope is not None and scope.is_set():
+            logger.info(f"批量请求已取消（{scope.reason}），耗时: {time.time() - start_time:.2f}秒")
+            return cancelled_response(scope.reason)
+        succeeded = sum(1 for result in results if "error" not in result)
+        logger.info(f"批量请求完成: 成功{succeeded}项，失败{len(results) - succeeded}项，耗时: {time.time() - start_time:.2f}秒")
+        return jsonify({"results": results, "succeeded": succeeded, "failed": len(results) - succeeded})
+    
+    except Exception as e:
+        logger.error(f"处理批量请求时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+class JobQueue:
+    """
+    基于SQLite的持久化任务队列：任务在进程重启后保留，多个worker进程通过事务和租约保证同一任务只被领取一次
+    执行中的任务由心跳线程定期续约；请求携带的API密钥只保存在提交任务的进程内存中，不写入任务库
+    """
+    def __init__(self, db_path, lease_seconds, max_attempts, retention):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._secrets = {}  # 任务ID -> API密钥，任务结束时删除
+        self._secrets_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._last_cleanup = 0
+        self._init_db()
+
+    @contextmanager
+    def _db(self):
+        """
+        独占本进程共用的SQLite连接：gevent下threading.local按greenlet区分，按线程建连接会让每个请求新开一个连接，
+        因此只保持一个连接，由锁串行化访问（领取任务的事务也在锁内完成）
+        """
+        with self._db_lock:
+            if self._conn is None:
+                db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+                db.row_factory = sqlite3.Row
+                db.execute("PRAGMA journal_mode=WAL")
+                self._conn = db
+            yield self._conn
+
+    def _init_db(self):
+        with self._db() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT NOT NULL, result TEXT, error TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, worker_id TEXT, lease_until REAL, key_holder TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+            # 旧版本创建的任务库没有key_holder列
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            if "key_holder" not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN key_holder TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+
+    def submit(self, payload):
+        """
+        提交任务；携带API密钥的任务只能由本进程领取，密钥留在内存中，
+        排队期间由心跳续约，本进程退出后租约过期，任务由其它进程领取并以失败结束
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        payload = dict(payload)
+        api_key = payload.pop("apiKey", None)
+        if api_key:
+            with self._secrets_lock:
+                self._secrets[job_id] = api_key
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, payload, key_holder, lease_until, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload, ensure_ascii=False), self.worker_id if api_key else None,
+                 now + self.lease_seconds if api_key else None, now, now)
+            )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self._db() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self):
+        """原子地领取一个排队中或租约已过期的任务，没有可领取的任务时返回None"""
+        with self._db() as db:
+            while True:
+                now = time.time()
+                # BEGIN IMMEDIATE会立即获取写锁，其他进程的领取操作必须等待本事务结束
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = db.execute(
+                        "SELECT * FROM jobs WHERE (status = 'queued' AND (key_holder IS NULL OR key_holder = ? OR lease_until < ?)) "
+                        "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                        (self.worker_id, now, now)
+                    ).fetchone()
+                    if row is None:
+                        db.execute("COMMIT")
+                        return None
+                    error = None
+                    if row["attempts"] >= self.max_attempts:
+                        error = "任务多次执行未完成，已放弃"
+                    elif row["key_holder"] and not self._has_secret(row["id"]):
+                        error = "提交任务的进程已退出，API密钥不会写入任务库，请重新提交"
+                    if error is not None:
+                        # 放弃该任务后继续领取下一个
+                        db.execute(
+                            "UPDATE jobs SET status = 'failed', error = ?, payload = ?, worker_id = NULL, lease_until = NULL, "
+                            "updated_at = ?, finished_at = ? WHERE id = ?",
+                            (error, self._redact(row["payload"]), now, now, row["id"])
+                        )
+                        db.execute("COMMIT")
+                        continue
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', worker_id = ?, lease_until = ?, attempts = attempts + 1, "
+                        "started_at = ?, updated_at = ? WHERE id = ?",
+                        (self.worker_id, now + self.lease_seconds, now, now, row["id"])
+                    )
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+                job = dict(row)
+                job["attempts"] += 1
+                return job
+
+    def _has_secret(self, job_id):
+        with self._secrets_lock:
+            return job_id in self._secrets
+
+    def job_payload(self, job):
+        """返回任务参数，本进程内存中保存了API密钥时补回"""
+        payload = json.loads(job["payload"])
+        with self._secrets_lock:
+            api_key = self._secrets.get(job["id"])
+        if api_key:
+            payload["apiKey"] = api_key
+        return payload
+
+    def renew_leases(self):
+        """续约本进程执行中的任务和携带API密钥、仍在排队的任务"""
+        now = time.time()
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE (status = 'running' AND worker_id = ?) "
+                "OR (status = 'queued' AND key_holder = ?)",
+                (now + self.lease_seconds, self.worker_id, self.worker_id)
+            )
+
+    @staticmethod
+    def _redact(payload):
+        """兼容旧版本写入任务库的API密钥，任务结束后删除"""
+        try:
+            data = json.loads(payload)
+            data.pop("apiKey", None)
+            return json.dumps(data, ensure_ascii=False)
+        except (TypeError, ValueError):
+            return payload
+
+    def finish(self, job, result=None, error=None):
+        """记录任务结果，只有仍持有本次租约的worker才能写入（同一进程重新领取时attempts不同）"""
+        now = time.time()
+        status = "failed" if error is not None else "succeeded"
+        with self._secrets_lock:
+            self._secrets.pop(job["id"], None)
+        with self._db() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, payload = ?, lease_until = NULL, "
+                "updated_at = ?, finished_at = ? WHERE id = ? AND worker_id = ? AND attempts = ? AND status = 'running'",
+                (status, result, error, self._redact(job["payload"]), now, now, job["id"], self.worker_id, job["attempts"])
+            )
+        if cursor.rowcount == 0:
+            logger.warning(f"任务{job['id']}的租约已失效，放弃写入结果")
+
+    def cleanup(self):
+        """删除超过保留期的已结束任务"""
+        now = time.time()
+        if now - self._last_cleanup < 600:
+            return
+        self._last_cleanup = now
+        with self._db() as db:
+            db.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?", (now - self.retention,)
+            )
+
+    def counts(self):
+        with self._db() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def start_workers(self, count, handler):
+        """启动任务处理线程，重复调用不会重复启动"""
+        with self._start_lock:
+            if self._threads or count <= 0:
+                return
+            for index in range(count):
+                thread = threading.Thread(
+                    target=self._work_loop, args=(handler,), name=f"job-worker-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            thread = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            logger.info(f"已启动{count}个任务处理线程，任务库: {self.db_path}")
+
+    def _heartbeat_loop(self):
+        # 每三分之一个租约时间续约一次，执行时间超过租约的任务不会被其它worker重复领取
+        interval = max(1.0, self.lease_seconds / 3)
+        while True:
+            time.sleep(interval)
             try:
-                import pkg_resources
-                openai_version = pkg_resources.get_distribution("openai").version
-                logger.info(f"OpenAI库版本: {openai_version}")
-            except Exception as ve:
-                logger.warning(f"无法获取OpenAI版本: {str(ve)}")
-                openai_version = "未知"
-                
-            # 对于不同版本的库，可能需要不同的初始化方式
+                self.renew_leases()
+            except sqlite3.Error as e:
+                logger.warning(f"任务续约失败: {str(e)}")
+
+    def _work_loop(self, handler):
+        while True:
             try:
-                # 创建OpenAI客户端 (openai >= 1.0.0)
-                client = openai.OpenAI(
-                    api_key=api_key,
-                    base_url=api_base,
-                    timeout=API_TIMEOUT  # 设置超时时间
-                )
-                logger.info("成功使用新版方式创建OpenAI客户端")
-            except (AttributeError, TypeError) as e:
-                # 对于旧版本, 可能需要不同的设置方式
-                logger.warning(f"新版客户端创建失败: {str(e)}，尝试兼容模式")
-                
-                # 设置全局配置 (openai < 1.0.0)
-                openai.api_key = api_key
-                openai.api_base = api_base
-                client = openai  # 在旧版中，直接使用openai模块
-                logger.info("已使用兼容模式设置OpenAI客户端")
-                
-        except Exception as e:
-            logger.error(f"创建OpenAI客户端失败: {str(e)}")
-            return jsonify({"error": f"API配置错误: {str(e)}"}), 500
-        
-        # 简单测试API连接（可选，会增加响应时间）
-        try:
-            # 使用轻量级请求测试连接，而不是完整models.list()
-            logger.info(f"测试API服务可用性: {api_base}")
-            
-            # 先尝试用HEAD请求检查服务是否在线
+                self.cleanup()
+                job = self.claim()
+            except sqlite3.Error as e:
+                logger.warning(f"领取任务失败: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            logger.info(f"开始处理任务: {job['id']}，第{job['attempts']}次执行")
             try:
-                head_response = requests.head(api_base, timeout=5)
-                if head_response.status_code >= 400:
-                    logger.warning(f"API服务HEAD请求返回错误状态: {head_response.status_code}")
-                else:
-                    logger.info(f"API服务响应正常: {head_response.status_code}")
-            except Exception as head_error:
-                logger.warning(f"API服务HEAD请求失败: {str(head_error)}")
-            
-            # 然后尝试models接口
-            test_url = f"{api_base}/v1/models"
-            headers = {"Authorization": f"Bearer {api_key}"}
-            
-            # 增加超时，避免长时间等待
-            test_response = requests.get(test_url, headers=headers, timeout=10)
-            
-            if test_response.status_code == 404:
-                # 尝试其他可能的路径
-                alt_test_url = f"{api_base}/models"
-                logger.info(f"标准models路径不存在，尝试备用路径: {alt_test_url}")
-                test_response = requests.get(alt_test_url, headers=headers, timeout=5)
-            
-            # 即使状态码不是200，我们也不立即失败，只记录警告
-            if test_response.status_code != 200:
-                warning_msg = f"API连接测试返回非200状态码: {test_response.status_code}"
-                logger.warning(warning_msg)
-                # 只在明确是认证问题时才直接返回错误
-                if test_response.status_code == 401:
-                    error_msg = f"API密钥认证失败: {test_response.status_code}"
-                    logger.error(error_msg)
-                    return jsonify({"error": error_msg}), 500
-            else:
-                logger.info("API连接测试成功")
-                
-        except requests.exceptions.RequestException as e:
-            warning_msg = f"API连接测试失败: {str(e)}"
-            logger.warning(warning_msg)
-            # 这里我们只记录警告，但仍尝试进行实际请求
-            # 因为有些API代理可能不支持models端点，但仍能处理聊天请求
+                self.finish(job, result=handler(self.job_payload(job)))
+                logger.info(f"任务处理完成: {job['id']}")
+            except Exception as e:
+                logger.warning(f"任务处理失败: {job['id']}, 错误: {str(e)}")
+                try:
+                    self.finish(job, error=str(e))
+                except sqlite3.Error as db_error:
+                    logger.error(f"记录任务失败状态出错: {str(db_error)}")
+
+job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """延迟创建任务队列，避免未使用任务功能时创建数据库文件"""
+    global job_queue
+    with _job_queue_lock:
+        if job_queue is None:
+            job_queue = JobQueue(JOB_DB_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETENTION)
+        return job_queue
+
+def process_chat_job(payload):
+    """执行一个简历优化任务，返回答案；参数错误或调用失败时抛出异常"""
+    refresh_config()
+    with app.app_context():
+        settings, error_response = resolve_chat_request(payload)
+        if error_response is not None:
+            response = error_response[0]
+            raise Exception(response.get_json().get("error", "请求参数错误"))
+    chunks = resolve_sections(payload, settings)
+    if chunks:
+        answer, _ = get_sectioned_answer(settings, chunks, bypass_cache=bool(payload.get('noCache')))
+    else:
+        answer, _ = get_chat_answer(settings, bypass_cache=bool(payload.get('noCache')))
+    return answer
+
+def start_job_workers():
+    """启动任务处理线程；已存在任务库时启动，以便继续处理重启前未完成的任务"""
+    if JOB_WORKERS > 0 and (job_queue is not None or os.path.exists(JOB_DB_PATH)):
+        get_job_queue().start_workers(JOB_WORKERS, process_chat_job)
+
+def job_status_payload(job):
+    payload = {
+        "jobId": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "createdAt": job["created_at"],
+        "startedAt": job["started_at"],
+        "finishedAt": job["finished_at"]
+    }
+    if job["status"] == "failed":
+        payload["error"] = job["error"]
+    return payload
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """提交异步优化任务，立即返回任务ID，客户端随后轮询状态并获取结果"""
+    try:
+        data = request.get_json()
+        if not data or not data.get('question'):
+            return jsonify({"error": "question参数不能为空"}), 400
+        if JOB_WORKERS <= 0:
+            return jsonify({"error": "任务队列未启用"}), 503
         
-        # 开始调用API
-        logger.info("开始调用OpenAI API")
+        allowed_fields = ("question", "systemPrompt", "apiKey", "baseUrl", "model", "noCache", "compact") + SAMPLING_PARAMS
+        payload = {name: data[name] for name in allowed_fields if name in data}
+        jobs = get_job_queue()
+        if JOB_MAX_QUEUED > 0:
+            queued = jobs.counts().get("queued", 0)
+            if queued >= JOB_MAX_QUEUED:
+                logger.warning(f"任务队列已满（{queued}个排队），拒绝提交")
+                metrics.inc(ADMISSION_REJECTIONS, endpoint="submit_job", reason="queue_full")
+                return busy_response("任务队列已满，请稍后重试", admission.estimate_wait(queued, JOB_WORKERS))
+        job_id = jobs.submit(payload)
+        jobs.start_workers(JOB_WORKERS, process_chat_job)
+        logger.info(f"已提交任务: {job_id}")
         
-        try:
-            # 设置最大重试次数
-            max_retries = 2
-            retries = 0
-            last_error = None
-            
-            while retries <= max_retries:
-                try:
-                    # 使用OpenAI 1.x版本的API调用方式
-                    try:
-                        # 首先尝试使用新版API调用方式 (openai >= 1.0.0)
-                        logger.info("使用OpenAI 1.x版本的API调用")
-                        
-                        # 确保请求参数格式正确
-                        messages = [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": question}
-                        ]
-                        
-                        # 设置请求参数
-                        request_params = {
-                            "model": model,
-                            "messages": messages
-                        }
-                        
-                        # 记录请求内容，便于调试
-                        logger.info(f"OpenAI请求参数: {request_params}")
-                        
-                        # 调用API
-                        response = client.chat.completions.create(**request_params)
-                        logger.info(f"新版API调用成功，耗时: {time.time() - start_time:.2f}秒")
-                        
-                        # 检查响应类型
-                        logger.info(f"响应类型: {type(response)}")
-                        
-                        # 正确提取答案
-                        answer = extract_answer_from_response(response, logger)
-                        
-                    except (AttributeError, ImportError, ValueError) as e:
-                        logger.warning(f"新版API调用失败，尝试使用兼容模式: {str(e)}")
-                        
-                        try:
-                            # 使用直接HTTP请求方式作为备选方案
-                            headers = {
-                                "Content-Type": "application/json",
-                                "Authorization": f"Bearer {api_key}"
-                            }
-                            
-                            payload = {
-                                "model": model,
-                                "messages": [
-                                    {"role": "system", "content": system_prompt},
-                                    {"role": "user", "content": question}
-                                ]
-                            }
-                            
-                            # 首先尝试测试/v1/chat/completions端点
-                            if api_base.rstrip('/').endswith('/v1'):
-                                # 如果基础URL已经以/v1结尾，直接添加/chat/completions
-                                chat_completions_url = f"{api_base.rstrip('/')}/chat/completions"
-                                logger.info(f"优先测试chat completions端点(基础URL已包含/v1): {chat_completions_url}")
-                            else:
-                                # 否则添加完整路径/v1/chat/completions
-                                chat_completions_url = f"{api_base.rstrip('/')}/v1/chat/completions"
-                                logger.info(f"优先测试chat completions端点: {chat_completions_url}")
-                            
-                            logger.info(f"使用HTTP请求调用API: {chat_completions_url}")
-                            logger.info(f"请求参数: {payload}")
-                            
-                            # 发送HTTP请求
-                            response = requests.post(
-                                chat_completions_url,
-                                headers=headers,
-                                json=payload,
-                                timeout=API_TIMEOUT
-                            )
-                            
-                            # 检查HTTP响应状态
-                            if response.status_code != 200:
-                                error_msg = f"API返回错误状态码: {response.status_code}, 响应: {response.text}"
-                                logger.error(error_msg)
-                                raise Exception(error_msg)
-                            
-                            # 解析JSON响应
-                            response_data = response.json()
-                            logger.info("HTTP请求API调用成功")
-                            
-                            # 检查响应格式并提取答案
-                            answer = extract_answer_from_response(response_data, logger)
-                        
-                        except Exception as http_error:
-                            logger.error(f"HTTP请求模式失败: {str(http_error)}")
-                            # 如果前两种方式都失败，再尝试completions接口
-                            completions_url = f"{api_base.rstrip('/')}/v1/completions"
-                            
-                            simple_payload = {
-                                "model": model,
-                                "prompt": f"系统: {system_prompt}\n\n用户: {question}",
-                                "max_tokens": 2000,
-                                "temperature": 0.7
-                            }
-                            
-                            logger.info(f"尝试completions接口: {completions_url}")
-                            logger.info(f"请求参数: {simple_payload}")
-                            
-                            completions_response = requests.post(
-                                completions_url,
-                                headers=headers,
-                                json=simple_payload,
-                                timeout=API_TIMEOUT
-                            )
-                            
-                            if completions_response.status_code != 200:
-                                error_msg = f"Completions接口返回错误: {completions_response.status_code}, 响应: {completions_response.text}"
-                                logger.error(error_msg)
-                                raise Exception(error_msg)
-                            
-                            completions_data = completions_response.json()
-                            logger.info("Completions接口调用成功")
-                            
-                            answer = extract_answer_from_response(completions_data, logger)
-                    
-                    logger.info(f"成功获取API响应，总耗时: {time.time() - start_time:.2f}秒")
-                    return jsonify({"answer": answer})
-                    
-                except Exception as e:
-                    last_error = e
-                    retries += 1
-                    logger.warning(f"API调用失败，重试 {retries}/{max_retries}: {str(e)}")
-                    if retries <= max_retries:
-                        time.sleep(2)  # 短暂延迟后重试
-            
-            # 如果所有重试都失败
-            logger.error(f"所有API调用重试都失败: {str(last_error)}")
-            return jsonify({"error": f"OpenAI API调用失败: {str(last_error)}"}), 500
-            
-        except Exception as e:
-            logger.error(f"调用OpenAI API时出错: {str(e)}")
-            return jsonify({"error": f"调用OpenAI API时出错: {str(e)}"}), 500
+        response = jsonify({
+            "jobId": job_id,
+            "status": "queued",
+            "statusUrl": f"/jobs/{job_id}",
+            "resultUrl": f"/jobs/{job_id}/result"
+        })
+        response.headers["Location"] = f"/jobs/{job_id}"
+        return response, 202
+    except Exception as e:
+        logger.error(f"提交任务时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询任务状态"""
+    try:
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return jsonify({"error": "任务不存在"}), 404
+        return jsonify(job_status_payload(job))
     except Exception as e:
-        logger.error(f"处理聊天请求时出错: {str(e)}", exc_info=True)
+        logger.error(f"查询任务时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """获取任务结果：未完成时返回202，失败时返回错误信息"""
+    try:
+        job = get_job_queue().get(job_id)
+        if job is None:
+            return jsonify({"error": "任务不存在"}), 404
+        if job["status"] == "succeeded":
+            return jsonify({"jobId": job_id, "status": "succeeded", "answer": job["result"]})
+        if job["status"] == "failed":
+            return jsonify({"jobId": job_id, "status": "failed", "error": job["error"]}), 500
+        response = jsonify(job_status_payload(job))
+        response.headers["Retry-After"] = str(int(JOB_POLL_INTERVAL) + 1)
+        return response, 202
+    except Exception as e:
+        logger.error(f"获取任务结果时出错: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
-    finally:
-        logger.info(f"请求处理总耗时: {time.time() - start_time:.2f}秒")
 
 @app.route('/get_config', methods=['GET'])
 def get_config():
@@ -447,11 +4659,94 @@ def get_config():
             "apiKey": mask_api_key(current_config['api_key']) if current_config['api_key'] else ""
         }
         logger.info("请求当前配置")
-        return jsonify({"config": safe_config})
+        return jsonify({"config": safe_config, "configVersion": _config_state["version"],
+                        "upstreamPool": upstream_pool.size()})
     except Exception as e:
         logger.error(f"获取配置时出错: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+@app.route('/upstream_health', methods=['GET'])
+def get_upstream_health():
+    """返回后台健康检查和熔断器记录的上游状态"""
+    try:
+        return jsonify({
+            "upstreams": upstream_health.snapshot(),
+            "protocols": protocol_memory.snapshot(),
+            "pool": upstream_pool.snapshot(),
+            "rateLimit": rate_limiter.stats(),
+            "hedging": hedge_controller.stats()
+        })
+    except Exception as e:
+        logger.error(f"获取上游健康状态时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """返回响应缓存的命中统计"""
+    try:
+        stats = response_cache.stats()
+        stats["coalescing"] = chat_singleflight.stats()
+        stats["nearDuplicate"] = near_duplicate_index.stats()
+        return jsonify(stats)
+    except Exception as e:
+        logger.error(f"获取缓存统计时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    """返回上游客户端连接池的复用统计"""
+    try:
+        return jsonify(client_pool.stats())
+    except Exception as e:
+        logger.error(f"获取连接池统计时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+@metrics.collector
+def collect_runtime_metrics():
+    """把准入队列、缓存、请求合并、限流、对冲和日志队列的已有统计导出为指标"""
+    cache = response_cache.stats()
+    coalescing = chat_singleflight.stats()
+    rate_limit = rate_limiter.stats()
+    hedging = hedge_controller.stats()
+    admission_stats = admission.stats()
+    return [
+        ("resume_admission_active", "gauge", "正在处理的耗时请求数", [({}, admission_stats["active"])]),
+        ("resume_admission_queued", "gauge", "排队等待处理名额的请求数", [({}, admission_stats["queued"])]),
+        ("resume_cache_lookups", "counter", "响应缓存查询结果", [
+            ({"result": "hit"}, cache["hits"]),
+            ({"result": "disk_hit"}, cache["diskHits"]),
+            ({"result": "miss"}, cache["misses"]),
+            ({"result": "bypass"}, cache["bypass"])
+        ]),
+        ("resume_cache_entries", "gauge", "内存中缓存的答案数", [({}, cache["entries"])]),
+        ("resume_coalesced_requests", "counter", "相同请求合并情况，leader为实际调用上游的请求", [
+            ({"role": "leader"}, coalescing["leaders"]),
+            ({"role": "shared"}, coalescing["shared"])
+        ]),
+        ("resume_rate_limit_events", "counter", "上游限流事件", [
+            ({"event": "queued"}, rate_limit["queued"]),
+            ({"event": "rejected"}, rate_limit["rejected"]),
+            ({"event": "throttled"}, rate_limit["throttled"])
+        ]),
+        ("resume_hedge_events", "counter", "对冲请求事件", [
+            ({"event": "hedged"}, hedging["hedged"]),
+            ({"event": "hedge_win"}, hedging["hedgeWins"]),
+            ({"event": "budget_exhausted"}, hedging["budgetExhausted"])
+        ]),
+        ("resume_hedge_tokens", "counter", "对冲请求消耗的估算token数", [({}, hedging["hedgeTokens"])]),
+        ("resume_log_dropped", "counter", "日志队列已满而丢弃的日志数", [({}, log_handler.dropped)]),
+        ("resume_log_queue_size", "gauge", "等待后台线程写出的日志数", [({}, log_queue.qsize())])
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """以Prometheus文本格式返回当前进程的指标"""
+    try:
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+    except Exception as e:
+        logger.error(f"生成指标时出错: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
 def mask_api_key(api_key):
     """遮盖API密钥，只显示前6位和后4位"""
     if not api_key or len(api_key) < 10:
@@ -476,119 +4771,45 @@ def test_api():
         
         logger.info(f"测试API连接: {base_url}")
         
-        # 尝试检测正确的API路径
-        detected_url = None
-        html_response = False
+        # 重新检测时丢弃旧的解析结果
+        invalidate_api_url_cache(base_url)
         
-        # 先尝试直接测试提供的URL
-        try:
-            # 发送简单的API请求
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-                "Accept": "application/json"
-            }
-            
-            # 首先尝试测试/v1/chat/completions端点
-            if base_url.rstrip('/').endswith('/v1'):
-                # 如果基础URL已经以/v1结尾，直接添加/chat/completions
-                chat_completions_url = f"{base_url.rstrip('/')}/chat/completions"
-                logger.info(f"优先测试chat completions端点(基础URL已包含/v1): {chat_completions_url}")
-            else:
-                # 否则添加完整路径/v1/chat/completions
-                chat_completions_url = f"{base_url.rstrip('/')}/v1/chat/completions"
-                logger.info(f"优先测试chat completions端点: {chat_completions_url}")
-            
-            try:
-                # 轻量级OPTIONS请求测试端点是否存在
-                options_response = requests.options(chat_completions_url, timeout=5, headers=headers)
-                # 如果接口可能存在
-                if options_response.status_code != 404:
-                    logger.info(f"chat completions端点可能存在")
-                    # 推测正确的基础URL
-                    detected_url = f"{base_url.rstrip('/')}/v1"
-                    if detected_url.endswith('/v1/v1'):  # 避免重复v1
-                        detected_url = detected_url[:-3]
-                    return jsonify({
-                        "success": True, 
-                        "message": "找到可能的API端点: /v1/chat/completions", 
-                        "detectedUrl": detected_url
-                    })
-            except Exception as e:
-                logger.warning(f"测试chat completions端点失败: {str(e)}")
-            
-            # 如果直接测试chat completions失败，尝试标准模型列表请求
-            test_url = f"{base_url.rstrip('/')}/v1/models"
-            logger.info(f"测试API端点: {test_url}")
-            
-            response = requests.get(test_url, headers=headers, timeout=10)
-            
-            # 检查响应类型
-            content_type = response.headers.get('content-type', '')
-            logger.info(f"API响应类型: {content_type}")
-            
-            # 如果响应是HTML而不是JSON，可能是前端页面
-            if 'text/html' in content_type.lower() or response.text.strip().startswith(('<!DOCTYPE', '<html')):
-                html_response = True
-                logger.warning("API返回了HTML内容，可能不是正确的API端点")
-                # 获取页面标题作为额外信息
-                try:
-                    import re
-                    title_match = re.search(r'<title>(.*?)</title>', response.text, re.IGNORECASE)
-                    if title_match:
-                        title = title_match.group(1)
-                        logger.info(f"HTML页面标题: {title}")
-                except:
-                    pass
-            elif response.status_code == 200 and 'application/json' in content_type.lower():
-                # 成功获取JSON响应
-                logger.info("成功连接到API端点")
-                detected_url = base_url
-            
-        except Exception as e:
-            logger.warning(f"直接测试URL失败: {str(e)}")
-        
-        # 如果直接测试失败或返回HTML，尝试规范化URL
-        if html_response or detected_url is None:
-            normalized_url = normalize_api_url(base_url)
-            if normalized_url != base_url:
-                logger.info(f"尝试规范化的URL: {normalized_url}")
-                
-                try:
-                    # 尝试使用规范化的URL
-                    test_url = f"{normalized_url.rstrip('/')}/models"
-                    response = requests.get(test_url, headers=headers, timeout=10)
-                    
-                    if response.status_code == 200 and 'application/json' in response.headers.get('content-type', '').lower():
-                        logger.info(f"规范化URL连接成功: {normalized_url}")
-                        detected_url = normalized_url
-                    else:
-                        # 尝试另一个常见路径
-                        test_url = f"{normalized_url.rstrip('/')}/v1/models"
-                        response = requests.get(test_url, headers=headers, timeout=10)
-                        if response.status_code == 200 and 'application/json' in response.headers.get('content-type', '').lower():
-                            logger.info(f"规范化URL(v1)连接成功: {normalized_url}")
-                            detected_url = normalized_url
-                            
-                except Exception as e:
-                    logger.warning(f"测试规范化URL失败: {str(e)}")
-                    
-        # 返回测试结果
-        if detected_url:
+        # 并发探测chat completions端点和各候选路径的models端点，取优先级最高的可用地址
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        start_time = time.time()
+        probes = build_test_api_probes(base_url)
+        best, report = run_probes(probes, headers=headers)
+        elapsed = round(time.time() - start_time, 3)
+        
+        # 返回测试结果，probes中为每个探测的耗时和接受或拒绝的原因
+        if best is not None:
+            logger.info(f"API连接成功: {best.result_url}（{best.method} {best.url}: {best.reason}）")
+            set_cached_api_url(base_url, best.result_url)
             return jsonify({
                 "success": True, 
-                "message": "API连接成功", 
-                "detectedUrl": detected_url
+                "message": best.message or "API连接成功", 
+                "detectedUrl": best.result_url,
+                "elapsed": elapsed,
+                "probes": report
             })
-        elif html_response:
+        elif any(probe.html for probe in probes):
+            logger.warning("API返回了HTML内容，可能不是正确的API端点")
             return jsonify({
                 "success": False, 
-                "error": "API地址返回了HTML页面，而不是API端点。请检查地址格式，通常需要添加/api/v1或/v1等路径。"
+                "error": "API地址返回了HTML页面，而不是API端点。请检查地址格式，通常需要添加/api/v1或/v1等路径。",
+                "elapsed": elapsed,
+                "probes": report
             })
         else:
             return jsonify({
                 "success": False, 
-                "error": "无法连接到API。请检查API地址和密钥是否正确。"
+                "error": "无法连接到API。请检查API地址和密钥是否正确。",
+                "elapsed": elapsed,
+                "probes": report
             })
             
     except Exception as e:
@@ -653,7 +4874,7 @@ def extract_answer_from_response(response_obj, logger):
         
         # 如果上面的方法都失败，记录详细信息并返回字符串表示
         logger.warning(f"无法用标准方式提取答案，响应类型: {type(response_obj)}")
-        logger.warning(f"响应内容: {str(response_obj)[:200]}...")
+        logger.warning("响应内容: %.200s...", response_obj)
         
         # 最后的尝试：直接返回字符串表示
         if hasattr(response_obj, 'content'):
@@ -667,13 +4888,10 @@ def extract_answer_from_response(response_obj, logger):
         logger.error(f"提取答案时出错: {str(e)}")
         return f"无法解析API响应: {str(e)}"
 
+# 继续处理上次运行时未完成的任务
+start_job_workers()
+
 if __name__ == '__main__':
-    # 初始化日志设置
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    
     # 获取当前配置
     API_BASE = current_config['baseUrl']
     MODEL = current_config['model']
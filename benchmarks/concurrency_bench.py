@@ -0,0 +1,148 @@
+"""
+并发基准测试：比较不同gunicorn worker类型在慢速上游下的并发能力
+
+脚本会启动本地桩服务（每次生成固定延迟），再依次用不同worker配置启动gunicorn，
+并发发送/chat请求，输出总耗时、吞吐量和延迟分位数。
+
+用法:
+    python benchmarks/concurrency_bench.py --requests 200 --concurrency 200 --latency 2
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_server import make_server  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 被测服务只使用进程内的配置、限流状态和缓存，不读写临时目录中其它实例共享的SQLite文件，也不启动任务队列
+APP_ENV = {
+    "HEALTH_CHECK_INTERVAL": "0", "CONFIG_STORE": "memory", "RATE_LIMIT_DB": "", "JOB_WORKERS": "0",
+    "GUNICORN_ACCESS_LOG": "", "GUNICORN_LOG_LEVEL": "warning", "GUNICORN_TIMEOUT": "600",
+}
+
+# 待比较的worker配置：(名称, 环境变量)
+WORKER_MODES = [
+    ("sync x1", {"GUNICORN_WORKER_CLASS": "sync", "GUNICORN_WORKERS": "1"}),
+    ("gthread x1 (32 threads)", {"GUNICORN_WORKER_CLASS": "gthread", "GUNICORN_WORKERS": "1", "GUNICORN_THREADS": "32"}),
+    ("gevent x1 (default)", {"GUNICORN_WORKER_CLASS": "gevent", "GUNICORN_WORKERS": "1"}),
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def free_port():
+    """向系统申请一个当前空闲的本地端口，避免与已在运行的服务冲突"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, timeout=60, process=None):
+    """等待服务返回200；process已退出（例如端口被占用）时立即返回False，不把占用端口的其它服务当作已就绪"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            return False
+        try:
+            if requests.get(url, timeout=1).ok:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_load(app_url, upstream_url, total, concurrency, timeout):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one_request(_):
+        nonlocal errors
+        start = time.time()
+        # 每个请求使用不同的简历内容并跳过缓存，否则缓存和相同请求合并会让结果与worker类型无关
+        payload = {"question": f"负责校园社团招新活动 #{uuid.uuid4().hex[:8]}", "apiKey": "sk-bench",
+                   "baseUrl": upstream_url, "model": "stub-model"}
+        try:
+            response = requests.post(f"{app_url}/chat", json=payload, headers={"Cache-Control": "no-cache"},
+                                     timeout=timeout)
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        elapsed = time.time() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(total)))
+    return time.time() - start, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gunicorn worker并发基准测试")
+    parser.add_argument("--requests", type=int, default=100, help="请求总数")
+    parser.add_argument("--concurrency", type=int, default=100, help="并发客户端数")
+    parser.add_argument("--latency", type=float, default=2.0, help="桩服务每次生成的延迟（秒）")
+    parser.add_argument("--app-port", type=int, default=0, help="gunicorn端口，0表示自动选择空闲端口")
+    parser.add_argument("--stub-port", type=int, default=0, help="桩服务端口，0表示自动选择空闲端口")
+    parser.add_argument("--timeout", type=float, default=60, help="单个请求的客户端超时（秒）")
+    args = parser.parse_args()
+
+    server, _ = make_server(port=args.stub_port, latency=args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    print(f"上游延迟 {args.latency}s，{args.requests} 个请求，并发 {args.concurrency}")
+    print(f"{'mode':<26}{'total(s)':>10}{'req/s':>9}{'p50(s)':>9}{'p95(s)':>9}{'p99(s)':>9}{'errors':>8}")
+    for name, mode_env in WORKER_MODES:
+        app_port = args.app_port or free_port()
+        app_url = f"http://127.0.0.1:{app_port}"
+        env = dict(os.environ, PORT=str(app_port), **APP_ENV, **mode_env)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            if not wait_until_ready(f"{app_url}/get_config", process=process):
+                print(f"{name:<26}启动失败")
+                continue
+            elapsed, latencies, errors = run_load(app_url, upstream_url, args.requests, args.concurrency, args.timeout)
+            throughput = len(latencies) / elapsed if elapsed else 0.0
+            print(f"{name:<26}{elapsed:>10.2f}{throughput:>9.2f}{percentile(latencies, 50):>9.2f}"
+                  f"{percentile(latencies, 95):>9.2f}{percentile(latencies, 99):>9.2f}{errors:>8}")
+        finally:
+            stop_process(process)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+压测脚本：用本地桩服务作为上游，对/chat（普通和流式）、/chat/batch和/test_api施加并发负载，
+输出每个场景的吞吐量、延迟分位数、首字延迟和上游调用放大倍数（上游请求总数/实际需要的上游操作数，
+生成场景为生成次数，/test_api为请求数），
+用于发现探测、重试逻辑改动带来的性能回退
+
+默认在本地启动桩服务和gunicorn（都绑定自动选择的空闲端口）；也可以用--app-url指向已运行的服务。
+每个请求有客户端超时，整次运行不超过--max-duration秒，到时尚未发出的请求记为deadline错误。
+
+用法:
+    python benchmarks/load_test.py --requests 100 --concurrency 20 --latency 0.5
+    python benchmarks/load_test.py --scenarios chat,test_api --error-rate 0.1 --rate-limit-rate 0.05
+    python benchmarks/load_test.py --scenarios test_api --html-homepage --base-path ""
+    python benchmarks/load_test.py --app-url http://127.0.0.1:5000 --scenarios chat-stream
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_server import make_server, add_stub_arguments, stub_options  # noqa: E402
+from concurrency_bench import APP_ENV, ROOT, free_port, percentile, stop_process, wait_until_ready  # noqa: E402
+
+SCENARIOS = ("chat", "chat-stream", "batch", "batch-stream", "test_api")
+
+
+class ScenarioResult:
+    """单个场景的统计结果"""
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.first_token = []
+        self.errors = {}
+        self.units = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def success(self, latency, first_token=None, units=1):
+        with self._lock:
+            self.latencies.append(latency)
+            self.units += units
+            if first_token is not None:
+                self.first_token.append(first_token)
+
+    def failure(self, reason, units=1):
+        with self._lock:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+            self.units += units
+
+
+def unique_question(args):
+    """每个请求使用不同的简历内容，避免命中缓存和请求合并；--repeat-question时使用相同内容"""
+    if args.repeat_question:
+        return "负责校园社团招新活动"
+    return f"负责校园社团招新活动 #{uuid.uuid4().hex[:8]}"
+
+
+def chat_payload(args, upstream_url, **extra):
+    payload = {"question": unique_question(args), "apiKey": "sk-bench", "baseUrl": upstream_url, "model": "stub-model"}
+    payload.update(extra)
+    return payload
+
+
+def read_sse(response, start, deadline):
+    """读取/chat的SSE输出，返回首字延迟；收到error事件或超过整次运行的截止时间时抛出异常"""
+    first_token = None
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if time.time() > deadline:
+            raise RuntimeError("deadline")
+        if not line or not line.startswith("data:"):
+            continue
+        event = json.loads(line[5:].strip())
+        if "error" in event:
+            raise RuntimeError("stream-error")
+        if event.get("content") and first_token is None:
+            first_token = time.time() - start
+        if event.get("done"):
+            return first_token
+    raise RuntimeError("stream-truncated")
+
+
+def read_ndjson(response, deadline):
+    """读取批量接口的逐行输出，返回(成功数, 失败数)"""
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if time.time() > deadline:
+            raise RuntimeError("deadline")
+        if not line:
+            continue
+        event = json.loads(line)
+        if event.get("done"):
+            return event["succeeded"], event["failed"]
+    raise RuntimeError("stream-truncated")
+
+
+def make_request(scenario, args, app_url, upstream_url, result):
+    """构造场景对应的单次请求函数"""
+    headers = {} if args.cache else {"Cache-Control": "no-cache"}
+    batch_size = args.batch_size if scenario.startswith("batch") else 1
+
+    def one_request(_):
+        start = time.time()
+        if start >= args.deadline:
+            return result.failure("deadline", batch_size)
+        # 单个请求的超时不超过整次运行剩余的时间
+        timeout = min(args.timeout, args.deadline - start)
+        try:
+            if scenario == "chat":
+                response = requests.post(f"{app_url}/chat", json=chat_payload(args, upstream_url),
+                                         headers=headers, timeout=timeout)
+                if response.status_code != 200:
+                    return result.failure(str(response.status_code))
+                result.success(time.time() - start)
+            elif scenario == "chat-stream":
+                with requests.post(f"{app_url}/chat", json=chat_payload(args, upstream_url, stream=True),
+                                   headers=headers, timeout=timeout, stream=True) as response:
+                    if response.status_code != 200:
+                        return result.failure(str(response.status_code))
+                    first_token = read_sse(response, start, args.deadline)
+                result.success(time.time() - start, first_token)
+            elif scenario.startswith("batch"):
+                items = [{"question": unique_question(args)} for _ in range(batch_size)]
+                payload = chat_payload(args, upstream_url, items=items, stream=scenario == "batch-stream")
+                with requests.post(f"{app_url}/chat/batch", json=payload, headers=headers,
+                                   timeout=timeout, stream=scenario == "batch-stream") as response:
+                    if response.status_code != 200:
+                        return result.failure(str(response.status_code), batch_size)
+                    if scenario == "batch-stream":
+                        succeeded, failed = read_ndjson(response, args.deadline)
+                    else:
+                        body = response.json()
+                        succeeded, failed = body["succeeded"], body["failed"]
+                if failed:
+                    return result.failure("item-failed", batch_size)
+                result.success(time.time() - start, units=batch_size)
+            else:
+                response = requests.post(f"{app_url}/test_api", json={"apiKey": "sk-bench", "baseUrl": upstream_url},
+                                         timeout=timeout)
+                if response.status_code != 200 or not response.json().get("success"):
+                    return result.failure(str(response.status_code))
+                result.success(time.time() - start)
+        except (requests.exceptions.RequestException, RuntimeError, ValueError, KeyError) as e:
+            result.failure(str(e) if isinstance(e, RuntimeError) else type(e).__name__, batch_size)
+
+    return one_request
+
+
+def upstream_calls(stats):
+    """把桩服务的调用计数分为生成请求和探测请求"""
+    generation = sum(count for key, count in stats["calls"].items() if key.startswith("POST "))
+    return generation, stats["total"] - generation
+
+
+def run_scenario(scenario, args, app_url, upstream_url, stub_url):
+    result = ScenarioResult(scenario)
+    if stub_url:
+        requests.post(f"{stub_url}/__reset", timeout=5)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(make_request(scenario, args, app_url, upstream_url, result), range(args.requests)))
+    result.elapsed = time.time() - start
+    stats = requests.get(f"{stub_url}/__stats", timeout=5).json() if stub_url else None
+    return result, stats
+
+
+def print_report(rows):
+    print(f"{'scenario':<14}{'ok':>6}{'err':>6}{'req/s':>9}{'p50(s)':>9}{'p95(s)':>9}{'p99(s)':>9}"
+          f"{'ttft50':>9}{'upstream':>10}{'probes':>8}{'amplif':>8}")
+    for result, stats in rows:
+        latencies = result.latencies
+        throughput = len(latencies) / result.elapsed if result.elapsed else 0.0
+        ttft = f"{percentile(result.first_token, 50):>9.2f}" if result.first_token else f"{'-':>9}"
+        if stats is not None:
+            generation, probes = upstream_calls(stats)
+            amplification = f"{stats['total'] / result.units:>8.2f}" if result.units else f"{'-':>8}"
+            upstream = f"{generation:>10}{probes:>8}{amplification}"
+        else:
+            upstream = f"{'-':>10}{'-':>8}{'-':>8}"
+        print(f"{result.name:<14}{len(latencies):>6}{sum(result.errors.values()):>6}{throughput:>9.2f}"
+              f"{percentile(latencies, 50):>9.2f}{percentile(latencies, 95):>9.2f}{percentile(latencies, 99):>9.2f}"
+              f"{ttft}{upstream}")
+    for result, stats in rows:
+        if result.errors:
+            print(f"{result.name} 错误: {json.dumps(result.errors, ensure_ascii=False)}")
+        if stats is not None and stats.get("statuses"):
+            print(f"{result.name} 上游状态码: {json.dumps(stats['statuses'], sort_keys=True)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基于本地桩服务的压测")
+    parser.add_argument("--scenarios", default="chat,chat-stream,batch,test_api",
+                        help=f"逗号分隔的场景，可选: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=50, help="每个场景的请求总数")
+    parser.add_argument("--concurrency", type=int, default=10, help="并发客户端数")
+    parser.add_argument("--batch-size", type=int, default=5, help="批量场景每个请求包含的条目数")
+    parser.add_argument("--timeout", type=float, default=60, help="单个请求的客户端超时（秒）")
+    parser.add_argument("--max-duration", type=float, default=240, help="整次运行（含启动服务）的最长时间（秒）")
+    parser.add_argument("--cache", action="store_true", help="允许命中响应缓存（默认发送Cache-Control: no-cache）")
+    parser.add_argument("--repeat-question", action="store_true", help="所有请求使用相同内容，用于测试缓存和请求合并")
+    parser.add_argument("--app-url", help="已运行的服务地址；不指定时在本地启动gunicorn")
+    parser.add_argument("--app-port", type=int, default=0, help="本地gunicorn端口，0表示自动选择空闲端口")
+    parser.add_argument("--stub-port", type=int, default=0, help="桩服务端口，0表示自动选择空闲端口")
+    parser.add_argument("--base-path", default="/v1", help="传给服务的API地址路径，空字符串表示只填主机（触发地址探测）")
+    add_stub_arguments(parser)
+    parser.set_defaults(latency=0.5)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知场景: {', '.join(unknown)}")
+    args.deadline = time.time() + args.max_duration
+
+    server, _ = make_server(port=args.stub_port, **stub_options(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{server.server_address[1]}"
+    upstream_url = f"{stub_url}{args.base_path}"
+
+    process = None
+    app_url = args.app_url
+    if not app_url:
+        app_port = args.app_port or free_port()
+        app_url = f"http://127.0.0.1:{app_port}"
+        env = dict(os.environ, PORT=str(app_port), **APP_ENV)
+        process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    try:
+        if not wait_until_ready(f"{app_url}/get_config", timeout=min(60, args.max_duration), process=process):
+            print(f"服务启动失败: {app_url}", file=sys.stderr)
+            sys.exit(1)
+        print(f"上游延迟 {args.latency}s（{args.latency_dist}），错误率 {args.error_rate}，429比例 {args.rate_limit_rate}，"
+              f"每个场景 {args.requests} 个请求，并发 {args.concurrency}")
+        rows = [run_scenario(scenario, args, app_url, upstream_url, stub_url) for scenario in scenarios]
+        print_report(rows)
+    finally:
+        if process is not None:
+            stop_process(process)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
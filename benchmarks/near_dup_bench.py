@@ -0,0 +1,135 @@
+"""
+近似重复索引基准测试：用随机生成的简历填充NearDuplicateIndex，测量写入和查询延迟、内存占用，
+以及对轻微改动（空白、标点、换电话、调整技能顺序）的召回率和对无关简历的误报率
+
+不需要启动服务和上游，直接在进程内调用app中的索引实现。
+
+用法:
+    python benchmarks/near_dup_bench.py --entries 100000 --queries 2000
+    python benchmarks/near_dup_bench.py --threshold 0.85 --num-perm 128 --bands 16
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("JOB_WORKERS", "0")
+os.environ.setdefault("HEALTH_CHECK_INTERVAL", "0")
+from concurrency_bench import percentile  # noqa: E402
+from app import NearDuplicateIndex  # noqa: E402
+
+SCHOOLS = ["北京大学", "浙江大学", "武汉大学", "中山大学", "四川大学", "山东大学", "厦门大学", "南开大学"]
+MAJORS = ["计算机科学与技术", "软件工程", "市场营销", "会计学", "电子信息工程", "汉语言文学", "机械工程", "统计学"]
+SKILLS = ["Python", "Java", "SQL", "Excel", "Linux", "Docker", "PS", "Go", "C++", "Tableau", "SPSS", "Vue"]
+VERBS = ["负责", "参与", "主导", "协助", "策划", "设计", "优化", "维护"]
+OBJECTS = ["校园二手交易平台", "社团招新活动", "订单系统重构", "数据分析报表", "公众号运营", "实验室管理系统",
+           "毕业设计项目", "学生会换届晚会", "电商促销活动", "客户回访流程"]
+RESULTS = ["用户增长{}%", "接口延迟降低{}%", "参与人数超过{}人", "覆盖率提升到{}%", "成本减少{}万元", "转化率提高{}%"]
+NAMES = "张王李赵刘陈杨黄周吴徐孙马朱胡郭何林罗高"
+
+
+def make_resume(rng):
+    """生成一份随机简历，保证不同简历之间的差异足够大"""
+    skills = rng.sample(SKILLS, 5)
+    lines = [
+        f"{rng.choice(NAMES)}{rng.choice(NAMES)} 电话：1{rng.randint(3000000000, 9999999999)} 邮箱 u{rng.randint(1, 10 ** 8)}@example.com",
+        f"教育背景：{rng.choice(SCHOOLS)} {rng.choice(MAJORS)} {rng.randint(2015, 2022)}-{rng.randint(2019, 2026)}",
+        f"技能：{'、'.join(skills)}",
+    ]
+    for _ in range(rng.randint(2, 4)):
+        result = rng.choice(RESULTS).format(rng.randint(5, 5000))
+        lines.append(f"{rng.choice(VERBS)}{rng.choice(OBJECTS)}，{rng.choice(VERBS)}{rng.choice(OBJECTS)}的"
+                     f"{rng.choice(['方案', '流程', '开发', '推广'])}，{result}，编号{rng.randint(1, 10 ** 6)}。")
+    return "\n".join(lines), skills
+
+
+def perturb(rng, text, skills):
+    """对简历做用户重复提交时常见的轻微改动"""
+    kind = rng.choice(["whitespace", "punctuation", "phone", "skills"])
+    if kind == "whitespace":
+        text = text.replace("，", "， ").replace("\n", "\n\n  ")
+    elif kind == "punctuation":
+        text = text.replace("，", ",").replace("。", ".").replace("：", ":")
+    elif kind == "phone":
+        head, _, rest = text.partition("电话：")
+        text = f"{head}电话：1{rng.randint(3000000000, 9999999999)}{rest[11:]}"
+    else:
+        shuffled = skills[:]
+        rng.shuffle(shuffled)
+        text = text.replace("、".join(skills), "、".join(shuffled))
+    return kind, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近似重复索引基准测试")
+    parser.add_argument("--entries", type=int, default=100000, help="索引中的简历数")
+    parser.add_argument("--queries", type=int, default=2000, help="改动版本和无关简历的查询数（各一半）")
+    parser.add_argument("--threshold", type=float, default=0.9)
+    parser.add_argument("--num-perm", type=int, default=64)
+    parser.add_argument("--bands", type=int, default=8)
+    parser.add_argument("--max-candidates", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = NearDuplicateIndex(args.entries, 3600, args.threshold, num_perm=args.num_perm, bands=args.bands,
+                               max_candidates=args.max_candidates)
+    scope = "bench"
+    resumes = [make_resume(rng) for _ in range(args.entries)]
+
+    signature_times, add_times = [], []
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for i, (text, _) in enumerate(resumes):
+        start = time.perf_counter()
+        signature = index.signature(text)
+        middle = time.perf_counter()
+        index.add(scope, signature, f"answer-{i}")
+        add_times.append(time.perf_counter() - middle)
+        signature_times.append(middle - start)
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    half = args.queries // 2
+    query_times, recalled, by_kind, wrong = [], 0, {}, 0
+    for _ in range(half):
+        i = rng.randrange(len(resumes))
+        kind, text = perturb(rng, *resumes[i])
+        start = time.perf_counter()
+        match = index.query(scope, index.signature(text))
+        query_times.append(time.perf_counter() - start)
+        hit = match is not None and match[0] == f"answer-{i}"
+        wrong += match is not None and not hit
+        recalled += hit
+        total, hits = by_kind.get(kind, (0, 0))
+        by_kind[kind] = (total + 1, hits + hit)
+    false_positives = 0
+    for _ in range(args.queries - half):
+        text, _ = make_resume(rng)
+        start = time.perf_counter()
+        false_positives += index.query(scope, index.signature(text)) is not None
+        query_times.append(time.perf_counter() - start)
+
+    def ms(values, pct):
+        return percentile(values, pct) * 1000
+
+    stats = index.stats()
+    print(f"条目 {stats['entries']}，桶 {stats['buckets']}，num_perm {args.num_perm}，bands {args.bands}，"
+          f"阈值 {args.threshold}")
+    print(f"内存占用 {memory / 1024 / 1024:.1f} MiB（{memory / max(stats['entries'], 1):.0f} 字节/条）")
+    print(f"{'操作':<10}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for name, values in (("签名", signature_times), ("写入", add_times), ("查询", query_times)):
+        print(f"{name:<10}{ms(values, 50):>10.3f}{ms(values, 99):>10.3f}")
+    print(f"平均每次查询比较候选 {stats['compared'] / max(stats['lookups'], 1):.1f} 个")
+    print(f"召回率 {recalled / max(half, 1):.2%}（命中错误条目 {wrong}），"
+          f"误报率 {false_positives / max(args.queries - half, 1):.2%}")
+    for kind, (total, hits) in sorted(by_kind.items()):
+        print(f"  {kind:<12}{hits}/{total}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+本地OpenAI兼容桩服务，用于在不消耗真实API额度的情况下测试和压测本服务
+
+支持/v1/chat/completions、/v1/completions、/v1/models以及HEAD/OPTIONS探测，
+可以配置延迟分布、错误率、429限流比例，并可模拟API地址填成网站首页时返回HTML的情况，
+以及忽略stream参数、总是返回普通JSON的上游。
+运行中可通过以下管理接口查看和调整:
+    GET  /__stats   各路径和状态码的调用计数
+    POST /__reset   清空调用计数
+    POST /__config  修改运行参数，例如{"error_rate": 0.1, "latency": 0.5}
+
+用法:
+    python benchmarks/stub_server.py --port 9100 --latency 2.0
+    python benchmarks/stub_server.py --latency 1 --latency-dist lognormal --jitter 0.5 --error-rate 0.05 --rate-limit-rate 0.05
+    python benchmarks/stub_server.py --html-homepage
+    python benchmarks/stub_server.py --ignore-stream
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+HOMEPAGE_HTML = """<!DOCTYPE html>
+<html>
+<head><title>Stub AI Console</title></head>
+<body><div id="app">这是一个网站首页，不是API端点</div></body>
+</html>
+"""
+
+
+class StubState:
+    """桩服务的运行参数和调用计数"""
+    def __init__(self, latency=1.0, chunk_delay=0.05, latency_dist="fixed", jitter=0.0,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, html_homepage=False, ignore_stream=False,
+                 api_prefix="/v1"):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.latency_dist = latency_dist
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.html_homepage = html_homepage
+        self.ignore_stream = ignore_stream
+        self.api_prefix = api_prefix.rstrip("/")
+        self.calls = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def count_status(self, status):
+        with self._lock:
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "statuses": dict(self.statuses), "total": sum(self.calls.values())}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.statuses.clear()
+
+    def configure(self, options):
+        """按名称修改运行参数，忽略未知字段，返回当前参数"""
+        with self._lock:
+            for name in ("latency", "chunk_delay", "jitter", "error_rate", "rate_limit_rate", "retry_after"):
+                if name in options:
+                    setattr(self, name, float(options[name]))
+            if options.get("latency_dist") in LATENCY_DISTRIBUTIONS:
+                self.latency_dist = options["latency_dist"]
+            if "html_homepage" in options:
+                self.html_homepage = bool(options["html_homepage"])
+            if "ignore_stream" in options:
+                self.ignore_stream = bool(options["ignore_stream"])
+            return self.settings()
+
+    def settings(self):
+        return {
+            "latency": self.latency, "latency_dist": self.latency_dist, "jitter": self.jitter,
+            "chunk_delay": self.chunk_delay, "error_rate": self.error_rate,
+            "rate_limit_rate": self.rate_limit_rate, "retry_after": self.retry_after,
+            "html_homepage": self.html_homepage, "ignore_stream": self.ignore_stream, "api_prefix": self.api_prefix,
+        }
+
+    def sample_latency(self):
+        """
+        按配置的分布生成一次延迟（秒）：
+        fixed为固定值，uniform在latency±jitter内均匀分布，exponential的均值为latency，
+        lognormal的中位数为latency、jitter为对数标准差（长尾）
+        """
+        if self.latency_dist == "uniform":
+            value = random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+        elif self.latency_dist == "exponential":
+            value = random.expovariate(1.0 / self.latency) if self.latency > 0 else 0.0
+        elif self.latency_dist == "lognormal":
+            value = random.lognormvariate(math.log(self.latency), self.jitter) if self.latency > 0 else 0.0
+        else:
+            value = self.latency
+        return max(0.0, value)
+
+    def sample_fault(self):
+        """按错误率和限流比例决定本次生成是否注入故障，返回None、500或429"""
+        roll = random.random()
+        if roll < self.error_rate:
+            return 500
+        if roll < self.error_rate + self.rate_limit_rate:
+            return 429
+        return None
+
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_response(self, code, message=None):
+            if not self.path.startswith("/__"):
+                state.count_status(code)
+            super().send_response(code, message)
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_html(self, include_body=True):
+            body = HOMEPAGE_HTML.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if include_body:
+                self.wfile.write(body)
+
+        def _send_empty(self, status, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length) if length else b"{}"
+            try:
+                return json.loads(raw or b"{}")
+            except json.JSONDecodeError:
+                return {}
+
+        def _send_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def _api_path(self):
+            """返回去掉API前缀后的路径（如/chat/completions），不在API前缀下时返回None"""
+            path = self.path.split("?", 1)[0].rstrip("/")
+            prefix = state.api_prefix
+            if path == prefix or path.startswith(prefix + "/"):
+                return path[len(prefix):] or "/"
+            return None
+
+        def do_HEAD(self):
+            state.count(f"HEAD {self.path}")
+            api_path = self._api_path()
+            if api_path in ("/chat/completions", "/completions", "/models"):
+                return self._send_empty(200)
+            if api_path is None and state.html_homepage:
+                return self._send_html(include_body=False)
+            self._send_empty(404)
+
+        def do_OPTIONS(self):
+            state.count(f"OPTIONS {self.path}")
+            api_path = self._api_path()
+            if api_path in ("/chat/completions", "/completions", "/models") or (api_path is None and state.html_homepage):
+                return self._send_empty(204, {"Allow": "GET, POST, HEAD, OPTIONS"})
+            self._send_empty(404)
+
+        def do_GET(self):
+            if self.path.startswith("/__stats"):
+                return self._send_json(200, dict(state.snapshot(), settings=state.settings()))
+            state.count(f"GET {self.path}")
+            api_path = self._api_path()
+            if api_path == "/models":
+                return self._send_json(200, {"object": "list", "data": [{"id": "stub-model", "object": "model"}]})
+            if api_path is None and state.html_homepage:
+                # 网站首页对任意路径都返回HTML（单页应用的常见行为）
+                return self._send_html()
+            self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if self.path.startswith("/__reset"):
+                state.reset()
+                return self._send_json(200, state.snapshot())
+            if self.path.startswith("/__config"):
+                return self._send_json(200, state.configure(self._read_json()))
+            state.count(f"POST {self.path}")
+            body = self._read_json()
+            api_path = self._api_path()
+            if api_path == "/chat/completions":
+                question = body.get("messages", [{}])[-1].get("content", "")
+                return self._reply(body, f"优化结果: {question}", chat=True)
+            if api_path == "/completions":
+                return self._reply(body, f"优化结果: {body.get('prompt', '')}", chat=False)
+            if api_path is None and state.html_homepage:
+                return self._send_html()
+            self._send_json(404, {"error": {"message": "not found"}})
+
+        def _reply(self, body, answer, chat):
+            fault = state.sample_fault()
+            if fault == 429:
+                retry_after = f"{state.retry_after:g}"
+                return self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}, {
+                    "Retry-After": retry_after,
+                    "x-ratelimit-remaining-requests": "0",
+                    "x-ratelimit-reset-requests": f"{retry_after}s",
+                })
+            time.sleep(state.sample_latency())
+            if fault == 500:
+                return self._send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+            model = body.get("model", "stub-model")
+            if body.get("stream") and not state.ignore_stream:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = 8
+                for i in range(0, len(answer), step):
+                    piece = answer[i:i + step]
+                    choice = {"index": 0, "delta": {"content": piece}} if chat else {"index": 0, "text": piece}
+                    chunk = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": model, "choices": [dict(choice, finish_reason=None)]}
+                    self._send_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    time.sleep(state.chunk_delay)
+                self._send_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+                return
+            if chat:
+                choice = {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+            else:
+                choice = {"index": 0, "text": answer, "finish_reason": "stop"}
+            self._send_json(200, {
+                "id": "stub",
+                "object": "chat.completion" if chat else "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [choice],
+                "usage": {"prompt_tokens": len(json.dumps(body)) // 4, "completion_tokens": len(answer) // 4,
+                          "total_tokens": (len(json.dumps(body)) + len(answer)) // 4}
+            })
+
+    return StubHandler
+
+
+def make_server(host="127.0.0.1", port=9100, **kwargs):
+    """创建桩服务实例，返回(server, state)"""
+    state = StubState(**kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    return server, state
+
+
+def add_stub_arguments(parser):
+    """添加桩服务的运行参数，供本脚本和压测脚本共用"""
+    parser.add_argument("--latency", type=float, default=1.0, help="每次生成的延迟（秒），含义随--latency-dist变化")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="fixed", help="生成延迟的分布")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="uniform分布的波动范围（秒），或lognormal分布的对数标准差")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="流式输出每个分片之间的间隔（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="生成请求返回500的比例")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="生成请求返回429的比例")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429响应中Retry-After的秒数")
+    parser.add_argument("--html-homepage", action="store_true", help="API前缀以外的路径返回HTML首页，模拟填错API地址")
+    parser.add_argument("--ignore-stream", action="store_true", help="忽略请求中的stream参数，总是返回普通JSON")
+
+
+def stub_options(args):
+    """把命令行参数转换为make_server的关键字参数"""
+    return {
+        "latency": args.latency, "latency_dist": args.latency_dist, "jitter": args.jitter,
+        "chunk_delay": args.chunk_delay, "error_rate": args.error_rate, "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after, "html_homepage": args.html_homepage, "ignore_stream": args.ignore_stream,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = make_server(args.host, args.port, **stub_options(args))
+    print(f"桩服务已启动: http://{args.host}:{args.port}/v1", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+gunicorn配置文件
+
+默认使用gevent协作式worker：调用上游大模型时大部分时间都在等待网络I/O，
+gevent让单个进程可以同时挂起数百个/chat请求，而默认的sync worker每个进程同一时间只能处理一个请求。
+所有参数都可以通过环境变量覆盖，例如 GUNICORN_WORKER_CLASS=sync 恢复同步模式。
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# worker类型：gevent（默认，协作式）、gthread（线程池）或 sync（同步）
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+
+# worker进程数。配置默认保存在进程内存中，多进程时需设置CONFIG_STORE=file或sqlite才能共享/save_config保存的配置；
+# 响应缓存默认也在各进程内存中，设置RESPONSE_CACHE_DB后共享
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+
+# gevent模式下每个进程可同时处理的连接数
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# gthread模式下每个进程的线程数（其他模式下threads>1会让gunicorn自动切换为gthread，因此固定为1）
+threads = int(os.getenv("GUNICORN_THREADS", "32")) if worker_class == "gthread" else 1
+
+# 单个请求的最长处理时间，需大于上游超时和重试等待的总和
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# 访问日志输出位置，设为空字符串关闭访问日志
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-") or None
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")